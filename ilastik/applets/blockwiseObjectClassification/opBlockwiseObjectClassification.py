@@ -20,7 +20,9 @@
 ###############################################################################
 # Built-in
 from __future__ import division
+import time
 import logging
+import collections
 
 # Third-party
 import numpy
@@ -34,7 +36,7 @@ from lazyflow.stype import Opaque
 from lazyflow.rtype import List
 
 # ilastik
-from ilastik.utility import bind
+from ilastik.utility import bind, CacheRegistry
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectPredict, OpRelabelSegmentation, OpMaxLabel, OpMultiRelabelSegmentation
 from ilastik.applets.base.applet import DatasetConstraintError
@@ -257,7 +259,10 @@ class OpBlockwiseObjectClassification( Operator ):
     def __init__(self, *args, **kwargs):
         super( self.__class__, self ).__init__(*args, **kwargs)
         self._blockPipelines = {} # indexed by blockstart
+        self._blocksInUse = collections.Counter() # indexed by blockstart
         self._lock = RequestLock()
+        self._cache_entry = CacheRegistry().registerDictCache( "OpBlockwiseObjectClassification._blockPipelines",
+                                                               self._evictBlockPipeline )
         
     def setupOutputs(self):
         # Check for preconditions.
@@ -317,10 +322,51 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = getIntersectingBlocks( block_shape, roi_one_channel )
         block_starts = map( tuple, block_starts )
 
-        # Ensure that block pipelines exist (create first if necessary)
+        new_block_starts = self._acquireBlockPipelines( block_starts )
+        elapsed = 0.0
+        try:
+            start_time = time.time()
+            self._executeBlockPipelines( slot, roi, roi_one_channel, block_starts, destination )
+            elapsed = time.time() - start_time
+        finally:
+            self._releaseBlockPipelines( block_starts, new_block_starts, elapsed )
+        return destination
+
+    def _acquireBlockPipelines(self, block_starts):
+        """
+        Ensure that the block pipelines exist (create first if necessary, e.g. after they were evicted)
+        and protect them from eviction while we're using them.
+        Returns the block starts of the newly created pipelines.
+        """
+        new_block_starts = []
+        with self._lock:
+            for block_start in block_starts:
+                if self._ensurePipelineExists(block_start):
+                    new_block_starts.append( block_start )
+                self._blocksInUse[block_start] += 1
+        return new_block_starts
+
+    def _releaseBlockPipelines(self, block_starts, new_block_starts, elapsed):
+        """
+        Counterpart of _acquireBlockPipelines(): the pipelines may be evicted again,
+        and the new ones are registered with the CacheRegistry.
+        """
+        with self._lock:
+            for block_start in block_starts:
+                self._blocksInUse[block_start] -= 1
+                if self._blocksInUse[block_start] == 0:
+                    del self._blocksInUse[block_start]
+
+        # New pipelines are registered outside of our lock: the registry may evict (which locks) right away.
+        # We can't measure each block separately, so the elapsed time is split evenly among the new blocks.
+        for block_start in new_block_starts:
+            self._cache_entry.insert( block_start,
+                                      self._estimatePipelineBytes( block_start ),
+                                      elapsed / len(new_block_starts) )
         for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
+            self._cache_entry.touch( block_start )
 
+    def _executeBlockPipelines(self, slot, roi, roi_one_channel, block_starts, destination):
         # Retrieve result from each block, and write into the appropriate region of the destination
         pool = RequestPool()
         for block_start in block_starts:
@@ -344,8 +390,6 @@ class OpBlockwiseObjectClassification( Operator ):
             pool.add( req )
         pool.wait()
 
-        return destination
-
     def _executeBlockwiseRegionFeatures(self, roi, destination):
         """
         Provide data for the BlockwiseRegionFeatures slot.
@@ -354,19 +398,31 @@ class OpBlockwiseObjectClassification( Operator ):
                    (1,20,30,40,5) should be requested via roi [(1,2,3,4,5),(2,3,4,5,6)]
         
         Note: It is assumed that you will request these features for debug purposes, AFTER requesting the prediction image.
-              Therefore, it is considered an error to request features that are not already computed.
+              If a block's pipeline was evicted in the meantime (see CacheRegistry), it is rebuilt,
+              and the features are recomputed.
         """
-        axiskeys = self.RawImage.meta.getAxisKeys()
         # Find the corresponding block start coordinates
         block_shape = self._getFullShape( self.BlockShape3dDict.value )
         pixel_roi = numpy.array(block_shape) * (roi.start, roi.stop)
         block_starts = getIntersectingBlocks( block_shape, pixel_roi )
         block_starts = map( tuple, block_starts )
-        
+
+        new_block_starts = self._acquireBlockPipelines( block_starts )
+        elapsed = 0.0
+        try:
+            start_time = time.time()
+            self._executeBlockRegionFeatures( roi, block_starts, destination )
+            elapsed = time.time() - start_time
+        finally:
+            self._releaseBlockPipelines( block_starts, new_block_starts, elapsed )
+        return destination
+
+    def _executeBlockRegionFeatures(self, roi, block_starts, destination):
+        axiskeys = self.RawImage.meta.getAxisKeys()
+        block_shape = self._getFullShape( self.BlockShape3dDict.value )
+
         # TODO: Parallelize this?
         for block_start in block_starts:
-            assert block_start in self._blockPipelines, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
-
             # Discard spatial axes to get (t,c) index for region slot roi
             tagged_block_start = zip( axiskeys, block_start )
             tagged_block_start_tc = filter( lambda (k,v): k in 'tc', tagged_block_start )
@@ -385,37 +441,61 @@ class OpBlockwiseObjectClassification( Operator ):
             destination_with_channel = destination_without_channel[ ...,block_roi_tc[0][-1] : block_roi_tc[1][-1] ]
             req.writeInto( destination_with_channel )
             req.wait()
-        
-        return destination
 
     def _ensurePipelineExists(self, block_start):
+        """
+        Create the pipeline for the given block, if necessary.
+        Must be called with self._lock held.
+        Returns True if a new pipeline was created.
+        """
         if block_start in self._blockPipelines:
-            return
-        with self._lock:
-            if block_start in self._blockPipelines:
-                return
+            return False
+
+        logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+
+        block_shape = self._getFullShape( self._block_shape_dict )
+        halo_padding = self._getFullShape( self._halo_padding_dict )
 
-            logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+        input_shape = self.RawImage.meta.shape
+        block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
+        block_roi = (block_start, block_stop)
 
-            block_shape = self._getFullShape( self._block_shape_dict )
-            halo_padding = self._getFullShape( self._halo_padding_dict )
+        # Instantiate pipeline
+        opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
+        opBlockPipeline.RawImage.connect( self.RawImage )
+        opBlockPipeline.BinaryImage.connect( self.BinaryImage )
+        opBlockPipeline.Classifier.connect( self.Classifier )
+        opBlockPipeline.LabelsCount.connect( self.LabelsCount )
+        opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
 
-            input_shape = self.RawImage.meta.shape
-            block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
-            block_roi = (block_start, block_stop)
+        # Forward dirtyness
+        opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
 
-            # Instantiate pipeline
-            opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
-            opBlockPipeline.RawImage.connect( self.RawImage )
-            opBlockPipeline.BinaryImage.connect( self.BinaryImage )
-            opBlockPipeline.Classifier.connect( self.Classifier )
-            opBlockPipeline.LabelsCount.connect( self.LabelsCount )
-            opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+        self._blockPipelines[block_start] = opBlockPipeline
+        return True
 
-            # Forward dirtyness
-            opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
-            
-            self._blockPipelines[block_start] = opBlockPipeline
+    def _estimatePipelineBytes(self, block_start):
+        """
+        Rough estimate of the RAM held by a block pipeline's caches:
+        uint8 predictions, float32 probabilities and the uint32 label image.
+        """
+        block_start, block_stop = self.get_block_roi( block_start )
+        num_pixels = numpy.prod( numpy.subtract( block_stop, block_start ) )
+        return int( num_pixels * (1 + 4*self.LabelsCount.value + 4) )
+
+    def _evictBlockPipeline(self, block_start):
+        """
+        Called by the CacheRegistry when the RAM budget is exceeded.
+        Pipelines that are currently in use are not evicted.
+        """
+        with self._lock:
+            if self._blocksInUse[block_start] > 0:
+                return False
+            opBlockPipeline = self._blockPipelines.pop( block_start, None )
+        if opBlockPipeline is not None:
+            logger.debug( "Evicting pipeline for block: {}".format( block_start ) )
+            opBlockPipeline.cleanUp()
+        return True
 
     def get_blockshape(self):
         return self._getFullShape(self.BlockShape3dDict.value)
@@ -457,6 +537,7 @@ class OpBlockwiseObjectClassification( Operator ):
         logger.debug("Deleting all pipelines.")
         oldBlockPipelines = self._blockPipelines
         self._blockPipelines = {}
+        self._cache_entry.clear()
         with self._lock:
             for opBlockPipeline in oldBlockPipelines.values():
                 opBlockPipeline.cleanUp()
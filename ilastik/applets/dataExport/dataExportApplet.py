@@ -22,6 +22,7 @@ import os
 import argparse
 from ilastik.applets.base.applet import Applet
 from opDataExport import OpDataExport
+from roiExport import ROI_EXPORT_MODES
 from dataExportSerializer import DataExportSerializer
 from ilastik.utility import OpMultiLaneWrapper
 
@@ -112,6 +113,10 @@ class DataExportApplet( Applet ):
         
         arg_parser.add_argument( '--table_only', help='Export only csv/HDF5 table.', action='store_true', default=False )
 
+        arg_parser.add_argument( '--export_rois', help='Export only these regions (hdf5 only), as a list of (start,stop) in the input coordinates, e.g. [((0,0,0),(10,10,1)), ((50,50,0),(60,60,1))]', required=False )
+        arg_parser.add_argument( '--export_roi_mask', help='Export only the blocks in which this mask image (shaped like the input) is nonzero (hdf5 only)', required=False )
+        arg_parser.add_argument( '--roi_export_mode', help="'sparse': one dataset in which only the ROI chunks are written, 'separate': one dataset per ROI", choices=ROI_EXPORT_MODES, required=False )
+
         return arg_parser
 
     @classmethod
@@ -153,6 +158,19 @@ class DataExportApplet( Applet ):
                     msg += "cutout_subregion start and stop coordinates must have the same dimensionality!"
                     raise Exception( msg )
 
+        if parsed_args.export_rois:
+            try:
+                rois = eval( parsed_args.export_rois )
+                rois = [ (tuple(start), tuple(stop)) for start, stop in rois ]
+                assert all( len(start) == len(stop) for start, stop in rois )
+                parsed_args.export_rois = rois
+            except:
+                msg += "Didn't understand export_rois: {}\n".format(parsed_args.export_rois)
+                raise Exception( msg )
+
+        if parsed_args.export_roi_mask:
+            parsed_args.export_roi_mask = os.path.expanduser( parsed_args.export_roi_mask )
+
         if parsed_args.pipeline_result_drange:        
             try:
                 input_drange = eval(parsed_args.pipeline_result_drange)
@@ -266,5 +284,17 @@ class DataExportApplet( Applet ):
         if parsed_args.table_only:
             opDataExport.TableOnly.setValue(True)
 
+        if ( parsed_args.export_rois or parsed_args.export_roi_mask ) and not hasattr(opDataExport, 'ExportRois'):
+            raise Exception( "ROI export is not supported by {}".format( type(opDataExport).__name__ ) )
+
+        if parsed_args.export_rois:
+            opDataExport.ExportRois.setValue( parsed_args.export_rois )
+
+        if parsed_args.export_roi_mask:
+            opDataExport.ExportRoiMask.setValue( parsed_args.export_roi_mask )
+
+        if parsed_args.roi_export_mode and hasattr(opDataExport, 'RoiExportMode'):
+            opDataExport.RoiExportMode.setValue( parsed_args.roi_export_mode )
+
         # Re-connect the 'transaction' slot to apply all settings at once.
         opDataExport.TransactionSlot.setValue(True)
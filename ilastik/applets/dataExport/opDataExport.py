@@ -28,6 +28,8 @@ from lazyflow.operators.ioOperators import OpInputDataReader, OpFormattedDataExp
 from lazyflow.operators.generic import OpSubRegion
 from lazyflow.operators.valueProviders import OpMetadataInjector
 
+from roiExport import roisFromMask, exportCoordinateRois, writeRois
+
 class OpDataExport(Operator):
     """
     Top-level operator for the export applet.
@@ -51,6 +53,11 @@ class OpDataExport(Operator):
     RegionStart = InputSlot(optional=True)
     RegionStop = InputSlot(optional=True)
 
+    # Multi-ROI params: If given, only the blocks intersecting these ROIs are computed and exported (hdf5 only).
+    ExportRois = InputSlot(optional=True)    # A list of (start, stop) in the coordinates of the input (None: full axis)
+    ExportRoiMask = InputSlot(optional=True) # Path to a mask image (shaped like the input): its nonzero blocks are exported
+    RoiExportMode = InputSlot(value='sparse') # 'sparse': one dataset, only the ROI chunks written; 'separate': one dataset per ROI
+
     # Normalization params    
     InputMin = InputSlot(optional=True)
     InputMax = InputSlot(optional=True)
@@ -266,10 +273,47 @@ class OpDataExport(Operator):
         # If Table-Only is disabled or we're not dirty, we don't have to do anything.
         if not self.TableOnly.value and self.Dirty.value:
             self.cleanupOnDiskView()
-            self._opFormattedExport.run_export()
+            roi_export = self.ExportRois.ready() or self.ExportRoiMask.ready()
+            if roi_export:
+                self._run_roi_export()
+            else:
+                self._opFormattedExport.run_export()
             self.Dirty.setValue( False )
-            self.setupOnDiskView()
-            self._opImageOnDiskProvider.Dirty.setValue( False )
+            # (With one dataset per ROI, there is no single image on disk to view.)
+            if not ( roi_export and self.RoiExportMode.value == 'separate' ):
+                self.setupOnDiskView()
+                self._opImageOnDiskProvider.Dirty.setValue( False )
+
+    def _run_roi_export(self):
+        """
+        Export only the blocks that intersect the ROIs given by ExportRois and/or ExportRoiMask.
+        """
+        if self.OutputFormat.value != 'hdf5':
+            raise Exception( "Exporting ROIs is only supported for the hdf5 format, not {}".format( self.OutputFormat.value ) )
+
+        input_meta = self.Inputs[self.InputSelection.value].meta
+        rois = list( self.ExportRois.value ) if self.ExportRois.ready() else []
+        if self.ExportRoiMask.ready():
+            opMaskReader = OpInputDataReader( parent=self )
+            try:
+                opMaskReader.WorkingDirectory.setValue( self.WorkingDirectory.value )
+                opMaskReader.FilePath.setValue( self.ExportRoiMask.value )
+                rois += roisFromMask( opMaskReader.Output, input_meta.getAxisKeys() )
+            finally:
+                opMaskReader.cleanUp()
+
+        region_start = self.RegionStart.value if self.RegionStart.ready() else None
+        region_stop = self.RegionStop.value if self.RegionStop.ready() else None
+        image = self._opFormattedExport.ImageToExport
+        export_rois = exportCoordinateRois( rois, input_meta, region_start, region_stop, image.meta )
+
+        path_components = PathComponents( self.ExportPath.value, self.WorkingDirectory.value )
+        self.progressSignal(0)
+        try:
+            writeRois( image, export_rois, path_components.externalPath, path_components.internalPath,
+                       self.RoiExportMode.value, progress_callback=self.progressSignal )
+        finally:
+            self.progressSignal(100)
 
     def run_export_to_array(self):
         # This function can be used to export the results to an in-memory array, instead of to disk
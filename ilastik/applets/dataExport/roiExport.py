@@ -0,0 +1,188 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Export of multiple regions of interest (ROIs).
+
+Only the blocks of the exported image that intersect the ROIs are requested (and thus computed).
+The result is written to hdf5, either as one sparse dataset of the full image shape,
+in which only the chunks that intersect the ROIs are written, or as one dataset per ROI.
+"""
+import os
+import threading
+import logging
+from functools import partial
+
+import numpy
+import h5py
+
+from lazyflow.roi import determineBlockShape, getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+# Volume of the chunks that are computed and written
+ROI_EXPORT_BLOCK_VOLUME = 64**3
+
+ROI_EXPORT_MODES = ['sparse', 'separate']
+
+def roisFromMask(mask_slot, axiskeys, blockshape=None):
+    """
+    Return the blocks of the mask image that contain nonzero pixels,
+    as (start, stop) boxes in the given axis order (e.g. the axes of the image to export).
+    Axes that the mask doesn't have (and the mask's channel axis) are given as None, i.e. the full range.
+    """
+    mask_keys = mask_slot.meta.getAxisKeys()
+    shape = mask_slot.meta.shape
+    if blockshape is None:
+        blockshape = determineBlockShape( shape, ROI_EXPORT_BLOCK_VOLUME )
+    block_starts = getIntersectingBlocks( blockshape, ( (0,)*len(shape), shape ) )
+
+    rois = []
+    lock = threading.Lock()
+    def check_block(block_start):
+        block_roi = getBlockBounds( shape, blockshape, block_start )
+        if mask_slot(*block_roi).wait().any():
+            tagged_start = dict( zip(mask_keys, block_roi[0]) )
+            tagged_stop = dict( zip(mask_keys, block_roi[1]) )
+            start = tuple( int(tagged_start[k]) if k in tagged_start and k != 'c' else None for k in axiskeys )
+            stop = tuple( int(tagged_stop[k]) if k in tagged_stop and k != 'c' else None for k in axiskeys )
+            with lock:
+                rois.append( (start, stop) )
+
+    pool = RequestPool()
+    for block_start in block_starts:
+        pool.add( Request( partial(check_block, block_start) ) )
+    pool.wait()
+    pool.clean()
+    return sorted(rois)
+
+def exportCoordinateRois(rois, input_meta, region_start, region_stop, export_meta):
+    """
+    Transform ROIs given in the coordinates (and axis order) of the input image
+    into the coordinates of the exported image, which may be a subregion of the input
+    (region_start/region_stop, either of which may be None) with different axis order.
+    None entries of the ROIs stand for the full range of that axis.  ROIs outside the subregion are dropped.
+    """
+    input_keys = input_meta.getAxisKeys()
+    input_shape = numpy.array( input_meta.shape )
+    def full(coords, default):
+        if coords is None:
+            return numpy.array( default )
+        return numpy.array( [ d if c is None else c for c, d in zip(coords, default) ] )
+    region_start = full( region_start, [0]*len(input_shape) )
+    region_stop = full( region_stop, input_shape )
+
+    export_keys = export_meta.getAxisKeys()
+    export_shape = numpy.array( export_meta.shape )
+    export_rois = []
+    for start, stop in rois:
+        start = numpy.maximum( full(start, [0]*len(input_shape)), region_start ) - region_start
+        stop = numpy.minimum( full(stop, input_shape), region_stop ) - region_start
+        if (stop <= start).any():
+            continue
+        tagged_start = dict( zip(input_keys, start) )
+        tagged_stop = dict( zip(input_keys, stop) )
+        export_start = numpy.array( [ tagged_start.get(k, 0) for k in export_keys ] )
+        export_stop = numpy.minimum( [ tagged_stop.get(k, 1) for k in export_keys ], export_shape )
+        export_rois.append( (tuple(export_start), tuple(export_stop)) )
+    return export_rois
+
+def writeRois(image_slot, rois, filepath, internal_path, mode='sparse', blockshape=None, progress_callback=None):
+    """
+    Compute the given ROIs of the image (blockwise, in parallel) and write them to an hdf5 file.
+
+    :param rois: list of (start, stop) in the coordinates of image_slot
+    :param mode: 'sparse': write into one dataset with the shape of the whole image, in which only
+                 the chunks intersecting the ROIs are written (the others read as zeros and take no space).
+                 'separate': write each ROI to its own dataset (internal_path/roi_0, internal_path/roi_1, ...).
+    In both modes, the ROIs are also stored as an array of shape (num_rois, 2, ndim)
+    in the dataset next to the export (internal_path + '_rois').
+    :param progress_callback: called with the progress in percent
+    """
+    assert mode in ROI_EXPORT_MODES, "Unknown ROI export mode: {}".format( mode )
+    shape = tuple(image_slot.meta.shape)
+    dtype = image_slot.meta.dtype
+    if blockshape is None:
+        blockshape = determineBlockShape( shape, ROI_EXPORT_BLOCK_VOLUME )
+    blockshape = tuple( numpy.minimum(blockshape, shape) )
+    rois = [ (tuple(map(int, start)), tuple(map(int, stop))) for start, stop in rois ]
+
+    export_dir = os.path.dirname( filepath )
+    if export_dir and not os.path.exists( export_dir ):
+        os.makedirs( export_dir )
+
+    # The ROI table can be large, so it is stored as a dataset rather than an attribute
+    # (hdf5 attributes are limited to 64 KB).
+    rois_path = internal_path.rstrip('/') + '_rois'
+
+    with h5py.File( filepath, 'a' ) as f:
+        for path in (internal_path, rois_path):
+            if path in f:
+                del f[path]
+
+        # Each task is (roi to compute, destination dataset, destination roi)
+        tasks = []
+        if mode == 'sparse':
+            dset = f.create_dataset( internal_path, shape=shape, dtype=dtype, chunks=blockshape, compression='gzip' )
+            if image_slot.meta.axistags is not None:
+                dset.attrs['axistags'] = image_slot.meta.axistags.toJSON()
+            block_starts = set()
+            for roi in rois:
+                block_starts.update( map( tuple, getIntersectingBlocks( blockshape, roi ) ) )
+            for block_start in sorted(block_starts):
+                block_roi = getBlockBounds( shape, blockshape, block_start )
+                tasks.append( (block_roi, dset, block_roi) )
+        else:
+            group = f.create_group( internal_path )
+            for i, (start, stop) in enumerate(rois):
+                roi_shape = numpy.subtract( stop, start )
+                dset = group.create_dataset( 'roi_{}'.format(i), shape=tuple(roi_shape), dtype=dtype,
+                                             chunks=tuple(numpy.minimum(blockshape, roi_shape)), compression='gzip' )
+                dset.attrs['start'] = start
+                dset.attrs['stop'] = stop
+                if image_slot.meta.axistags is not None:
+                    dset.attrs['axistags'] = image_slot.meta.axistags.toJSON()
+                for block_start in getIntersectingBlocks( blockshape, (start, stop) ):
+                    block_roi = getBlockBounds( shape, blockshape, block_start )
+                    intersection = getIntersection( block_roi, (start, stop) )
+                    destination_roi = numpy.subtract( intersection, start )
+                    tasks.append( (intersection, dset, destination_roi) )
+        if rois:
+            f.create_dataset( rois_path, data=numpy.array( rois, dtype=numpy.int64 ) )
+
+        lock = threading.Lock()
+        num_done = [0]
+        def process(task):
+            roi, dset, destination_roi = task
+            data = image_slot(*roi).wait()
+            with lock:
+                dset[roiToSlice(*destination_roi)] = data
+                num_done[0] += 1
+                if progress_callback is not None:
+                    progress_callback( 100 * num_done[0] // len(tasks) )
+
+        pool = RequestPool()
+        for task in tasks:
+            pool.add( Request( partial(process, task) ) )
+        pool.wait()
+        pool.clean()
+
+    logger.info( "Exported {} ROIs ({} blocks) to {}/{}".format( len(rois), len(tasks), filepath, internal_path ) )
@@ -250,7 +250,7 @@ class DataSelectionApplet( Applet ):
         import pickle
         import h5py
         from lazyflow.graph import Graph
-        from lazyflow.operators.ioOperators import OpStackToH5Writer
+        from projectDataStorage import createStackLoader, importStack, isImportComplete
         
         filePaths = list(filePaths)
         for i, path in enumerate(filePaths):
@@ -273,27 +273,23 @@ class DataSelectionApplet( Applet ):
             # Overwrite original path
             filePaths[i] = stackPath + "/volume/data"
 
-            # Generate the hdf5 if it doesn't already exist
-            if os.path.exists(stackPath):
-                logger.info( "Using previously generated hdf5 volume for stack {}".format(path) )
-                logger.info( "Volume path: {}".format(filePaths[i]) )
-            else:
+            if not os.path.exists( stackVolumeCacheDir ):
+                os.makedirs( stackVolumeCacheDir )
+
+            # Generate the hdf5 if it doesn't already exist (or finish it, if its import was interrupted)
+            with h5py.File(stackPath, 'a') as f:
+                if isImportComplete(f, 'volume/data'):
+                    logger.info( "Using previously generated hdf5 volume for stack {}".format(path) )
+                    logger.info( "Volume path: {}".format(filePaths[i]) )
+                    continue
+
                 logger.info( "Generating hdf5 volume for stack {}".format(path) )
                 logger.info( "Volume path: {}".format(filePaths[i]) )
-
-                if not os.path.exists( stackVolumeCacheDir ):
-                    os.makedirs( stackVolumeCacheDir )
-                
-                with h5py.File(stackPath) as f:
-                    # Configure the conversion operator
-                    opWriter = OpStackToH5Writer( graph=Graph() )
-                    opWriter.hdf5Group.setValue(f)
-                    opWriter.hdf5Path.setValue("volume/data")
-                    opWriter.GlobString.setValue(globstring)
-                    
-                    # Initiate the write
-                    success = opWriter.WriteImage.value
-                    assert success, "Something went wrong when generating an hdf5 file from an image sequence."
+                opLoader, stack_slot = createStackLoader( globstring, 'z', graph=Graph() )
+                try:
+                    importStack( stack_slot, f.require_group('volume'), 'data', 'z', source=globstring )
+                finally:
+                    opLoader.cleanUp()
             
         return filePaths
 
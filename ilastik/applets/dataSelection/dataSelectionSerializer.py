@@ -20,9 +20,6 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 from opDataSelection import OpDataSelection, DatasetInfo
-from lazyflow.operators.ioOperators import OpStackLoader, OpH5WriterBigDataset
-from lazyflow.operators.ioOperators.opTiffReader import OpTiffReader
-from lazyflow.operators.ioOperators.opTiffSequenceReader import OpTiffSequenceReader
 
 import os
 import vigra
@@ -31,6 +28,8 @@ from lazyflow.utility.timer import timeLogged
 from ilastik.utility import bind
 from lazyflow.utility.pathHelpers import getPathVariants, isUrl
 import ilastik.utility.globals
+from ilastik.config import cfg as ilastik_config
+from projectDataStorage import writeProjectDataset, createStackLoader, importStack
 
 from ilastik.applets.base.appletSerializer import \
     AppletSerializer, getOrCreateGroup, deleteIfPresent
@@ -57,6 +56,10 @@ class DataSelectionSerializer( AppletSerializer ):
         self._projectFilePath = None
         
         self.version = '0.2'
+
+        # Storage layout for data that is copied into the project (see projectDataStorage)
+        self.storageCompression = ilastik_config.get('project data', 'compression')
+        self.chunkLayout = ilastik_config.get('project data', 'chunk_layout')
         
         def handleDirty():
             if not self.ignoreDirty:
@@ -84,40 +87,43 @@ class DataSelectionSerializer( AppletSerializer ):
         # Write any missing local datasets to the local_data group
         localDataGroup = getOrCreateGroup(topGroup, 'local_data')
         wroteInternalData = False
+
+        # Find the datasets that should be stored in the project, but aren't there yet
+        missing = []
         for laneIndex, multislot in enumerate(self.topLevelOperator.DatasetGroup):
             for roleIndex, slot in enumerate( multislot ):
                 if not slot.ready():
                     continue
                 info = slot.value
-                # If this dataset should be stored in the project, but it isn't there yet
                 if  info.location == DatasetInfo.Location.ProjectInternal \
                 and info.datasetId not in localDataGroup.keys():
-                    # Obtain the data from the corresponding output and store it to the project.
-                    dataSlot = self.topLevelOperator._NonTransposedImageGroup[laneIndex][roleIndex]
-
-                    try:    
-                        opWriter = OpH5WriterBigDataset(parent=self.topLevelOperator.parent, graph=self.topLevelOperator.graph)
-                        opWriter.CompressionEnabled.setValue(False) # Compression slows down browsing a lot, and raw data tends to be noisy and doesn't compress very well, anyway.
-                        opWriter.hdf5File.setValue( localDataGroup )
-                        opWriter.hdf5Path.setValue( info.datasetId )
-                        opWriter.Image.connect(dataSlot)
-        
-                        # Trigger the copy
-                        success = opWriter.WriteImage.value
-                        assert success
-                    finally:
-                        opWriter.cleanUp()
+                    missing.append( (laneIndex, roleIndex, info) )
+
+        if missing:
+            self.progressSignal.emit(0)
+        try:
+            for i, (laneIndex, roleIndex, info) in enumerate(missing):
+                # Obtain the data from the corresponding output and store it to the project.
+                dataSlot = self.topLevelOperator._NonTransposedImageGroup[laneIndex][roleIndex]
+
+                def emit_progress(percent):
+                    self.progressSignal.emit( (100*i + percent) / len(missing) )
+                writeProjectDataset( dataSlot, localDataGroup, info.datasetId,
+                                     self.storageCompression, self.chunkLayout, progress_callback=emit_progress )
     
-                    # Add axistags and drange attributes, in case someone uses this dataset outside ilastik
-                    localDataGroup[info.datasetId].attrs['axistags'] = dataSlot.meta.axistags.toJSON()
-                    if dataSlot.meta.drange is not None:
-                        localDataGroup[info.datasetId].attrs['drange'] = dataSlot.meta.drange
+                # Add axistags and drange attributes, in case someone uses this dataset outside ilastik
+                localDataGroup[info.datasetId].attrs['axistags'] = dataSlot.meta.axistags.toJSON()
+                if dataSlot.meta.drange is not None:
+                    localDataGroup[info.datasetId].attrs['drange'] = dataSlot.meta.drange
     
-                    # Make sure the dataSlot's axistags are updated with the dataset as we just wrote it
-                    # (The top-level operator may use an OpReorderAxes, which changed the axisorder)
-                    info.axistags = dataSlot.meta.axistags
+                # Make sure the dataSlot's axistags are updated with the dataset as we just wrote it
+                # (The top-level operator may use an OpReorderAxes, which changed the axisorder)
+                info.axistags = dataSlot.meta.axistags
     
-                    wroteInternalData = True
+                wroteInternalData = True
+        finally:
+            if missing:
+                self.progressSignal.emit(100)
 
         # Construct a list of all the local dataset ids we want to keep
         localDatasetIds = set()
@@ -206,39 +212,23 @@ class DataSelectionSerializer( AppletSerializer ):
         if os.path.pathsep not in globstring and not os.path.isabs(globstring):
             globstring = os.path.normpath( os.path.join(cwd, globstring) )
 
-        if firstPathParts.extension.lower() in OpTiffReader.TIFF_EXTS:
-            # Special loader for TIFFs
-            opLoader = OpTiffSequenceReader( parent=self.topLevelOperator.parent )
-            opLoader.SequenceAxis.setValue(sequence_axis)
-            opLoader.GlobString.setValue(globstring)
-            data_slot = opLoader.Output
-        else:
-            # All other sequences (e.g. pngs, jpegs, etc.)
-            opLoader = OpStackLoader( parent=self.topLevelOperator.parent )
-            opLoader.SequenceAxis.setValue(sequence_axis)
-            opLoader.globstring.setValue(globstring)
-            data_slot = opLoader.stack
+        # If an earlier import of this stack was interrupted, resume it
+        localDataGroup = getOrCreateGroup( getOrCreateGroup(projectFileHdf5, self.topGroupName), 'local_data' )
+        for datasetId, dataset in localDataGroup.items():
+            if 'imported_slabs' in dataset.attrs and dataset.attrs.get('import_source') == globstring:
+                info._datasetId = datasetId
+                break
 
+        opLoader, data_slot = createStackLoader( globstring, sequence_axis, parent=self.topLevelOperator.parent )
         try:
-            opWriter = OpH5WriterBigDataset(parent=self.topLevelOperator.parent)
-            opWriter.hdf5File.setValue(projectFileHdf5)
-            opWriter.hdf5Path.setValue(self.topGroupName + '/local_data/' + info.datasetId)
-            opWriter.CompressionEnabled.setValue(False)
-            # We assume that the main bottleneck is the hard disk, 
-            #  so adding lots of threads to access it at once seems like a bad idea.
-            opWriter.BatchSize.setValue(1)
-            opWriter.Image.connect( data_slot )
-                
-            # Forward progress from the writer directly to our applet                
-            opWriter.progressSignal.subscribe( self.progressSignal.emit )
-
-            success = opWriter.WriteImage.value
+            importStack( data_slot, localDataGroup, info.datasetId, sequence_axis, source=globstring,
+                         compression=self.storageCompression, layout=self.chunkLayout,
+                         progress_callback=self.progressSignal.emit )
         finally:
-            opWriter.cleanUp()
             opLoader.cleanUp()
             self.progressSignal.emit(100)
 
-        return success
+        return True
 
     def initWithoutTopGroup(self, hdf5File, projectFilePath):
         """
@@ -322,15 +322,22 @@ class OpDataSelection(Operator):
                                      "correct dimensionality for your dataset, which has {} dimensions."
                                      .format( "".join(tag.key for tag in datasetInfo.axistags), len(providerSlot.meta.shape) ) )
                 metadata['axistags'] = datasetInfo.axistags
-            if datasetInfo.subvolume_roi is not None:
-                metadata['subvolume_roi'] = datasetInfo.subvolume_roi
-                
+
                 # FIXME: We are overwriting the axistags metadata to intentionally allow 
                 #        the user to change our interpretation of which axis is which.
                 #        That's okay, but technically there's a special corner case if 
                 #        the user redefines the channel axis index.  
                 #        Technically, it invalidates the meaning of meta.ram_usage_per_requested_pixel.
                 #        For most use-cases, that won't really matter, which is why I'm not worrying about it right now.
+            if datasetInfo.subvolume_roi is not None:
+                metadata['subvolume_roi'] = datasetInfo.subvolume_roi
+            if datasetInProject and self.ProjectFile.value[internalPath].chunks is not None:
+                # Let downstream operators request chunk-aligned blocks
+                metadata['ideal_blockshape'] = self.ProjectFile.value[internalPath].chunks
+            if datasetInfo.location == DatasetInfo.Location.FileSystem and not isUrl( datasetInfo.filePath ):
+                # Downstream operators may use this to identify the data source (e.g. for persistent caches).
+                metadata['filepath'] = os.path.pathsep.join( make_absolute( path, self.WorkingDirectory.value )
+                                                             for path in datasetInfo.filePath.split( os.path.pathsep ) )
             
             opMetadataInjector = OpMetadataInjector( parent=self )
             opMetadataInjector.Input.connect( providerSlot )
@@ -0,0 +1,260 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Storage layout of datasets that are copied into the project file.
+
+The chunk shape is chosen from the data's axes: 2D tiles for images (and for stacks that are
+viewed slice by slice) or cubes for volumes.  Compression is optional, since it slows down browsing
+and noisy raw data doesn't compress very well.  The layout is recorded in the dataset attributes
+(and, of course, in its hdf5 chunk shape), so readers can request chunk-aligned blocks.
+
+Image stacks are imported with their own (resumable) writer, see importStack().
+"""
+import os
+import threading
+import logging
+from functools import partial
+
+import numpy
+
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+STORAGE_COMPRESSIONS = ['none', 'lzf', 'gzip']
+CHUNK_LAYOUTS = ['auto', 'tiles', 'cubes']
+
+TILE_WIDTH = 256
+CUBE_WIDTH = 64
+
+# Chunks include all channels, unless there are more than this
+MAX_CHUNK_CHANNELS = 4
+
+# Data is copied in chunk-aligned blocks of (at least) this size
+WRITE_BLOCK_BYTES = 16 * 2**20
+
+# Image stacks are imported in batches of (about) this size
+IMPORT_BATCH_BYTES = 256 * 2**20
+
+def chooseChunkShape(tagged_shape, layout='auto'):
+    """
+    Choose the hdf5 chunk shape for data with the given tagged shape (an OrderedDict of axis key -> size).
+
+    'tiles': TILE_WIDTH x TILE_WIDTH tiles in x and y, one slice along z
+    'cubes': CUBE_WIDTH in each spatial axis
+    'auto': cubes for volumes (z > 1), tiles otherwise
+
+    Chunks are one time step deep and contain all channels (if there are only a few).
+    Returns (chunk shape, the layout that was used).
+    """
+    assert layout in CHUNK_LAYOUTS, "Unknown chunk layout: {}".format( layout )
+    if layout == 'auto':
+        layout = 'cubes' if tagged_shape.get('z', 1) > 1 else 'tiles'
+
+    chunks = []
+    for key, size in tagged_shape.items():
+        if key == 't':
+            width = 1
+        elif key == 'c':
+            width = size if size <= MAX_CHUNK_CHANNELS else 1
+        elif key == 'z':
+            width = CUBE_WIDTH if layout == 'cubes' else 1
+        else:
+            width = CUBE_WIDTH if layout == 'cubes' else TILE_WIDTH
+        chunks.append( max(1, min(width, size)) )
+    return tuple(chunks), layout
+
+def writeBlockShape(shape, chunks, itemsize, block_bytes=WRITE_BLOCK_BYTES):
+    """
+    Grow the chunk shape (by doubling, so blocks stay chunk-aligned) until blocks have about block_bytes.
+    """
+    shape = numpy.array( shape )
+    block = numpy.array( chunks )
+    while numpy.prod(block) * itemsize < block_bytes and (block < shape).any():
+        block = numpy.where( block < shape, numpy.minimum( 2*block, shape ), block )
+    return tuple( int(b) for b in block )
+
+def writeProjectDataset(data_slot, group, name, compression='none', layout='auto',
+                        batch_size=None, progress_callback=None):
+    """
+    Copy the data of the given slot into a new dataset group[name] with the requested storage layout.
+    Chunk-aligned blocks are requested in parallel (batch_size at a time; default: one per worker thread)
+    and written as they arrive.
+
+    :param compression: one of STORAGE_COMPRESSIONS
+    :param layout: one of CHUNK_LAYOUTS (see chooseChunkShape())
+    :param progress_callback: called with the progress in percent
+    :returns: the new dataset
+    """
+    assert compression in STORAGE_COMPRESSIONS, "Unknown compression: {}".format( compression )
+    tagged_shape = data_slot.meta.getTaggedShape()
+    shape = tuple(data_slot.meta.shape)
+    dtype = numpy.dtype(data_slot.meta.dtype)
+    chunks, layout = chooseChunkShape( tagged_shape, layout )
+
+    compression_args = {}
+    if compression != 'none':
+        compression_args = { 'compression' : compression, 'shuffle' : True }
+    dataset = group.create_dataset( name, shape=shape, dtype=dtype, chunks=chunks, **compression_args )
+    dataset.attrs['chunk_layout'] = layout
+    dataset.attrs['compression'] = compression
+
+    blockshape = writeBlockShape( shape, chunks, dtype.itemsize )
+    block_starts = getIntersectingBlocks( blockshape, ( (0,)*len(shape), shape ) )
+    logger.debug( "Copying {} into the project: chunks {}, {} blocks of {}, compression: {}"
+                  .format( name, chunks, len(block_starts), blockshape, compression ) )
+
+    if batch_size is None:
+        batch_size = max( 1, Request.global_thread_pool.num_workers )
+    write_lock = threading.Lock()
+    def copy_block(block_start):
+        block_roi = getBlockBounds( shape, blockshape, block_start )
+        data = data_slot(*block_roi).wait()
+        with write_lock:
+            dataset[roiToSlice(*block_roi)] = data
+
+    for batch_start in range(0, len(block_starts), batch_size):
+        pool = RequestPool()
+        for block_start in block_starts[batch_start:batch_start+batch_size]:
+            pool.add( Request( partial(copy_block, block_start) ) )
+        pool.wait()
+        pool.clean()
+        if progress_callback is not None:
+            progress_callback( 100 * min(batch_start + batch_size, len(block_starts)) // len(block_starts) )
+    return dataset
+
+def createStackLoader(globstring, sequence_axis, **op_kwargs):
+    """
+    Create the operator that reads the given image stack (TIFF sequences have their own reader).
+    The op_kwargs (parent or graph) are passed to the operator.
+    Returns (loader operator, output slot).  Clean up the operator when you're done with it.
+    """
+    from lazyflow.operators.ioOperators import OpStackLoader
+    from lazyflow.operators.ioOperators.opTiffReader import OpTiffReader
+    from lazyflow.operators.ioOperators.opTiffSequenceReader import OpTiffSequenceReader
+
+    first_file = globstring.split(os.path.pathsep)[0]
+    if os.path.splitext(first_file)[1].lower() in OpTiffReader.TIFF_EXTS:
+        opLoader = OpTiffSequenceReader( **op_kwargs )
+        opLoader.SequenceAxis.setValue(sequence_axis)
+        opLoader.GlobString.setValue(globstring)
+        return opLoader, opLoader.Output
+    else:
+        # All other sequences (e.g. pngs, jpegs, etc.)
+        opLoader = OpStackLoader( **op_kwargs )
+        opLoader.SequenceAxis.setValue(sequence_axis)
+        opLoader.globstring.setValue(globstring)
+        return opLoader, opLoader.stack
+
+def isImportComplete(group, name):
+    """
+    True if group[name] exists and is not the remainder of an interrupted importStack().
+    """
+    return name in group and 'imported_slabs' not in group[name].attrs
+
+def importStack(stack_slot, group, name, sequence_axis, source, compression='none', layout='auto',
+                batch_bytes=IMPORT_BATCH_BYTES, progress_callback=None):
+    """
+    Copy an image stack (e.g. from createStackLoader()) into a new dataset group[name].
+
+    The stack is split along the sequence axis into slabs that are one chunk deep, so every
+    write fills whole chunks.  The slabs are imported in order, in batches of about batch_bytes:
+    all slices of a batch are decoded in parallel, and the batch is written at once.
+    After each batch, the number of completed slabs is recorded in the dataset attributes.
+    If the import is interrupted, calling this function again with the same source resumes
+    after the last completed batch.
+
+    :param source: identifies the stack (e.g. its globstring).  An existing dataset is only resumed
+                   (or, if it is complete, kept) if it was imported from the same source.
+    :param compression: one of STORAGE_COMPRESSIONS
+    :param layout: one of CHUNK_LAYOUTS (see chooseChunkShape())
+    :param progress_callback: called with the progress in percent
+    :returns: the dataset
+    """
+    assert compression in STORAGE_COMPRESSIONS, "Unknown compression: {}".format( compression )
+    axiskeys = stack_slot.meta.getAxisKeys()
+    shape = tuple(stack_slot.meta.shape)
+    dtype = numpy.dtype(stack_slot.meta.dtype)
+    axis = axiskeys.index(sequence_axis) if sequence_axis in axiskeys else 0
+
+    dataset = group.get(name)
+    if dataset is not None and ( dataset.attrs.get('import_source') != source
+                                 or dataset.shape != shape or dataset.dtype != dtype ):
+        logger.info( "Replacing {}, which doesn't match the stack {}".format( name, source ) )
+        del group[name]
+        dataset = None
+
+    if dataset is None:
+        chunks, layout = chooseChunkShape( stack_slot.meta.getTaggedShape(), layout )
+        compression_args = {}
+        if compression != 'none':
+            compression_args = { 'compression' : compression, 'shuffle' : True }
+        dataset = group.create_dataset( name, shape=shape, dtype=dtype, chunks=chunks, **compression_args )
+        dataset.attrs['chunk_layout'] = layout
+        dataset.attrs['compression'] = compression
+        dataset.attrs['axistags'] = stack_slot.meta.axistags.toJSON()
+        dataset.attrs['import_source'] = source
+        dataset.attrs['imported_slabs'] = 0
+
+    # Use the chunks of the dataset we have (the layout may have changed since an interrupted import)
+    slab_depth = dataset.chunks[axis]
+    num_slabs = -(-shape[axis] // slab_depth)
+    first_slab = int( dataset.attrs.get('imported_slabs', num_slabs) )
+    if first_slab > 0 and first_slab < num_slabs:
+        logger.info( "Resuming import of {} at slab {} of {}".format( source, first_slab, num_slabs ) )
+
+    slab_bytes = dtype.itemsize * numpy.prod(shape) // shape[axis] * slab_depth
+    slabs_per_batch = max( 1, batch_bytes // slab_bytes )
+
+    def read_slice(index, batch_start, batch_data):
+        start = [0] * len(shape)
+        stop = list(shape)
+        start[axis], stop[axis] = index, index+1
+        dest = [slice(None)] * len(shape)
+        dest[axis] = slice(index - batch_start, index - batch_start + 1)
+        stack_slot(start, stop).writeInto( batch_data[tuple(dest)] ).wait()
+
+    for batch_first_slab in range(first_slab, num_slabs, slabs_per_batch):
+        batch_stop_slab = min( batch_first_slab + slabs_per_batch, num_slabs )
+        batch_start = batch_first_slab * slab_depth
+        batch_stop = min( batch_stop_slab * slab_depth, shape[axis] )
+        batch_shape = list(shape)
+        batch_shape[axis] = batch_stop - batch_start
+        batch_data = numpy.empty( batch_shape, dtype=dtype )
+
+        pool = RequestPool()
+        for index in range(batch_start, batch_stop):
+            pool.add( Request( partial(read_slice, index, batch_start, batch_data) ) )
+        pool.wait()
+        pool.clean()
+
+        dest = [slice(None)] * len(shape)
+        dest[axis] = slice(batch_start, batch_stop)
+        dataset[tuple(dest)] = batch_data
+        dataset.attrs['imported_slabs'] = batch_stop_slab
+        dataset.file.flush()
+        if progress_callback is not None:
+            progress_callback( 100 * batch_stop_slab // num_slabs )
+
+    if 'imported_slabs' in dataset.attrs:
+        del dataset.attrs['imported_slabs']
+    return dataset
@@ -19,23 +19,43 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 from __future__ import division
+import time
+import collections
+from functools import partial
+
 from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.roi import determineBlockShape, getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+from lazyflow.request import Request, RequestPool, RequestLock
 import numpy
-from ilastik.utility import MultiLaneOperatorABC, OperatorSubView
+from ilastik.utility import MultiLaneOperatorABC, OperatorSubView, CacheRegistry
 
 class OpDeviationFromMean(Operator):
     """
     Multi-image operator.
     Calculates the pixelwise mean of a set of images, and produces a set of corresponding images for the difference from the mean.
     Note: Inputs must all have the same shape.
-    """    
+
+    The pixelwise sum of all inputs is cached blockwise, so it is computed once for all
+    outputs (and the Mean).  When an input becomes dirty, only the affected blocks are dropped.
+    """
+    # Number of pixels per cached block of the sum image
+    BLOCK_VOLUME = 64**3
+
     ScalingFactor = InputSlot() # Scale after subtraction
     Offset = InputSlot()        # Offset final results
     Input = InputSlot(level=1)  # Multi-image input
 
     Mean = OutputSlot()
     Output = OutputSlot(level=1) # Multi-image output
-    
+
+    def __init__(self, *args, **kwargs):
+        super(OpDeviationFromMean, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._blockshape = None
+        self._sums = {} # block start -> sum of all inputs (float64)
+        self._block_versions = collections.defaultdict(int)
+        self._cache_entry = CacheRegistry().registerDictCache( "OpDeviationFromMean.sums", self._evictBlock )
+
     def setupOutputs(self):
         # Ensure all inputs have the same shape
         if len(self.Input) > 0:
@@ -51,29 +71,100 @@ class OpDeviationFromMean(Operator):
         
         self.Mean.meta.assignFrom(self.Input[0].meta)
 
+        blockshape = tuple( determineBlockShape( self.Input[0].meta.shape, self.BLOCK_VOLUME ) )
+        if blockshape != self._blockshape:
+            self._blockshape = blockshape
+            self._invalidate()
+
         def markAllOutputsDirty( *args ):
+            self._invalidate()
             self.propagateDirty( self.Input, (), slice(None) )
         self.Input.notifyInserted( markAllOutputsDirty )
         self.Input.notifyRemoved( markAllOutputsDirty )
 
-    def execute(self, slot, subindex, roi, result):
+    def _invalidate(self, roi=None):
         """
-        Compute.  This is a simple implementation, without optimizations.
+        Drop the cached sums of all blocks that intersect the given roi (default: all blocks).
         """
-        # Compute average of *all* inputs
-        result[:] = 0.0
+        with self._lock:
+            if roi is None:
+                block_starts = self._sums.keys() + self._block_versions.keys()
+            else:
+                block_starts = map( tuple, getIntersectingBlocks( self._blockshape, roi ) )
+            for block_start in block_starts:
+                self._block_versions[block_start] += 1
+                self._sums.pop( block_start, None )
+                self._cache_entry.discard( block_start )
+
+    def _evictBlock(self, block_start):
+        """
+        Called by the CacheRegistry when the RAM budget is exceeded.
+        """
+        with self._lock:
+            self._sums.pop( block_start, None )
+
+    def _blockSum(self, block_start):
+        """
+        Return the sum of all inputs in the given block, from the cache if possible.
+        """
+        with self._lock:
+            block_sum = self._sums.get( block_start )
+            version = self._block_versions[block_start]
+        if block_sum is not None:
+            self._cache_entry.touch( block_start )
+            return block_sum
+
+        start_time = time.time()
+        block_roi = getBlockBounds( self.Input[0].meta.shape, self._blockshape, block_start )
+        block_sum = numpy.zeros( numpy.subtract(*block_roi[::-1]), dtype=numpy.float64 )
         for s in self.Input:
-            result[:] += s.get(roi).wait()
-        result[:] = result / len(self.Input)
+            block_sum += s(*block_roi).wait()
+
+        with self._lock:
+            # Don't cache the sum if an input became dirty in the meantime
+            cached = ( self._block_versions[block_start] == version )
+            if cached:
+                self._sums[block_start] = block_sum
+
+        # Report the new cache entry only after releasing our lock:
+        #  the registry may decide to evict (which locks) right away.
+        if cached:
+            self._cache_entry.insert( block_start, block_sum.nbytes, time.time() - start_time )
+        return block_sum
+
+    def _computeMean(self, roi, result):
+        shape = self.Input[0].meta.shape
+        request_roi = numpy.array( (roi.start, roi.stop) )
+        block_starts = map( tuple, getIntersectingBlocks( self._blockshape, request_roi ) )
+
+        def process_block(block_start):
+            block_roi = getBlockBounds( shape, self._blockshape, block_start )
+            intersection = getIntersection( block_roi, request_roi )
+            block_relative = numpy.subtract( intersection, block_roi[0] )
+            result_relative = numpy.subtract( intersection, request_roi[0] )
+            block_sum = self._blockSum( block_start )
+            result[roiToSlice(*result_relative)] = block_sum[roiToSlice(*block_relative)] / len(self.Input)
+
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add( Request( partial(process_block, block_start) ) )
+        pool.wait()
+        pool.clean()
+
+    def execute(self, slot, subindex, roi, result):
+        # Compute average of *all* inputs (from the cached sums)
+        mean = numpy.empty( result.shape, dtype=numpy.float64 )
+        self._computeMean( roi, mean )
 
         # If the user wanted the mean, we're done.
         if slot == self.Mean:
+            result[:] = mean
             return result
 
         assert slot == self.Output
 
         # Subtract average from the particular image being requested
-        result[:] = self.Input[subindex].get(roi).wait() - result
+        result[:] = self.Input[subindex].get(roi).wait() - mean
 
         # Scale
         result[:] *= self.ScalingFactor.value
@@ -85,10 +176,22 @@ class OpDeviationFromMean(Operator):
 
     def propagateDirty(self, slot, subindex, roi):
         # If the dirty slot is one of our two constants, then the entire image region is dirty
+        # (but the cached sums are still valid)
         if slot == self.Offset or slot == self.ScalingFactor:
-            roi = slice(None) # The whole image region
-        
-        # All inputs affect all outputs, so every image is dirty now
+            for oslot in self.Output:
+                oslot.setDirty( slice(None) )
+            return
+
+        if isinstance( roi, slice ) or self._blockshape is None or len(self.Input) == 0:
+            # Whole image (e.g. an image was added or removed)
+            self._invalidate()
+            roi = slice(None)
+        else:
+            # Only the sums of the affected blocks must be recomputed
+            self._invalidate( numpy.array( (roi.start, roi.stop) ) )
+
+        # All inputs affect all outputs within the dirty region
+        self.Mean.setDirty( roi )
         for oslot in self.Output:
             oslot.setDirty( roi )
 
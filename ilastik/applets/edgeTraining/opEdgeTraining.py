@@ -10,6 +10,7 @@ import ilastikrag
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.roi import roiToSlice
+from lazyflow.request import Request, RequestPool
 from lazyflow.operators import OpValueCache, OpBlockedArrayCache
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
 
@@ -228,36 +229,59 @@ class OpComputeEdgeFeatures(Operator):
         rag = self.Rag.value
         channel_feature_names = self.FeatureNames.value
 
-        edge_feature_dfs =[]
+        # Which channels have any features selected?
+        selected_channels = []
         for c in range( self.VoxelData.meta.shape[-1] ):
             channel_name = self.VoxelData.meta.channel_names[c]
-            if channel_name not in channel_feature_names:
-                continue
-            feature_names = list(channel_feature_names[channel_name])
-            if not feature_names:
-                # No features selected for this channel
-                continue
+            if channel_feature_names.get(channel_name):
+                selected_channels.append(c)
+
+        all_edge_features_df = pd.DataFrame( rag.edge_ids, columns=['sp1', 'sp2'] )
+        if not selected_channels:
+            result[0] = all_edge_features_df
+            return
 
-            voxel_data = self.VoxelData[...,c:c+1].wait()
+        # The accumulator passes for each channel are independent, so compute them in parallel.
+        # Each pass fetches only its own channel, so unselected channels are never read,
+        # and only the channels that are currently being processed are held in memory.
+        channel_features = {}
+        def compute_channel_features(c):
+            channel_name = self.VoxelData.meta.channel_names[c]
+            feature_names = list(channel_feature_names[channel_name])
+            voxel_data = self.VoxelData[..., c:c+1].wait()
             voxel_data = vigra.taggedView(voxel_data, self.VoxelData.meta.axistags)
             voxel_data = voxel_data[...,0] # drop channel
             edge_features_df = rag.compute_features(voxel_data, feature_names)
 
             #if np.isnan(edge_features_df.values).any():
             #    raise RuntimeError("Whoa, why are there NaN values in the feature matrix?")
-            
-            edge_features_df = edge_features_df.iloc[:, 2:] # Discard columns [sp1, sp2]
-            
-            # Prefix all column names with the channel name, to guarantee uniqueness
-            # (Generally a nice feature, but also required for serialization.)
-            edge_features_df.columns = map( lambda feature_name: channel_name + ' ' + feature_name,
-                                            edge_features_df.columns.values )
-            edge_feature_dfs.append(edge_features_df)
 
-        # Could use join() or merge() here, but we know the rows are already in the right order, and concat() should be faster.
-        all_edge_features_df = pd.DataFrame( rag.edge_ids, columns=['sp1', 'sp2'] )
-        all_edge_features_df = pd.concat([all_edge_features_df] + edge_feature_dfs, axis=1, copy=False)
-        result[0] = all_edge_features_df
+            # Discard columns [sp1, sp2], and prefix all column names with the channel name,
+            # to guarantee uniqueness (Generally a nice feature, but also required for serialization.)
+            column_names = map( lambda feature_name: channel_name + ' ' + feature_name,
+                                edge_features_df.columns.values[2:] )
+            channel_features[c] = ( column_names, edge_features_df.iloc[:, 2:].values )
+
+        pool = RequestPool()
+        for c in selected_channels:
+            pool.add( Request( partial(compute_channel_features, c) ) )
+        pool.wait()
+        pool.clean()
+
+        # Merge all channels into one preallocated array (instead of merging DataFrames column by column)
+        all_column_names = []
+        num_columns = sum( channel_features[c][1].shape[1] for c in selected_channels )
+        dtype = np.result_type( *[ channel_features[c][1].dtype for c in selected_channels ] )
+        edge_features = np.empty( (len(rag.edge_ids), num_columns), dtype=dtype )
+        col = 0
+        for c in selected_channels:
+            column_names, values = channel_features[c]
+            edge_features[:, col:col+values.shape[1]] = values
+            all_column_names += column_names
+            col += values.shape[1]
+
+        edge_features_df = pd.DataFrame( edge_features, columns=all_column_names )
+        result[0] = pd.concat([all_edge_features_df, edge_features_df], axis=1, copy=False)
  
     def propagateDirty(self, slot, subindex, roi):
         self.EdgeFeaturesDataFrame.setDirty()
@@ -44,7 +44,7 @@ class FeatureSelectionApplet( StandardApplet ):
 
     @property
     def broadcastingSlots(self):
-        return ['Scales', 'FeatureIds', 'SelectionMatrix']
+        return ['Scales', 'FeatureIds', 'SelectionMatrix', 'PersistentCacheDirectory']
 
     @property
     def singleLaneGuiClass(self):
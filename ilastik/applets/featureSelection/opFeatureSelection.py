@@ -19,6 +19,7 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 #Python
+import os
 import sys
 import logging
 
@@ -36,6 +37,7 @@ from lazyflow.operators.imgFilterOperators import OpPixelFeaturesPresmoothed as
 from lazyflow.operators import OpReorderAxes, OperatorWrapper
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from opPersistentFeatureCache import OpPersistentFeatureCache, featureCacheKey
 
 logger = logging.getLogger(__name__)
 
@@ -88,6 +90,10 @@ class OpFeatureSelectionNoCache(Operator):
                                                        #  which requires that the number of matrix columns must match len(Scales.value)
 
     FeatureListFilename = InputSlot(stype="str", optional=True)
+
+    # If provided, computed features are also stored in this directory, and re-used in later sessions.
+    # (Only for input data that was read from the filesystem.  See OpPersistentFeatureCache.)
+    PersistentCacheDirectory = InputSlot(stype="filestring", optional=True)
     
     # Features are presented in the channels of the output image
     # Output can be optionally accessed via an internal cache.
@@ -102,6 +108,7 @@ class OpFeatureSelectionNoCache(Operator):
     
     def __init__(self, filter_implementation, *args, **kwargs):
         super(OpFeatureSelectionNoCache, self).__init__(*args, **kwargs)
+        self._filter_implementation = filter_implementation
 
         # Create the operator that actually generates the features
         if filter_implementation == 'Original':
@@ -124,6 +131,8 @@ class OpFeatureSelectionNoCache(Operator):
         self.opPixelFeatures.Input.connect(self.opReorderIn.Output)
         self.opReorderOut = OpReorderAxes(parent=self)
         self.opReorderOut.Input.connect(self.opPixelFeatures.Output)
+        self.opPersistentCache = OpPersistentFeatureCache(parent=self)
+        self.opPersistentCache.Input.connect(self.opReorderOut.Output)
         self.opReorderLayers = OperatorWrapper(OpReorderAxes, parent=self,
                                                broadcastingSlotNames=["AxisOrder"])
         self.opReorderLayers.Input.connect(self.opPixelFeatures.Features)
@@ -191,9 +200,33 @@ class OpFeatureSelectionNoCache(Operator):
                 raise DatasetConstraintError( "Feature Selection", msg )
             
             # Connect our external outputs to our internal operators
-            self.OutputImage.connect( self.opReorderOut.Output )
+            cache_file_path = self.persistentCacheFilePath()
+            if cache_file_path is None:
+                self.opPersistentCache.CacheFilePath.disconnect()
+                self.OutputImage.connect( self.opReorderOut.Output )
+            else:
+                self.opPersistentCache.CacheFilePath.setValue( cache_file_path )
+                self.OutputImage.connect( self.opPersistentCache.Output )
             self.FeatureLayers.connect( self.opReorderLayers.Output )
 
+    def persistentCacheFilePath(self):
+        """
+        Return the file the persistent feature cache should use, or None if
+        the persistent cache is disabled or the input data can't be identified.
+        """
+        if not self.PersistentCacheDirectory.ready() or not self.PersistentCacheDirectory.value:
+            return None
+        if not all( slot.ready() for slot in (self.InputImage, self.Scales, self.FeatureIds, self.SelectionMatrix) ):
+            return None
+        key = featureCacheKey( self.InputImage.meta,
+                               self._filter_implementation,
+                               self.Scales.value,
+                               self.FeatureIds.value,
+                               self.SelectionMatrix.value )
+        if key is None:
+            return None
+        return os.path.join( self.PersistentCacheDirectory.value, key + '.h5' )
+
     def propagateDirty(self, slot, subindex, roi):
         # Output slots are directly connected to internal operators
         pass
@@ -0,0 +1,254 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+#Python
+import os
+import glob
+import time
+import hashlib
+import logging
+from functools import partial
+
+#SciPy
+import numpy
+import h5py
+
+#lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+from lazyflow.request import Request, RequestLock, RequestPool
+from lazyflow.utility import PathComponents
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the file layout or the meaning of the stored data changes.
+FORMAT_VERSION = 1
+
+def fileIdentity(filepath):
+    """
+    Return a list of (path, mtime, size) for every file the given dataset path refers to,
+    or None if any of them can't be found.
+    Handles hdf5 paths with an internal dataset path, and stacks given as globstrings
+    or as os.path.pathsep-separated file lists.
+    """
+    identity = []
+    for path in filepath.split(os.path.pathsep):
+        external_path = PathComponents(path).externalPath
+        filenames = sorted( glob.glob(external_path) )
+        if not filenames:
+            return None
+        for filename in filenames:
+            stat = os.stat(filename)
+            identity.append( (os.path.abspath(filename), stat.st_mtime, stat.st_size) )
+    return identity
+
+def featureCacheKey(input_meta, filter_implementation, scales, feature_ids, selection_matrix):
+    """
+    Compute the key under which the features for the given input image and
+    feature selection are stored.  Returns None if the input can't be identified
+    (e.g. it wasn't read from the filesystem).
+    """
+    filepath = input_meta.filepath
+    if not filepath:
+        return None
+    identity = fileIdentity( filepath )
+    if identity is None:
+        return None
+
+    key_items = ( FORMAT_VERSION,
+                  identity,
+                  filepath,
+                  input_meta.subvolume_roi,
+                  tuple(input_meta.shape),
+                  str(numpy.dtype(input_meta.dtype)),
+                  "".join( input_meta.getAxisKeys() ),
+                  filter_implementation,
+                  list(scales),
+                  list(feature_ids),
+                  numpy.asarray(selection_matrix).astype(bool).tolist() )
+    return hashlib.sha1( repr(key_items) ).hexdigest()
+
+def pruneFeatureCache(cache_dir, max_age_days):
+    """
+    Delete the cache files in cache_dir that have not been used for more than max_age_days.
+    Cache files are never reused once their key changed (e.g. after the input file or the
+    feature selection changed), so stale files would otherwise accumulate.
+    (OpPersistentFeatureCache touches its file whenever it opens it, so the modification time
+    tells when a file was last used.  Files of inputs that are only processed in batch mode
+    are kept as long as they are used regularly.)
+    Returns the list of deleted files.
+    """
+    oldest_mtime = time.time() - max_age_days * 24 * 60 * 60
+    removed = []
+    for filepath in glob.glob( os.path.join( cache_dir, '*.h5' ) ):
+        try:
+            if os.path.getmtime(filepath) >= oldest_mtime:
+                continue
+            os.remove(filepath)
+        except OSError as ex:
+            os.remove(filepath)
+        except OSError as ex:
+            logger.warn( "Could not remove stale feature cache file {}: {}".format( filepath, ex ) )
+        else:
+            removed.append(filepath)
+    if removed:
+        logger.info( "Removed {} stale feature cache file(s) from {}".format( len(removed), cache_dir ) )
+    return removed
+
+class OpPersistentFeatureCache(Operator):
+    """
+    Caches the feature image in an hdf5 file on disk.
+    The file is filled lazily, block by block, as the features are requested.
+    Blocks that were computed in an earlier session are read from the file.
+
+    The caller is responsible for choosing a file name that uniquely identifies
+    the input data and the feature selection (see featureCacheKey()).
+    """
+    Input = InputSlot()
+    CacheFilePath = InputSlot(stype='filestring')
+
+    Output = OutputSlot()
+
+    # Spatial block width, depending on the number of spatial axes
+    SPATIAL_BLOCK_WIDTH = { 1 : 4096, 2 : 256, 3 : 64 }
+
+    def __init__(self, *args, **kwargs):
+        super(OpPersistentFeatureCache, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._h5File = None
+        self._blockshape = None
+
+    def setupOutputs(self):
+        self._closeFile()
+        self.Output.meta.assignFrom(self.Input.meta)
+
+        tagged_shape = self.Input.meta.getTaggedShape()
+        num_spatial = len( filter( lambda k: k in 'xyz', tagged_shape.keys() ) )
+        width = self.SPATIAL_BLOCK_WIDTH[num_spatial]
+        blockshape = []
+        for k, size in tagged_shape.items():
+            if k == 't':
+                blockshape.append( 1 )
+            elif k == 'c':
+                blockshape.append( size )
+            else:
+                blockshape.append( min(size, width) )
+        self._blockshape = tuple(blockshape)
+        self.Output.meta.ideal_blockshape = self._blockshape
+
+        self._openFile( self.CacheFilePath.value )
+
+    def _openFile(self, filepath):
+        shape = tuple(self.Input.meta.shape)
+        dtype = numpy.dtype(self.Input.meta.dtype)
+        block_grid_shape = tuple( (numpy.array(shape) + self._blockshape - 1) // self._blockshape )
+
+        cache_dir = os.path.dirname( filepath )
+        if cache_dir and not os.path.exists( cache_dir ):
+            os.makedirs( cache_dir )
+
+        f = h5py.File( filepath, 'a' )
+        try:
+            if 'features' in f:
+                dset = f['features']
+                if dset.shape != shape or dset.dtype != dtype or f['completed_blocks'].shape != block_grid_shape:
+                    logger.warn( "Discarding incompatible persistent feature cache: {}".format( filepath ) )
+                    del f['features']
+                    del f['completed_blocks']
+            if 'features' not in f:
+                f.create_dataset( 'features', shape=shape, dtype=dtype, chunks=self._blockshape, compression='lzf' )
+                f.create_dataset( 'completed_blocks', data=numpy.zeros( block_grid_shape, dtype=numpy.uint8 ) )
+                f['features'].attrs['axistags'] = self.Input.meta.axistags.toJSON()
+        except:
+            f.close()
+            raise
+
+        # Mark the file as recently used (see pruneFeatureCache)
+        os.utime( filepath, None )
+
+        self._h5File = f
+        num_completed = numpy.count_nonzero( f['completed_blocks'][:] )
+        logger.debug( "Opened persistent feature cache {} ({} of {} blocks computed)"
+                      .format( filepath, num_completed, numpy.prod(block_grid_shape) ) )
+
+    def _closeFile(self):
+        with self._lock:
+            if self._h5File is not None:
+                self._h5File.close()
+                self._h5File = None
+
+    def cleanUp(self):
+        self._closeFile()
+        super(OpPersistentFeatureCache, self).cleanUp()
+
+    def execute(self, slot, subindex, roi, result):
+        shape = self.Input.meta.shape
+        request_roi = numpy.array( (roi.start, roi.stop) )
+        block_starts = map( tuple, getIntersectingBlocks( self._blockshape, request_roi ) )
+
+        def process_block(block_start):
+            block_roi = getBlockBounds( shape, self._blockshape, block_start )
+            block_index = tuple( numpy.array(block_start) // self._blockshape )
+            completed = False
+            with self._lock:
+                # (The file may have been closed in the meantime, e.g. if the input changed.)
+                if self._h5File is not None:
+                    completed = self._h5File['completed_blocks'][block_index]
+                    if completed:
+                        block_data = self._h5File['features'][roiToSlice(*block_roi)]
+
+            if not completed:
+                block_data = self.Input(*block_roi).wait()
+                with self._lock:
+                    if self._h5File is not None:
+                        self._h5File['features'][roiToSlice(*block_roi)] = block_data
+                        self._h5File['completed_blocks'][block_index] = 1
+
+            intersection = getIntersection( block_roi, request_roi )
+            block_relative = numpy.subtract( intersection, block_roi[0] )
+            result_relative = numpy.subtract( intersection, request_roi[0] )
+            result[roiToSlice(*result_relative)] = block_data[roiToSlice(*block_relative)]
+
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add( Request( partial(process_block, block_start) ) )
+        pool.wait()
+        pool.clean()
+
+        with self._lock:
+            if self._h5File is not None:
+                self._h5File.flush()
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            # Mark the affected blocks as incomplete, so they'll be recomputed.
+            dirty_roi = numpy.array( (roi.start, roi.stop) )
+            block_starts = getIntersectingBlocks( self._blockshape, dirty_roi )
+            with self._lock:
+                if self._h5File is not None:
+                    completed_blocks = self._h5File['completed_blocks']
+                    for block_start in block_starts:
+                        block_index = tuple( numpy.array(block_start) // self._blockshape )
+                        completed_blocks[block_index] = 0
+            self.Output.setDirty( roi.start, roi.stop )
+        else:
+            # CacheFilePath changed: setupOutputs() will be called.
+            self.Output.setDirty( slice(None) )
@@ -6,10 +6,10 @@ from functools import partial
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators.operators import OpSlicedBlockedArrayCache, OpUnblockedArrayCache
 from lazyflow.roi import enlargeRoiForHalo, roiToSlice
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 
 from ilastik.applets.featureSelection.opFeatureSelection import OpFeatureSelection
-from iiboost import computeEigenVectorsOfHessianImage, computeIntegralImage
+from iiboost import computeEigenVectorsOfHessianImage
 
 from ilastik.applets.base.applet import DatasetConstraintError
 
@@ -53,6 +53,7 @@ class OpIIBoostFeatureSelection(Operator):
     FeatureIds = InputSlot(value=FeatureIds)
     SelectionMatrix = InputSlot(value=default_feature_matrix)
     FeatureListFilename = InputSlot(stype="str", optional=True)
+    PersistentCacheDirectory = InputSlot(stype="filestring", optional=True)
 
     # This output is only for the GUI.  It's taken directly from OpFeatureSelection.
     # Unlike the OutputImage slot, it provides the raw features, NOT the integral images.
@@ -71,6 +72,7 @@ class OpIIBoostFeatureSelection(Operator):
         self.opFeatureSelection.FeatureIds.connect( self.FeatureIds )
         self.opFeatureSelection.SelectionMatrix.connect( self.SelectionMatrix )
         self.opFeatureSelection.FeatureListFilename.connect( self.FeatureListFilename )        
+        self.opFeatureSelection.PersistentCacheDirectory.connect( self.PersistentCacheDirectory )
         self.FeatureLayers.connect( self.opFeatureSelection.FeatureLayers )
 
         self.WINDOW_SIZE = self.opFeatureSelection.WINDOW_SIZE
@@ -82,8 +84,8 @@ class OpIIBoostFeatureSelection(Operator):
         self.opIntegralImage_from_cache = OpIntegralImage( parent=self )
         self.opIntegralImage_from_cache.Input.connect( self.opFeatureSelection.CachedOutputImage )
 
-        # We use an UNBLOCKED cache to store integral features, because a blocked cache would service 
-        #  requests by concatenating neighboring blocks.  That is not a valid operation for integral images. 
+        # We use an UNBLOCKED cache to store integral features.
+        # (OpIntegralImage computes blockwise internally, and serves any roi of the full-volume integral image.)
         self.opIntegralImageCache = OpUnblockedArrayCache( parent=self )
         self.opIntegralImageCache.Input.connect( self.opIntegralImage_from_cache.Output )
                 
@@ -154,6 +156,9 @@ class OpIIBoostFeatureSelection(Operator):
         # Copy the cache block settings from the standard pixel feature operator.
         self.opHessianEigenvectorCache.BlockShape.setValue( self.opFeatureSelection.opPixelFeatureCache.BlockShape.value )
 
+    def persistentCacheFilePath(self):
+        return self.opFeatureSelection.persistentCacheFilePath()
+
     def propagateDirty(self, slot, subindex, roi):
         # All channels are dirty
         num_channels = self.OutputImage.meta.shape[-1]
@@ -365,13 +370,29 @@ class OpIntegralImage(Operator):
         np.add.accumulate(output, axis=i, out=output)
 
     (That is, simply integrate over all axes of the volume.)
-    
-    But here, we use iiboost.computeIntegralImage() because 
-      it seems to be faster than the above numpy code.
+
+    The output is always the integral image of the *whole* volume, but it is computed blockwise:
+    Each block is integrated locally, starting from the boundary planes ("faces") of its
+    predecessors along each axis, which carry the prefix sums of everything before the block.
+    The faces are computed by a scan over the blocks (in parallel along anti-diagonals of the
+    block grid), and only for the blocks up to the requested roi.  After that, any roi is
+    computed from its own blocks and their incoming faces.
+
+    Since every element is accumulated in exactly the same order as in the full-volume
+    computation above, the results are bit-identical to it.
     """ 
     Input = InputSlot()
     Output = OutputSlot()
 
+    # Spatial shape of the blocks (clipped to the volume)
+    BLOCK_SHAPE = (128, 128, 128)
+
+    def __init__(self, *args, **kwargs):
+        super( OpIntegralImage, self ).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._faces = {} # block index -> (face after axis 0, face after axis 1, face after axis 2)
+        self._blockshape = None
+
     def setupOutputs(self):
         assert len(self.Input.meta.shape) == 4, "Data must be exactly 3D+c (no time axis)"
         assert self.Input.meta.getAxisKeys()[-1] == 'c'
@@ -382,27 +403,107 @@ class OpIntegralImage(Operator):
         if self.Input.meta.channel_names:
             self.Output.meta.channel_names = ["Integrated " + name for name in self.Input.meta.channel_names]
 
-    def execute(self, slot, subindex, roi, result):
+        with self._lock:
+            self._blockshape = numpy.minimum( self.BLOCK_SHAPE, self.Input.meta.shape[:-1] )
+            self._faces = {}
 
-        def compute_for_channel(output_channel, input_channel):
-            input_roi = numpy.array( (roi.start, roi.stop) )
-            input_roi[:,-1] = (input_channel, input_channel+1)
-            input_req = self.Input(*input_roi)
+    def _blockRoi(self, block_index):
+        spatial_shape = self.Input.meta.shape[:-1]
+        start = numpy.array(block_index) * self._blockshape
+        stop = numpy.minimum( start + self._blockshape, spatial_shape )
+        return start, stop
 
-            # If possible, use the result array itself as a scratch area
-            if self.Input.meta.dtype == result.dtype:
-                input_req.writeInto( result[...,output_channel:output_channel+1] )        
+    def _integrateBlock(self, block_index, faces):
+        """
+        Read the given block (all channels) and integrate it, starting from the faces of its predecessors.
+        Returns the integrated block and its own outgoing faces.
+        """
+        start, stop = self._blockRoi( block_index )
+        data = self.Input( tuple(start) + (0,), tuple(stop) + (self.Input.meta.shape[-1],) ).wait()
+        data = data.view(numpy.ndarray).astype( numpy.float32, order='C' )
+
+        outgoing = []
+        for axis in range(3):
+            if block_index[axis] > 0:
+                predecessor = list(block_index)
+                predecessor[axis] -= 1
+                first = [slice(None)] * 4
+                first[axis] = slice(0, 1)
+                data[tuple(first)] += faces[tuple(predecessor)][axis]
+            numpy.add.accumulate( data, axis=axis, out=data )
+            last = [slice(None)] * 4
+            last[axis] = slice(-1, None)
+            outgoing.append( data[tuple(last)].copy() )
+        return data, tuple(outgoing)
+
+    def _ensureFaces(self, max_index, keep):
+        """
+        Compute the faces of all blocks up to (and including) max_index, unless they are known already.
+        Returns the integrated data of the blocks in `keep` (as far as they had to be computed),
+        and a snapshot of all faces.
+        """
+        kept = {}
+        with self._lock:
+            missing = [ index for index in numpy.ndindex( *(numpy.array(max_index) + 1) )
+                        if index not in self._faces ]
+            if not missing:
+                return kept, dict(self._faces)
+
+            # Blocks on the same anti-diagonal don't depend on each other.
+            diagonals = {}
+            for index in missing:
+                diagonals.setdefault( sum(index), [] ).append( index )
+
+            def process_block(index):
+                data, outgoing = self._integrateBlock( index, self._faces )
+                self._faces[index] = outgoing
+                if index in keep:
+                    kept[index] = data
+
+            for d in sorted(diagonals.keys()):
+                pool = RequestPool()
+                for index in diagonals[d]:
+                    pool.add( Request( partial( process_block, index ) ) )
+                pool.wait()
+                pool.clean()
+            return kept, dict(self._faces)
 
-            input_data = input_req.wait()
-            input_data = input_data.astype(numpy.float32, order='C', copy=False)
-            input_data = input_data[...,0] # drop channel axis
-            result[..., output_channel] = computeIntegralImage(input_data)
+    def execute(self, slot, subindex, roi, result):
+        spatial_start = numpy.array( roi.start[:-1] )
+        spatial_stop = numpy.array( roi.stop[:-1] )
+        first_block = spatial_start // self._blockshape
+        last_block = (spatial_stop - 1) // self._blockshape
+        roi_blocks = set( tuple(first_block + offset)
+                          for offset in numpy.ndindex( *(last_block - first_block + 1) ) )
+
+        kept, faces = self._ensureFaces( tuple(last_block), roi_blocks )
+
+        def process_block(index):
+            if index in kept:
+                data = kept[index]
+            else:
+                data, _ = self._integrateBlock( index, faces )
+            block_start, block_stop = self._blockRoi( index )
+            inter_start = numpy.maximum( block_start, spatial_start )
+            inter_stop = numpy.minimum( block_stop, spatial_stop )
+            block_slicing = roiToSlice( inter_start - block_start, inter_stop - block_start )
+            result_slicing = roiToSlice( inter_start - spatial_start, inter_stop - spatial_start )
+            result[result_slicing] = data[block_slicing][..., roi.start[-1]:roi.stop[-1]]
 
         pool = RequestPool()
-        for output_channel, input_channel in enumerate(range(roi.start[-1], roi.stop[-1])):
-            pool.add( Request( partial( compute_for_channel, output_channel, input_channel ) ) )
+        for index in roi_blocks:
+            pool.add( Request( partial( process_block, index ) ) )
         pool.wait()
+        pool.clean()
+        return result
     
     def propagateDirty(self, slot, subindex, roi):
-        self.Output.setDirty(roi.start, roi.stop)
-
+        # Everything "after" the dirty region (along all axes) depends on it.
+        if self._blockshape is not None:
+            first_block = numpy.array( roi.start[:-1] ) // self._blockshape
+            with self._lock:
+                for index in self._faces.keys():
+                    if (numpy.array(index) >= first_block).all():
+                        del self._faces[index]
+        dirty_stop = tuple(self.Output.meta.shape[:-1]) + (roi.stop[-1],)
+        self.Output.setDirty( roi.start, dirty_stop )
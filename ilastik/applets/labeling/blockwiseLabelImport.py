@@ -0,0 +1,159 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Blockwise import of label images (without GUI, so it can also be used headlessly).
+
+The source is read in blocks, in parallel.  The label histogram is accumulated
+blockwise, so it works for data of any size, and the labels are mapped and written
+into the label array block by block, skipping blocks without any labels.
+"""
+import threading
+import logging
+from functools import partial
+
+import numpy
+
+from lazyflow.roi import determineBlockShape, roiToSlice
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+# Number of voxels per block that is read from the source
+DEFAULT_BLOCK_VOLUME = 2**24
+
+# Label values below this are counted with numpy.bincount, larger ones by sorting.
+DENSE_HISTOGRAM_LIMIT = 2**24
+
+class LabelImportCancelled(Exception):
+    pass
+
+def block_rois(shape, blockshape):
+    """
+    Return the list of (start, stop) rois of the blocks that tile an array of the given shape.
+    """
+    shape = numpy.array(shape)
+    blockshape = numpy.minimum(blockshape, shape)
+    num_blocks = (shape + blockshape - 1) // blockshape
+    rois = []
+    for index in numpy.ndindex( *num_blocks ):
+        start = numpy.array(index) * blockshape
+        rois.append( (start, numpy.minimum(start + blockshape, shape)) )
+    return rois
+
+def _process_blocks(slot, process_block, blockshape, progress_callback, cancel_event):
+    """
+    Request the blocks of the given slot in parallel (a batch at a time) and call process_block(roi, data) for each.
+    Reports progress (0-100) after every batch, and checks for cancellation before every batch.
+    """
+    if blockshape is None:
+        blockshape = determineBlockShape( slot.meta.shape, DEFAULT_BLOCK_VOLUME )
+    rois = block_rois( slot.meta.shape, blockshape )
+
+    def process(roi):
+        process_block( roi, slot(*roi).wait() )
+
+    batch_size = max( 1, Request.global_thread_pool.num_workers )
+    for batch_start in range(0, len(rois), batch_size):
+        if cancel_event is not None and cancel_event.is_set():
+            raise LabelImportCancelled()
+        pool = RequestPool()
+        for roi in rois[batch_start:batch_start+batch_size]:
+            pool.add( Request( partial(process, roi) ) )
+        pool.wait()
+        pool.clean()
+        if progress_callback is not None:
+            progress_callback( 100 * min(batch_start + batch_size, len(rois)) // len(rois) )
+
+def label_histogram(slot, blockshape=None, progress_callback=None, cancel_event=None):
+    """
+    Count the pixels of each value in the given (label) image.
+    Returns (labels, counts) for all values that occur, with labels sorted.
+
+    :param progress_callback: called with the progress in percent
+    :param cancel_event: a threading.Event; if it is set, LabelImportCancelled is raised
+    """
+    lock = threading.Lock()
+    dense_counts = [numpy.zeros((0,), dtype=numpy.int64)]
+    sparse_counts = {}
+
+    def count_block(roi, data):
+        data = numpy.asarray(data).ravel()
+        if len(data) == 0:
+            return
+        if data.dtype.kind in 'iub' and data.min() >= 0 and data.max() < DENSE_HISTOGRAM_LIMIT:
+            block_counts = numpy.bincount( data.astype(numpy.intp, copy=False) )
+            with lock:
+                counts = dense_counts[0]
+                if len(counts) < len(block_counts):
+                    counts = numpy.concatenate( (counts, numpy.zeros(len(block_counts) - len(counts), dtype=numpy.int64)) )
+                counts[:len(block_counts)] += block_counts
+                dense_counts[0] = counts
+        else:
+            data = numpy.sort(data)
+            starts = numpy.concatenate( ([0], numpy.flatnonzero(data[1:] != data[:-1]) + 1) )
+            block_counts = numpy.diff( numpy.append(starts, len(data)) )
+            with lock:
+                for value, count in zip(data[starts].tolist(), block_counts):
+                    sparse_counts[value] = sparse_counts.get(value, 0) + count
+
+    _process_blocks( slot, count_block, blockshape, progress_callback, cancel_event )
+
+    counts = dense_counts[0]
+    for value in numpy.flatnonzero(counts).tolist():
+        sparse_counts[value] = sparse_counts.get(value, 0) + counts[value]
+    labels = numpy.array( sorted(sparse_counts.keys()), dtype=slot.meta.dtype )
+    return labels, numpy.array( [sparse_counts[l] for l in labels], dtype=numpy.int64 )
+
+def import_labels(slot, label_slot, offsets=None, read_labels=None, new_labels=None,
+                  blockshape=None, progress_callback=None, cancel_event=None):
+    """
+    Write the labels of the given image into label_slot (e.g. the LabelInput of a labeling operator),
+    block by block.  Blocks without labels are skipped (zeros don't change the label array).
+
+    :param slot: the image to import; its axes must be ordered like those of label_slot
+    :param offsets: where to insert the image into the label array (default: the origin)
+    :param read_labels: the (sorted) values that occur in the image (e.g. from label_histogram())
+    :param new_labels: the label each of read_labels is mapped to (default: no mapping)
+    :returns: the number of blocks that were written
+    """
+    if offsets is None:
+        offsets = [0] * len(slot.meta.shape)
+    if new_labels is not None:
+        read_labels = numpy.asarray(read_labels)
+        new_labels = numpy.asarray(new_labels)
+        assert len(read_labels) == len(new_labels)
+
+    write_lock = threading.Lock()
+    num_written = [0]
+
+    def write_block(roi, data):
+        if new_labels is not None:
+            data = new_labels[ numpy.searchsorted(read_labels, data) ]
+        if not data.any():
+            return
+        start, stop = numpy.add( roi, offsets )
+        with write_lock:
+            label_slot[roiToSlice(start, stop)] = data.astype( label_slot.meta.dtype, copy=False )
+            num_written[0] += 1
+
+    _process_blocks( slot, write_block, blockshape, progress_callback, cancel_event )
+    logger.debug( "Imported labels: {} blocks written".format( num_written[0] ) )
+    return num_written[0]
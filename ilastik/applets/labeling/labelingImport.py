@@ -22,16 +22,17 @@
 #Python
 import collections
 import os
+import threading
+from functools import partial
 import numpy
 import vigra
 
 import logging
-from lazyflow.operators import opArrayCache
 logger = logging.getLogger(__name__)
 
 #Qt
 from PyQt4 import uic
-from PyQt4.QtCore import Qt, QEvent
+from PyQt4.QtCore import Qt, QEvent, QObject, pyqtSignal
 from PyQt4.QtGui import QDialog, QDialogButtonBox, QMessageBox, QCheckBox, QSpinBox, QLabel, QValidator, QProgressDialog, QApplication, QCloseEvent
 
 # volumina
@@ -39,15 +40,15 @@ from volumina.utility import PreferencesManager
 
 #lazyflow
 import lazyflow
-from lazyflow.utility import chunked_bincount
-from lazyflow.roi import TinyVector, roiToSlice, roiFromShape
+from lazyflow.request import Request
+from lazyflow.roi import TinyVector
 from lazyflow.operators.ioOperators import OpInputDataReader
 from lazyflow.operators.opReorderAxes import OpReorderAxes
-from lazyflow.operators.opBlockedArrayCache import OpBlockedArrayCache
 from lazyflow.operators.valueProviders import OpMetadataInjector
 
 # ilastik
 from ilastik.applets.dataSelection.dataSelectionGui import DataSelectionGui
+from blockwiseLabelImport import label_histogram, import_labels, LabelImportCancelled
 
 def import_labeling_layer(labelLayer, labelingSlots, parent_widget=None):
     """
@@ -85,70 +86,30 @@ def import_labeling_layer(labelLayer, labelingSlots, parent_widget=None):
     try:
         # Initialize operators
         opImport = OpInputDataReader( parent=opLabels.parent )
-        opCache = OpBlockedArrayCache( parent=opLabels.parent )
         opMetadataInjector = OpMetadataInjector( parent=opLabels.parent )
         opReorderAxes = OpReorderAxes( parent=opLabels.parent )
     
         # Set up the pipeline as follows:
         #
-        #   opImport --> (opCache) --> opMetadataInjector --------> opReorderAxes --(inject via setInSlot)--> labelInput
-        #                             /                            /
+        #   opImport --> opMetadataInjector --------> opReorderAxes --(inject blockwise via setInSlot)--> labelInput
+        #               /                            /
         #     User-specified axisorder    labelInput.meta.axistags
     
         opImport.WorkingDirectory.setValue(defaultDirectory)
         opImport.FilePath.setValue(fileNames[0] if len(fileNames) == 1 else
                                    os.path.pathsep.join(fileNames))
         assert opImport.Output.ready()
+        reading_slot = opImport.Output
 
         maxLabels = len(labelingSlots.labelNames.value)
-    
-        # We don't bother with counting the label pixels
-        # (and caching the data) if it's big (1 GB)
-        if numpy.prod(opImport.Output.meta.shape) > 1e9:
-            reading_slot = opImport.Output
-            
-            # For huge data, we don't go through and search for the pixel values,
-            # because that takes an annoyingly long amount of time.
-            # Instead, we make the reasonable assumption that the input labels are already 1,2,3..N
-            # and we don't tell the user what the label pixel counts are.
-            unique_read_labels = numpy.array(range(maxLabels+1))
-            readLabelCounts = numpy.array([-1]*(maxLabels+1))
-            labelInfo = (maxLabels, (unique_read_labels, readLabelCounts))
-        else:    
-            opCache.Input.connect( opImport.Output )
-            opCache.CompressionEnabled.setValue(True)
-            assert opCache.Output.ready()
-            reading_slot = opCache.Output
-
-            # We'll show a little window with a busy indicator while the data is loading
-            busy_dlg = QProgressDialog(parent=parent_widget)
-            busy_dlg.setLabelText("Scanning Label Data...")
-            busy_dlg.setCancelButton(None)
-            busy_dlg.setMinimum(100)
-            busy_dlg.setMaximum(100)
-            def close_busy_dlg(*args):
-                QApplication.postEvent(busy_dlg, QCloseEvent())
-        
-            # Load the data from file into our cache
-            # When it's done loading, close the progress dialog.
-            req = reading_slot[:]
-            req.notify_finished( close_busy_dlg )
-            req.notify_failed( close_busy_dlg )
-            req.submit()
-            busy_dlg.exec_()
-    
-            readData = req.result
 
-            # Can't use return_counts feature because that requires numpy >= 1.9
-            #unique_read_labels, readLabelCounts = numpy.unique(readData, return_counts=True)
-    
-            # This does the same as the above, albeit slower, and probably with more ram.
-            bincounts = chunked_bincount(readData)
-            unique_read_labels = bincounts.nonzero()[0].astype(readData.dtype, copy=False)
-            readLabelCounts = bincounts[unique_read_labels]
-    
-            labelInfo = (maxLabels, (unique_read_labels, readLabelCounts))
-            del readData
+        # Count the label pixels, block by block (and in parallel)
+        histogram = _run_with_progress( parent_widget, "Scanning Label Data...",
+                                        partial(label_histogram, reading_slot) )
+        if histogram is None:
+            return
+        unique_read_labels, readLabelCounts = histogram
+        labelInfo = (maxLabels, (unique_read_labels, readLabelCounts))
     
         opMetadataInjector.Input.connect( reading_slot )
         metadata = reading_slot.meta.copy()
@@ -197,29 +158,60 @@ def import_labeling_layer(labelLayer, labelingSlots, parent_widget=None):
         if labelMapping.keys() == labelMapping.values():
             labelMapping = None
 
-        # If the data was already cached, this will be fast.
-        label_data = opReorderAxes.Output[:].wait()
-        
-        # Map input labels to output labels
+        # Map input labels to output labels (via searchsorted, which supports potentially
+        # huge values of unique_read_labels without needing GB of RAM)
+        new_labels = None
         if labelMapping:
-            # There are other ways to do a relabeling (e.g skimage.segmentation.relabel_sequential)
-            # But this supports potentially huge values of unique_read_labels (in the billions),
-            # without needing GB of RAM.
-            mapping_indexes = numpy.searchsorted(unique_read_labels, label_data)
             new_labels = numpy.array([labelMapping[x] for x in unique_read_labels])
-            label_data[:] = new_labels[mapping_indexes]
 
-        label_roi = numpy.array( roiFromShape(opReorderAxes.Output.meta.shape) )
-        label_roi += imageOffsets
-        label_slice = roiToSlice(*label_roi)
-        writeSeeds[label_slice] = label_data
+        # Read, map and write the labels block by block.
+        # (Canceling leaves the blocks that were already written in place.)
+        _run_with_progress( parent_widget, "Importing Labels...",
+                            partial( import_labels, opReorderAxes.Output, writeSeeds, imageOffsets,
+                                     unique_read_labels, new_labels ) )
 
     finally:
         opReorderAxes.cleanUp()
         opMetadataInjector.cleanUp()
-        opCache.cleanUp()
         opImport.cleanUp()
 
+class _ProgressRelay(QObject):
+    """
+    Forwards progress from worker threads to the GUI thread (via queued signal connections).
+    """
+    progress = pyqtSignal(int)
+    finished = pyqtSignal()
+
+def _run_with_progress(parent_widget, label_text, func):
+    """
+    Run func(progress_callback=..., cancel_event=...) in a request, while showing a progress dialog
+    with a cancel button.  Returns the result of func, or None if the user canceled.
+    """
+    cancel_event = threading.Event()
+    relay = _ProgressRelay()
+
+    progress_dlg = QProgressDialog(parent=parent_widget)
+    progress_dlg.setLabelText(label_text)
+    progress_dlg.setMinimum(0)
+    progress_dlg.setMaximum(100)
+    progress_dlg.setAutoClose(False)
+    progress_dlg.setAutoReset(False)
+    progress_dlg.canceled.connect( cancel_event.set )
+    relay.progress.connect( progress_dlg.setValue )
+    relay.finished.connect( progress_dlg.close )
+
+    req = Request( partial(func, progress_callback=relay.progress.emit, cancel_event=cancel_event) )
+    req.notify_finished( lambda *args: relay.finished.emit() )
+    req.notify_failed( lambda *args: relay.finished.emit() )
+    req.submit()
+    progress_dlg.exec_()
+
+    try:
+        return req.wait()
+    except LabelImportCancelled:
+        logger.info( "{} canceled by the user".format( label_text.rstrip('.') ) )
+        return None
+
 
 #**************************************************************************
 # LabelImportOptionsDlg
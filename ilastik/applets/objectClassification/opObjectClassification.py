@@ -24,7 +24,6 @@ import numpy.lib.recfunctions as rfn
 import vigra
 import time
 import warnings
-import itertools
 from collections import defaultdict, OrderedDict
 from functools import partial
 
@@ -36,7 +35,7 @@ from lazyflow.request import Request, RequestPool, RequestLock
 
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory, ParallelVigraRfLazyflowClassifier
 
-from ilastik.utility import OperatorSubView, MultiLaneOperatorABC, OpMultiLaneWrapper
+from ilastik.utility import OperatorSubView, MultiLaneOperatorABC, OpMultiLaneWrapper, CacheRegistry
 from ilastik.utility.exportingOperator import ExportingOperator
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
@@ -493,97 +492,74 @@ class OpObjectClassification(Operator, ExportingOperator, MultiLaneOperatorABC):
 
     @staticmethod
     def transferLabels(old_labels, old_bboxes, new_bboxes, axistags = None):
-        #transfer labels from old segmentation to new segmentation
+        """
+        Transfer labels from old segmentation to new segmentation, by matching
+        the bounding boxes of the labeled old objects with those of the new objects.
+        Each labeled old object passes its label to the new object it overlaps most.
+        New objects which receive more than one label stay unlabeled (a "conflict").
 
-        mins_old = old_bboxes["Coord<Minimum>"]
-        maxs_old = old_bboxes["Coord<Maximum>"]
-        mins_new = new_bboxes["Coord<Minimum>"]
-        maxs_new = new_bboxes["Coord<Maximum>"]
-        nobj_old = mins_old.shape[0]
+        Returns (new_labels, old_labels_lost, new_labels_lost), where the lost
+        objects are reported by the centers of their bounding boxes.
+        """
+        mins_old = numpy.asarray(old_bboxes["Coord<Minimum>"])
+        maxs_old = numpy.asarray(old_bboxes["Coord<Maximum>"])
+        mins_new = numpy.asarray(new_bboxes["Coord<Minimum>"])
+        maxs_new = numpy.asarray(new_bboxes["Coord<Maximum>"])
         nobj_new = mins_new.shape[0]
         if axistags is None:
             axistags = "xyz"
-        
-        data2D = False
-        if mins_old.shape[1]==2:
-            data2D = True
-        class bbox():
-            def __init__(self, minmaxs, axistags):
-                self.xmin = minmaxs[0][axistags.index('x')]
-                self.ymin = minmaxs[0][axistags.index('y')]
-                if not data2D:
-                    self.zmin = minmaxs[0][axistags.index('z')]
-                else:
-                    self.zmin = 0
-                self.xmax = minmaxs[1][axistags.index('x')]
-                self.ymax = minmaxs[1][axistags.index('y')]
-                if not data2D:
-                    self.zmax = minmaxs[1][axistags.index('z')]
-                else:
-                    self.zmax = 0
-                self.rad_x = 0.5*(self.xmax - self.xmin)
-                self.cent_x = self.xmin+self.rad_x
-                self.rad_y = 0.5*(self.ymax-self.ymin)
-                self.cent_y = self.ymin+self.rad_y
-                self.rad_z = 0.5*(self.zmax-self.zmin)
-                self.cent_z = self.zmin+self.rad_z
-
-            @staticmethod
-            def overlap(bbox_tuple):
-                this = bbox_tuple[0]
-                that = bbox_tuple[1]
-                over_x = this.rad_x+that.rad_x - (abs(this.cent_x-that.cent_x))
-                over_y = this.rad_y+that.rad_y - (abs(this.cent_y-that.cent_y))
-                over_z = this.rad_z+that.rad_z - (abs(this.cent_z-that.cent_z))
-                if not data2D:
-                    if over_x>0 and over_y>0 and over_z>0:
-                        return over_x*over_y*over_z
-                else:
-                    if over_x>0 and over_y>0:
-                        return over_x*over_y
-                return 0
+
+        data2D = (mins_old.shape[1] == 2)
+        axes = [axistags.index(k) for k in ('xy' if data2D else 'xyz')]
+
+        def centers_and_radii(mins, maxs):
+            mins = mins[:, axes].astype(numpy.float64)
+            maxs = maxs[:, axes].astype(numpy.float64)
+            radii = 0.5*(maxs - mins)
+            return mins + radii, radii
+
+        def center_tuple(centers, i):
+            if data2D:
+                return (centers[i, 0], centers[i, 1], 0)
+            return tuple(centers[i])
 
         nonzeros = numpy.nonzero(old_labels)[0]
-        bboxes_old = [bbox(x, axistags) for x in zip(mins_old[nonzeros], maxs_old[nonzeros])]
-        bboxes_new = [bbox(x, axistags) for x in zip(mins_new, maxs_new)]
+        cent_old, rad_old = centers_and_radii(mins_old[nonzeros], maxs_old[nonzeros])
 
         #remove background
         #FIXME: assuming background is 0 again
-        bboxes_new = bboxes_new[1:]
+        cent_new, rad_new = centers_and_radii(mins_new[1:], maxs_new[1:])
 
-        double_for_loop = itertools.product(bboxes_old, bboxes_new)
-        overlaps = map(bbox.overlap, double_for_loop)
+        old_index, new_index, overlaps = overlapping_bboxes(cent_old, rad_old, cent_new, rad_new)
 
-        overlaps = numpy.asarray(overlaps)
-        overlaps = overlaps.reshape((len(bboxes_old), len(bboxes_new)))
         new_labels = numpy.zeros((nobj_new,), dtype=numpy.uint32)
         old_labels_lost = dict()
         old_labels_lost["full"]=[]
         old_labels_lost["partial"]=[]
         new_labels_lost = dict()
         new_labels_lost["conflict"]=[]
-        for iobj in range(overlaps.shape[0]):
-            #take the object with maximum overlap
-            overlapsum = numpy.sum(overlaps[iobj, :])
-            if overlapsum==0:
-                old_labels_lost["full"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-                continue
-            newindex = numpy.argmax(overlaps[iobj, :])
-            if overlapsum-overlaps[iobj,newindex]>0:
-                #this object overlaps with more than one new object
-                old_labels_lost["partial"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-
-            overlaps[iobj, :] = 0
-            overlaps[iobj, newindex] = 1 #doesn't matter what number>0
-
-        for iobj in range(overlaps.shape[1]):
-            labels = numpy.where(overlaps[:, iobj]>0)[0]
-            if labels.shape[0]==1:
-                new_labels[iobj+1]=old_labels[nonzeros[labels[0]]] #iobj+1 because of the background
-            elif labels.shape[0]>1:
-                new_labels_lost["conflict"].append((bboxes_new[iobj].cent_x, bboxes_new[iobj].cent_y, bboxes_new[iobj].cent_z))
-
-        new_labels = new_labels
+
+        # For every old object, take the new object with maximum overlap (the first one, if tied).
+        num_overlapping = numpy.bincount(old_index, minlength=len(nonzeros))
+        order = numpy.lexsort((new_index, -overlaps, old_index))
+        old_index = old_index[order]
+        new_index = new_index[order]
+        is_best = numpy.ones(len(order), dtype=bool)
+        is_best[1:] = old_index[1:] != old_index[:-1]
+        best_old, best_new = old_index[is_best], new_index[is_best]
+
+        for iobj in numpy.flatnonzero(num_overlapping == 0):
+            old_labels_lost["full"].append(center_tuple(cent_old, iobj))
+        for iobj in numpy.flatnonzero(num_overlapping > 1):
+            #this object overlaps with more than one new object
+            old_labels_lost["partial"].append(center_tuple(cent_old, iobj))
+
+        num_assigned = numpy.bincount(best_new, minlength=len(cent_new))
+        unique = (num_assigned[best_new] == 1)
+        new_labels[best_new[unique]+1] = old_labels[nonzeros[best_old[unique]]] #+1 because of the background
+        for iobj in numpy.flatnonzero(num_assigned > 1):
+            new_labels_lost["conflict"].append(center_tuple(cent_new, iobj))
+
         new_labels[0]=0 #FIXME: hardcoded background value again
         return new_labels, old_labels_lost, new_labels_lost
 
@@ -657,10 +633,11 @@ class OpObjectClassification(Operator, ExportingOperator, MultiLaneOperatorABC):
             json_data_this_lane = json_data_all_lanes[lane_index_str]
             
             new_labels_this_lane = {}
+            # Request the features of all labeled time slices at once
+            times = sorted(map(int, json_data_this_lane.keys()))
+            old_features_timewise = self.ObjectFeatures[lane_index](times).wait()
             for time_str in sorted(json_data_this_lane.keys(), key=int):
                 time = int(time_str)
-                
-                old_features_timewise = self.ObjectFeatures[lane_index]([time]).wait()
                 old_features = old_features_timewise[time]
                 
                 current_bboxes = {}
@@ -814,6 +791,51 @@ class OpObjectClassification(Operator, ExportingOperator, MultiLaneOperatorABC):
         export_file.InsertionProgress.unsubscribe(progress_slot)
 
 
+def overlapping_bboxes(cent_a, rad_a, cent_b, rad_b):
+    """
+    Find all pairs of overlapping bounding boxes between two sets of boxes, which
+    are given by their centers and radii (arrays of shape (N, ndim)).
+
+    Returns (index_a, index_b, overlaps), where overlaps is the volume of the
+    overlap (computed from the sum of the radii minus the distance of the centers).
+
+    The boxes of b are swept along the first axis: they are sorted by their lower bound,
+    so the candidates for each box of a are found with a binary search.  Boxes of b that
+    are much wider than the others would make the sweep window large, so they are tested
+    against all boxes of a directly.
+    """
+    empty = (numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,)))
+    if len(cent_a) == 0 or len(cent_b) == 0:
+        return empty
+
+    lower_b = cent_b[:, 0] - rad_b[:, 0]
+    width_b = 2*rad_b[:, 0]
+    is_large = width_b > 4*max(numpy.median(width_b), 1.0)
+    small, large = numpy.flatnonzero(~is_large), numpy.flatnonzero(is_large)
+
+    # Sweep: candidates have lower_b < upper_a and lower_b > lower_a - max_width
+    sorted_small = small[numpy.argsort(lower_b[small], kind='mergesort')]
+    sorted_lower = lower_b[sorted_small]
+    max_width = width_b[small].max() if len(small) else 0
+    lower_a = cent_a[:, 0] - rad_a[:, 0]
+    upper_a = cent_a[:, 0] + rad_a[:, 0]
+    begin = numpy.searchsorted(sorted_lower, lower_a - max_width, side='left')
+    end = numpy.searchsorted(sorted_lower, upper_a, side='left')
+    counts = numpy.maximum(end - begin, 0)
+    index_a = numpy.repeat(numpy.arange(len(cent_a)), counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    index_b = sorted_small[numpy.repeat(begin, counts) + offsets]
+
+    # Large boxes: test all pairs
+    index_a = numpy.concatenate((index_a, numpy.repeat(numpy.arange(len(cent_a)), len(large))))
+    index_b = numpy.concatenate((index_b, numpy.tile(large, len(cent_a))))
+
+    over = rad_a[index_a] + rad_b[index_b] - numpy.abs(cent_a[index_a] - cent_b[index_b])
+    keep = (over > 0).all(axis=1)
+    order = numpy.lexsort((index_b[keep], index_a[keep]))
+    return index_a[keep][order], index_b[keep][order], over[keep].prod(axis=1)[order]
+
+
 def _atleast_nd(a, ndim):
     """Like numpy.atleast_1d and friends, but supports arbitrary ndim,
     always puts extra dimensions last, and resizes.
@@ -899,7 +921,13 @@ def replace_missing(a):
 
 
 class OpObjectTrain(Operator):
-    """Trains a random forest on all labeled objects."""
+    """Trains a random forest on all labeled objects.
+
+    The feature vectors of the labeled objects are cached, keyed by
+    (lane, time, object id), so that a label change only requests the
+    features of the time slices that contain newly labeled objects.
+    The cache of a lane is cleared when its features change.
+    """
 
     name = "TrainRandomForestObjects"
     description = "Train a random forest on multiple images"
@@ -920,6 +948,13 @@ class OpObjectTrain(Operator):
         self._tree_count = 100
         self.FixClassifier.setValue(False)        
 
+        # {lane_index: {(t, obj): (feature_vector, bad_col_names)}}
+        self._labeled_features = defaultdict(dict)
+        # {lane_index: col_names}
+        self._labeled_features_cols = {}
+        self._num_lanes = 0
+        self._cache_lock = RequestLock()
+
     def setupOutputs(self):
         if self.FixClassifier.value == False:
             self.Classifier.meta.dtype = object
@@ -930,6 +965,42 @@ class OpObjectTrain(Operator):
         self.BadObjects.meta.dtype = object
         self.BadObjects.meta.axistags = None
 
+        if len(self.Labels) != self._num_lanes:
+            # lanes were added or removed, so the lane indexes may have changed
+            self._clearFeatureCache()
+            self._num_lanes = len(self.Labels)
+
+    def _clearFeatureCache(self, lane_index=None):
+        with self._cache_lock:
+            if lane_index is None:
+                self._labeled_features.clear()
+                self._labeled_features_cols.clear()
+            else:
+                self._labeled_features.pop(lane_index, None)
+                self._labeled_features_cols.pop(lane_index, None)
+
+    def _cacheFeatures(self, lane_index, timesteps, labels_image, selected):
+        """Request the features of the given time slices and add the
+        feature vectors of their labeled objects to the cache."""
+        feats = self.Features[lane_index](timesteps).wait()
+        labels_filtered = dict((t, labels_image[t]) for t in timesteps)
+        featstmp, row_names, col_names, labelstmp = make_feature_array(feats, selected, labels_filtered)
+        if labelstmp.size == 0 or featstmp.size == 0:
+            return
+
+        bad = numpy.isnan(featstmp) + numpy.isinf(featstmp)
+        replace_missing(featstmp)
+
+        with self._cache_lock:
+            if self._labeled_features_cols.get(lane_index, col_names) != col_names:
+                # the feature selection changed in the meantime
+                self._labeled_features.pop(lane_index, None)
+            self._labeled_features_cols[lane_index] = col_names
+            lane_cache = self._labeled_features[lane_index]
+            for idx, (t, obj) in enumerate(row_names):
+                bad_cols = tuple(col_names[c] for c in numpy.nonzero(bad[idx])[0])
+                lane_cache[(t, obj)] = (featstmp[idx].copy(), bad_cols)
+
     def execute(self, slot, subindex, roi, result):
         featList = []
         all_col_names = []
@@ -956,27 +1027,33 @@ class OpObjectTrain(Operator):
             # but the current implementation of Slot.value() does not
             # do the right thing.
             labels_image = self.Labels[lane_index]([]).wait()
-            labels_image_filtered = {}
-            nztimes = []
-            for timestep, labels_time in labels_image.iteritems():
-                nz = numpy.nonzero(labels_time)
-                if len(nz[0])==0:
-                    continue
-                else:
-                    nztimes.append(timestep)
-                    labels_image_filtered[timestep] = labels_time
 
-            if len(nztimes)==0:
+            # the labeled objects, in the same order as make_feature_array() would list them
+            labeled = []
+            for timestep in sorted(labels_image.keys()):
+                labels_time = numpy.atleast_1d(numpy.asarray(labels_image[timestep]).squeeze())
+                for obj in numpy.nonzero(labels_time)[0]:
+                    labeled.append((timestep, obj, labels_time[obj]))
+
+            if len(labeled)==0:
                 return
-            # compute the features if there are nonzero labels in this image
-            # and only for the time steps, which have labels
-            feats = self.Features[lane_index](nztimes).wait()
 
-            featstmp, row_names, col_names, labelstmp = make_feature_array(feats, selected, labels_image_filtered)
-            if labelstmp.size == 0 or featstmp.size == 0:
+            # compute the features only for the time steps with labeled objects that aren't cached yet
+            with self._cache_lock:
+                lane_cache = self._labeled_features[lane_index]
+                missing_times = sorted(set(t for t, obj, _ in labeled if (t, obj) not in lane_cache))
+            if missing_times:
+                self._cacheFeatures(lane_index, missing_times, labels_image, selected)
+
+            with self._cache_lock:
+                lane_cache = self._labeled_features[lane_index]
+                col_names = self._labeled_features_cols.get(lane_index)
+                rows = [(t, obj, label) + lane_cache[(t, obj)] for t, obj, label in labeled if (t, obj) in lane_cache]
+            if len(rows)==0:
                 return
 
-            rows, cols = replace_missing(featstmp)
+            featstmp = numpy.array([row[3] for row in rows])
+            labelstmp = numpy.array([[row[2]] for row in rows])
 
             # Critical section: Adding to shared lists.
             with lock:
@@ -984,12 +1061,10 @@ class OpObjectTrain(Operator):
                 all_col_names.append(tuple(col_names))
                 labelsList.append(labelstmp)
     
-                for idx in rows:
-                    t, obj = row_names[idx]
-                    all_bad_objects[lane_index][t].append(obj)
-    
-                for c in cols:
-                    all_bad_feats.add(col_names[c])
+                for t, obj, _, _, bad_cols in rows:
+                    if bad_cols:
+                        all_bad_objects[lane_index][t].append(obj)
+                        all_bad_feats.update(bad_cols)
 
         pool = RequestPool()
         for i in range(len(self.Labels)):
@@ -1025,6 +1100,11 @@ class OpObjectTrain(Operator):
         return result
 
     def propagateDirty(self, slot, subindex, roi):
+        if slot is self.Features:
+            self._clearFeatureCache(subindex[0])
+        elif slot is self.SelectedFeatures:
+            self._clearFeatureCache()
+
         if slot is not self.FixClassifier and \
            self.inputs["FixClassifier"].value == False:
             slcs = (slice(0, self.ForestCount.value, None),)
@@ -1066,6 +1146,23 @@ class OpObjectPredict(Operator):
 
     #SegmentationThreshold = 0.5
 
+    def __init__(self, *args, **kwargs):
+        super(OpObjectPredict, self).__init__(*args, **kwargs)
+        self.lock = RequestLock()
+        self.prob_cache = dict()
+        self.bad_objects = dict()
+        self._cache_entry = CacheRegistry().registerDictCache( "OpObjectPredict.prob_cache", self._evictTimestep )
+        # The cached probabilities were all computed with this classifier.
+        # (We keep a reference to it, so its id can't be reused by a new classifier.)
+        self._cache_classifier = None
+        # If True, the cached probabilities were loaded from the project file,
+        # and belong to whichever classifier we are asked to use next.
+        self._adopt_cache = False
+        # Incremented whenever the whole cache (or a single timestep) is invalidated, so that
+        # predictions which were started before the invalidation don't end up in the cache.
+        self._cache_generation = 0
+        self._timestep_versions = defaultdict(int)
+
     def setupOutputs(self):
         self.Predictions.meta.shape = self.Features.meta.shape
         self.Predictions.meta.dtype = object
@@ -1092,9 +1189,31 @@ class OpObjectPredict(Operator):
                 oslot.meta.axistags = None
                 oslot.meta.mapping_dtype = numpy.float32
 
-        self.lock = RequestLock()
-        self.prob_cache = dict()
-        self.bad_objects = dict()
+        self._invalidate()
+
+    def _invalidate(self, times=None):
+        """
+        Drop the cached probabilities for the given timesteps (all timesteps if times is None).
+        """
+        with self.lock:
+            if times is None:
+                times = self.prob_cache.keys() + self.bad_objects.keys()
+                self._cache_classifier = None
+                self._adopt_cache = False
+                self._cache_generation += 1
+            for t in times:
+                self.prob_cache.pop(t, None)
+                self.bad_objects.pop(t, None)
+                self._timestep_versions[t] += 1
+        for t in times:
+            self._cache_entry.discard(t)
+
+    def _evictTimestep(self, t):
+        """
+        Called by the CacheRegistry when the RAM budget is exceeded.
+        """
+        with self.lock:
+            self.prob_cache.pop(t, None)
 
     def execute(self, slot, subindex, roi, result):
         assert slot in [self.Predictions,
@@ -1109,7 +1228,11 @@ class OpObjectPredict(Operator):
             times = range(self.Predictions.meta.shape[0])
 
         if slot is self.CachedProbabilities:
-            return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            with self.lock:
+                cached = {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            for t in cached:
+                self._cache_entry.touch(t)
+            return cached
 
         classifier = self.Classifier.value
         if classifier is None:
@@ -1117,7 +1240,9 @@ class OpObjectPredict(Operator):
             return dict((t, numpy.array([])) for t in times)
 
         feats = {}
+        bad_objects = {}
         prob_predictions = {}
+        predict_seconds = defaultdict(float)
 
         selected = self.SelectedFeatures([]).wait()
 
@@ -1128,9 +1253,24 @@ class OpObjectPredict(Operator):
                     n = max(n, len(feature_matrix))
             return n
 
-        # Keep a list of times that are not in the cache
+        # Keep a list of times that are not in the cache.
+        # (The cached ones are kept here, in case the CacheRegistry evicts them in the meantime.)
         with self.lock:
-            times_not_cached = [t for t in times if t not in self.prob_cache]
+            if classifier is not self._cache_classifier:
+                if self._adopt_cache:
+                    # Probabilities that were loaded from the project file belong to the loaded classifier.
+                    self._adopt_cache = False
+                else:
+                    self.prob_cache = dict()
+                    self.bad_objects = dict()
+                    self._cache_entry.clear()
+                    self._cache_generation += 1
+                self._cache_classifier = classifier
+            probs = {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            times_not_cached = [t for t in times if t not in probs]
+            versions = {t: (self._cache_generation, self._timestep_versions[t]) for t in times_not_cached}
+        for t in probs:
+            self._cache_entry.touch(t)
 
         # Initialize with a single value for the 'background object ' 
         if times_not_cached:  
@@ -1147,8 +1287,8 @@ class OpObjectPredict(Operator):
                   
             ftmatrix, _, col_names = make_feature_array({t:tmpfeats[t]}, selected)
             rows, cols = replace_missing(ftmatrix)
-            self.bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
-            self.bad_objects[t][rows] = 1
+            bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
+            bad_objects[t][rows] = 1
             feats[t] = ftmatrix
   
         # Are there any objects to predict?
@@ -1160,7 +1300,9 @@ class OpObjectPredict(Operator):
                 #       For details please see wikipedia:
                 #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
                 #       (^-^)
+                start = time.time()
                 prob_predictions[_t] = classifier.predict_probabilities(feats[_t].astype(numpy.float32))
+                predict_seconds[_t] = time.time() - start
   
             # predict the data with all the forests in parallel
             pool = RequestPool()
@@ -1172,49 +1314,77 @@ class OpObjectPredict(Operator):
             pool.wait()
             pool.clean()
 
+        newly_cached = []
         with self.lock:
-            for t in times:
+            for t in times_not_cached:
+                # prob_predictions is a dict-of-arrays, indexed as follows:
+                # prob_predictions[t][object_index, class_index]
+                prob_predictions[t][0] = 0 # Background probability is always zero
+                if versions[t] != (self._cache_generation, self._timestep_versions[t]):
+                    # The features or the classifier changed while we were predicting.
+                    # Return what we computed, but don't cache it.
+                    probs[t] = prob_predictions[t]
+                    continue
                 if t not in self.prob_cache:
-                    # prob_predictions is a dict-of-arrays, indexed as follows:
-                    # prob_predictions[t][object_index, class_index]
                     self.prob_cache[t] = prob_predictions[t]
-                    self.prob_cache[t][0] = 0 # Background probability is always zero
-
-            if slot == self.Probabilities:
-                return { t : self.prob_cache[t] for t in times }
-            elif slot == self.Predictions:
-                # FIXME: Support SegmentationThreshold again...
-                labels = dict()
-                for t in times:
-                    prob_sum = numpy.sum(self.prob_cache[t], axis=1)
-                    labels[t] = 1 + numpy.argmax(self.prob_cache[t], axis=1)
-                    labels[t][0] = 0 # Background gets the zero label
-                
-                return labels
-
-            elif slot == self.ProbabilityChannels:
-                try:
-                    prob_single_channel = {t: self.prob_cache[t][:, subindex[0]]
-                                           for t in times}
-                except:
-                    # no probabilities available for this class; return zeros
-                    prob_single_channel = {t: numpy.zeros((self.prob_cache[t].shape[0], 1))
-                                           for t in times}
-                return prob_single_channel
-
-            elif slot == self.BadObjects:
-                return { t : self.bad_objects[t] for t in times }
+                    if t in bad_objects:
+                        self.bad_objects[t] = bad_objects[t]
+                    newly_cached.append(t)
+                probs[t] = self.prob_cache[t]
+            current_bad_objects = dict(self.bad_objects)
+            current_bad_objects.update(bad_objects)
+
+        # Report new cache entries only after releasing our lock:
+        #  the registry may decide to evict (which locks) right away.
+        for t in newly_cached:
+            self._cache_entry.insert( t, probs[t].nbytes, predict_seconds[t] )
+
+        if slot == self.Probabilities:
+            return probs
+        elif slot == self.Predictions:
+            # FIXME: Support SegmentationThreshold again...
+            labels = dict()
+            for t in times:
+                labels[t] = 1 + numpy.argmax(probs[t], axis=1)
+                labels[t][0] = 0 # Background gets the zero label
+            return labels
+
+        elif slot == self.ProbabilityChannels:
+            try:
+                prob_single_channel = {t: probs[t][:, subindex[0]]
+                                       for t in times}
+            except:
+                # no probabilities available for this class; return zeros
+                prob_single_channel = {t: numpy.zeros((probs[t].shape[0], 1))
+                                       for t in times}
+            return prob_single_channel
+
+        elif slot == self.BadObjects:
+            # (Timesteps without any objects, or with loaded probabilities, have no entry.)
+            return { t : current_bad_objects.get(t, numpy.zeros((probs[t].shape[0],))) for t in times }
 
-            else:
-                assert False, "Unknown input slot"
+        else:
+            assert False, "Unknown input slot"
 
     def propagateDirty(self, slot, subindex, roi):
-        self.prob_cache = {}
-        if slot is self.InputProbabilities:
-            self.prob_cache = self.InputProbabilities([]).wait()
-        self.Predictions.setDirty(())
-        self.Probabilities.setDirty(())
-        self.ProbabilityChannels.setDirty(())
+        if slot is self.Features and len(roi._l) > 0:
+            # Only the timesteps whose features changed have to be predicted again.
+            # (The roi may also list (time, object) pairs.)
+            times = sorted(set(t[0] if isinstance(t, tuple) else t for t in roi._l))
+            self._invalidate(times)
+        else:
+            self._invalidate()
+            if slot is self.InputProbabilities:
+                loaded = self.InputProbabilities([]).wait()
+                with self.lock:
+                    self.prob_cache = dict(loaded)
+                    # Since the classifier is deserialized before the probabilities,
+                    # the loaded probabilities are consistent with the next classifier we see.
+                    # If the classifier becomes dirty before then, they are dropped again.
+                    self._adopt_cache = True
+            times = []
+        for oslot in [self.Predictions, self.Probabilities, self.BadObjects] + list(self.ProbabilityChannels):
+            oslot.setDirty(List(oslot, times))
 
     def createExportTable(self, roi):
         if not self.Predictions.ready() or not self.Features.ready():
@@ -47,6 +47,7 @@ except:
     logger.warn('could not import pluginManager')
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility import CacheRegistry
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -147,6 +148,9 @@ class OpCachedRegionFeatures(Operator):
         self._opCache.name = "OpCachedRegionFeatures._opCache"
         self._opCache.Input.connect(self._opRegionFeatures.Output)
 
+        # Region features are small, but expensive to recompute.
+        CacheRegistry().registerOperatorCache( "OpCachedRegionFeatures._opCache", self._opCache, seconds_per_mb=20.0 )
+
         # Hook up our output slots
         self.Output.connect(self._opCache.Output)
         self.CleanBlocks.connect(self._opCache.CleanBlocks)
@@ -724,17 +724,20 @@ class FeatureSelectionDialog(QtGui.QDialog):
         '''
         from sklearn.ensemble import RandomForestClassifier
         from ilastik_feature_selection.wrapper_feature_selection import EvaluationFunction
+        from ilastik.applets.pixelClassification.featureSetEvaluation import stratifiedSubsample, \
+            MAX_FEATURE_SELECTION_SAMPLES, FEATURE_SELECTION_SEED
 
 
         feature_order = numpy.array(feature_order)
 
-        rf = RandomForestClassifier(n_jobs=-1, n_estimators=255)
+        rf = RandomForestClassifier(n_jobs=-1, n_estimators=255, random_state=FEATURE_SELECTION_SEED)
         ev_func = EvaluationFunction(rf, complexity_penalty=self._selection_params["c"])
         n_select = 1
         overshoot = 0
         score = 0.
-        X = self.featureLabelMatrix_all_features[:, 1:]
-        Y = self.featureLabelMatrix_all_features[:, 0]
+        samples = stratifiedSubsample(self.featureLabelMatrix_all_features[:, 0], MAX_FEATURE_SELECTION_SAMPLES)
+        X = self.featureLabelMatrix_all_features[samples, 1:]
+        Y = self.featureLabelMatrix_all_features[samples, 0]
         n_select_opt = n_select
 
         while (overshoot < 3) & (n_select < self.n_features):
@@ -0,0 +1,160 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Helpers for the wrapper feature selection: evaluating a feature subset means training
+(and cross-validating) a classifier, so the searches spend almost all their time there.
+
+- the labeled samples are subsampled (stratified by class, with a fixed seed),
+- scores are memoized per feature subset,
+- the candidates of a search step are evaluated concurrently on the request pool,
+- sequential forward selection stops once the score hasn't improved for a few steps.
+"""
+import threading
+import logging
+from functools import partial
+
+import numpy
+
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+# Default maximum number of labeled samples used to evaluate feature sets
+MAX_FEATURE_SELECTION_SAMPLES = 20000
+
+# Seed for subsampling and for the default classifiers, so that results are reproducible
+FEATURE_SELECTION_SEED = 42
+
+def stratifiedSubsample(labels, max_samples, seed=FEATURE_SELECTION_SEED):
+    """
+    Return the (sorted) indices of about max_samples entries of labels,
+    with each class represented in proportion to its frequency (but by at least one sample).
+    If there are no more than max_samples labels, all indices are returned.
+    """
+    labels = numpy.asarray(labels)
+    if not max_samples or len(labels) <= max_samples:
+        return numpy.arange(len(labels))
+
+    rng = numpy.random.RandomState(seed)
+    classes, counts = numpy.unique(labels, return_counts=True)
+    num_per_class = numpy.maximum( (counts * max_samples) // len(labels), 1 )
+    indices = []
+    for c, n in zip(classes, num_per_class):
+        class_indices = numpy.flatnonzero(labels == c)
+        indices.append( rng.choice(class_indices, min(n, len(class_indices)), replace=False) )
+    return numpy.sort( numpy.concatenate(indices) )
+
+class FeatureSetEvaluator(object):
+    """
+    Scores feature subsets with the given evaluation function, which is called as
+    ``evaluation_fct(data, labels, None, feature_set)`` (as the functions of
+    ilastik_feature_selection.wrapper_feature_selection.EvaluationFunction).
+    Scores are memoized, so every subset is only evaluated once (if several threads ask for the same
+    subset at once, they all wait for the first evaluation).
+
+    If parallel is True, the evaluation function must be safe to call from several threads
+    (e.g. it creates its own classifier per call).  Otherwise the evaluations are serialized.
+    """
+    def __init__(self, data, labels, evaluation_fct, parallel=True):
+        self._data = data
+        self._labels = labels
+        self._evaluation_fct = evaluation_fct
+        self._parallel = parallel
+        self._scores = {}
+        self._pending = {} # key -> Request of the running evaluation
+        self._lock = threading.Lock()
+        self._evaluation_lock = threading.Lock()
+        self.num_evaluations = 0
+
+    @staticmethod
+    def _key(feature_set):
+        return tuple(sorted(int(f) for f in feature_set))
+
+    def score(self, feature_set):
+        key = self._key(feature_set)
+        with self._lock:
+            if key in self._scores:
+                return self._scores[key]
+            request = self._pending.get(key)
+            if request is None:
+                request = self._pending[key] = Request( partial(self._evaluate, key) )
+        return request.wait()
+
+    def _evaluate(self, key):
+        try:
+            if self._parallel:
+                score = self._evaluation_fct( self._data, self._labels, None, list(key) )
+            else:
+                with self._evaluation_lock:
+                    score = self._evaluation_fct( self._data, self._labels, None, list(key) )
+            with self._lock:
+                self._scores[key] = score
+                self.num_evaluations += 1
+        finally:
+            with self._lock:
+                del self._pending[key]
+        return score
+
+    def scoreAll(self, feature_sets):
+        """
+        Score several feature sets (concurrently, if possible).  Returns the scores in the same order.
+        Equal feature sets (in any order) are only scored once.
+        """
+        keys = map( self._key, feature_sets )
+        unique_keys = sorted( set(keys) )
+        if not self._parallel or len(unique_keys) <= 1:
+            scores = dict( (key, self.score(key)) for key in unique_keys )
+            return [ scores[key] for key in keys ]
+
+        scores = {}
+        def evaluate(key):
+            scores[key] = self.score( key )
+
+        pool = RequestPool()
+        for key in unique_keys:
+            pool.add( Request( partial(evaluate, key) ) )
+        pool.wait()
+        pool.clean()
+        return [ scores[key] for key in keys ]
+
+def sequentialForwardSelection(evaluator, num_features, overshoot=3):
+    """
+    Greedily add the feature that improves the score most, until the score hasn't
+    improved for `overshoot` steps (or all features are selected).
+    Returns (best_feature_set, best_score).
+    """
+    selected = []
+    remaining = range(num_features)
+    best_set = []
+    best_score = -numpy.inf
+    num_overshoot = 0
+    while num_overshoot < overshoot and remaining:
+        scores = evaluator.scoreAll( [selected + [f] for f in remaining] )
+        best = int(numpy.argmax(scores))
+        selected.append( remaining.pop(best) )
+        logger.debug( "SFS: {} features, score {}".format( len(selected), scores[best] ) )
+        if scores[best] > best_score:
+            best_score = scores[best]
+            best_set = list(selected)
+            num_overshoot = 0
+        else:
+            num_overshoot += 1
+    return best_set, best_score
@@ -28,7 +28,8 @@ import numpy
 import vigra
 
 #lazyflow
-from lazyflow.roi import determineBlockShape
+from lazyflow.roi import determineBlockShape, getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+from lazyflow.request import Request, RequestPool
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
 from lazyflow.operators import OpValueCache, OpTrainClassifierBlocked, OpClassifierPredict,\
                                OpSlicedBlockedArrayCache, OpMultiArraySlicer2, \
@@ -36,12 +37,14 @@ from lazyflow.operators import OpValueCache, OpTrainClassifierBlocked, OpClassif
 import ilastik_feature_selection
 import numpy as np
 
-from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
+from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory, LazyflowVectorwiseClassifierABC
 
 #ilastik
 from ilastik.applets.base.applet import DatasetConstraintError
 from ilastik.utility.operatorSubView import OperatorSubView
-from ilastik.utility import OpMultiLaneWrapper
+from ilastik.utility import OpMultiLaneWrapper, CacheRegistry
+from featureSetEvaluation import FeatureSetEvaluator, stratifiedSubsample, sequentialForwardSelection, \
+                                 MAX_FEATURE_SELECTION_SAMPLES, FEATURE_SELECTION_SEED
 
 #from PyQt4.QtCore import pyqtRemoveInputHook, pyqtRestoreInputHook
 
@@ -82,6 +85,7 @@ class OpPixelClassification( Operator ):
     HeadlessPredictionProbabilities = OutputSlot(level=1) # Classification predictions ( via no image caches (except for the classifier itself )
     HeadlessUint8PredictionProbabilities = OutputSlot(level=1) # Same as above, but 0-255 uint8 instead of 0.0-1.0 float32
     HeadlessUncertaintyEstimate = OutputSlot(level=1) # Same as uncertaintly estimate, but does not rely on cached data.
+    HeadlessFusedPredictions = OutputSlot(level=1) # Probabilities, segmentation and uncertainty from one prediction (no caches)
 
     UncertaintyEstimate = OutputSlot(level=1)
     
@@ -182,6 +186,7 @@ class OpPixelClassification( Operator ):
         self.UncertaintyEstimate.connect( self.opPredictionPipeline.UncertaintyEstimate )
         self.SimpleSegmentation.connect( self.opPredictionPipeline.SimpleSegmentation )
         self.HeadlessUncertaintyEstimate.connect( self.opPredictionPipeline.HeadlessUncertaintyEstimate )
+        self.HeadlessFusedPredictions.connect( self.opPredictionPipeline.HeadlessFusedPredictions )
 
         def inputResizeHandler( slot, oldsize, newsize ):
             if ( newsize == 0 ):
@@ -426,6 +431,7 @@ class OpPredictionPipelineNoCache(Operator):
     HeadlessUint8PredictionProbabilities = OutputSlot() # drange 0 to 255
     SimpleSegmentation = OutputSlot()
     HeadlessUncertaintyEstimate = OutputSlot()
+    HeadlessFusedPredictions = OutputSlot() # Probabilities, then segmentation, then uncertainty (all float32)
 
     def __init__(self, *args, **kwargs):
         super( OpPredictionPipelineNoCache, self ).__init__( *args, **kwargs )
@@ -433,8 +439,9 @@ class OpPredictionPipelineNoCache(Operator):
         # Random forest prediction using the raw feature image slot (not the cached features)
         # This would be bad for interactive labeling, but it's good for headless flows 
         #  because it avoids the overhead of cache.        
-        self.cacheless_predict = OpClassifierPredict( parent=self )
-        self.cacheless_predict.name = "OpClassifierPredict (Cacheless Path)"
+        # Blocks outside the prediction mask are skipped.
+        self.cacheless_predict = OpMaskedClassifierPredict( parent=self )
+        self.cacheless_predict.name = "OpMaskedClassifierPredict (Cacheless Path)"
         self.cacheless_predict.Classifier.connect(self.Classifier) 
         self.cacheless_predict.Image.connect(self.FeatureImages) # <--- Not from cache
         self.cacheless_predict.LabelsCount.connect(self.NumClasses)
@@ -457,6 +464,12 @@ class OpPredictionPipelineNoCache(Operator):
         self.opUncertaintyEstimator.Input.connect( self.cacheless_predict.PMaps )
         self.HeadlessUncertaintyEstimate.connect( self.opUncertaintyEstimator.Output )
 
+        # All of the above from a single prediction per block,
+        # for exporting them together without running the classifier three times.
+        self.opFusedOutputs = OpFusedPredictionOutputs( parent=self )
+        self.opFusedOutputs.Input.connect( self.cacheless_predict.PMaps )
+        self.HeadlessFusedPredictions.connect( self.opFusedOutputs.Output )
+
     def setupOutputs(self):
         pass
 
@@ -498,6 +511,179 @@ class OpArgmaxChannel( Operator ):
         roi.stop[-1] = 1
         self.Output.setDirty( roi.start, roi.stop )        
 
+def top_two_margin(pmap, axis=-1):
+    """
+    Return the difference between the highest and the second-highest value along the given axis
+    (which must have at least 2 entries).  Uses a partial selection instead of sorting all channels.
+    """
+    top_two = numpy.partition(pmap, pmap.shape[axis]-2, axis=axis)
+    top_two = numpy.rollaxis(top_two, axis % pmap.ndim, pmap.ndim)
+    return top_two[..., -1] - top_two[..., -2]
+
+class OpFusedPredictionOutputs( Operator ):
+    """
+    Computes the probabilities, the simple segmentation (as in OpArgmaxChannel)
+    and the uncertainty (as in OpEnsembleMargin) from a single request of the input.
+    The output has the input's channels, followed by one channel for the segmentation
+    and one for the uncertainty.  Since all channels share the output dtype (float32),
+    the segmentation channel holds the class labels (1, 2, ...) as float values.
+
+    Only the requested channels are computed: requests for probability channels only
+    fetch just those channels from the input.  Requests that include the segmentation
+    or uncertainty channel need all input channels of their spatial roi.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def setupOutputs(self):
+        assert self.Input.meta.getAxisKeys()[-1] == 'c'
+        num_classes = self.Input.meta.shape[-1]
+        self.Output.meta.assignFrom( self.Input.meta )
+        self.Output.meta.dtype = numpy.float32
+        self.Output.meta.shape = self.Input.meta.shape[:-1] + (num_classes + 2,)
+        self.Output.meta.drange = None
+        channel_names = self.Input.meta.channel_names or ["Class {}".format(i+1) for i in range(num_classes)]
+        self.Output.meta.channel_names = list(channel_names) + ["Simple Segmentation", "Uncertainty"]
+
+    def execute(self, slot, subindex, roi, result):
+        num_classes = self.Input.meta.shape[-1]
+        c_start, c_stop = roi.start[-1], roi.stop[-1]
+        segmentation_channel, uncertainty_channel = num_classes, num_classes+1
+
+        if c_stop <= num_classes:
+            # Probabilities only
+            self.Input(roi.start, roi.stop).writeInto(result).wait()
+            return result
+
+        start = tuple(roi.start[:-1]) + (0,)
+        stop = tuple(roi.stop[:-1]) + (num_classes,)
+        pmap = self.Input(start, stop).wait()
+
+        if c_start < num_classes:
+            result[..., :num_classes - c_start] = pmap[..., c_start:]
+        if c_start <= segmentation_channel < c_stop:
+            result[..., segmentation_channel - c_start] = numpy.argmax( pmap, axis=-1 ) + 1 # Class labels start at 1
+        if c_start <= uncertainty_channel < c_stop:
+            if num_classes > 1:
+                result[..., uncertainty_channel - c_start] = 1 - top_two_margin( pmap, axis=-1 )
+            else:
+                result[..., uncertainty_channel - c_start] = 0
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        roi = roi.copy()
+        roi.start[-1] = 0
+        roi.stop[-1] = self.Output.meta.shape[-1]
+        self.Output.setDirty( roi.start, roi.stop )
+
+class OpMaskedClassifierPredict( Operator ):
+    """
+    Like OpClassifierPredict (which it uses internally), but with a block-level PredictionMask check:
+    Blocks that are entirely outside the mask are zero, without requesting any features.
+    In partially masked blocks, only the pixels inside the mask are passed to the classifier
+    (the others are zero).  Blocks that are entirely inside the mask are predicted as usual.
+
+    Pixelwise classifiers can't predict individual pixels, so they (and requests without a mask)
+    are always handled by OpClassifierPredict.
+    """
+    Image = InputSlot()
+    LabelsCount = InputSlot()
+    Classifier = InputSlot()
+    PredictionMask = InputSlot(optional=True)
+
+    PMaps = OutputSlot()
+
+    # Partially masked requests are split into blocks of this volume (not counting channels)
+    MASK_BLOCK_VOLUME = 64**3
+
+    def __init__(self, *args, **kwargs):
+        super( OpMaskedClassifierPredict, self ).__init__( *args, **kwargs )
+        self._opPredict = OpClassifierPredict( parent=self )
+        self._opPredict.Image.connect( self.Image )
+        self._opPredict.LabelsCount.connect( self.LabelsCount )
+        self._opPredict.Classifier.connect( self.Classifier )
+        self._opPredict.PredictionMask.connect( self.PredictionMask )
+
+        # Forward dirty regions (the internal operator knows which inputs affect which regions)
+        self._opPredict.PMaps.notifyDirty( self._handleDirtyPrediction )
+        self._blockshape = None
+
+    def setupOutputs(self):
+        self.PMaps.meta.assignFrom( self._opPredict.PMaps.meta )
+        spatial_shape = self.Image.meta.shape[:-1]
+        self._blockshape = tuple( determineBlockShape( spatial_shape, self.MASK_BLOCK_VOLUME ) ) + (self.PMaps.meta.shape[-1],)
+
+    def execute(self, slot, subindex, roi, result):
+        classifier = self.Classifier.value
+        if not self.PredictionMask.ready() or not isinstance(classifier, LazyflowVectorwiseClassifierABC):
+            self._opPredict.PMaps(roi.start, roi.stop).writeInto(result).wait()
+            return result
+
+        mask = self._readMask( roi.start, roi.stop )
+        if not mask.any():
+            result[:] = 0.0
+        elif mask.all():
+            self._opPredict.PMaps(roi.start, roi.stop).writeInto(result).wait()
+        else:
+            # Predict block by block, so the feature computation is skipped for the empty blocks
+            request_roi = ( roi.start, roi.stop )
+            def predict_block(block_start):
+                block_roi = getBlockBounds( self.PMaps.meta.shape, self._blockshape, block_start )
+                block_roi = getIntersection( block_roi, request_roi )
+                result_roi = numpy.subtract( block_roi, roi.start )
+                result_view = result[roiToSlice(*result_roi)]
+                block_mask = mask[roiToSlice(*result_roi)][..., 0]
+                self._predictMasked( classifier, block_roi, block_mask, result_view )
+
+            pool = RequestPool()
+            for block_start in getIntersectingBlocks( self._blockshape, request_roi ):
+                pool.add( Request( partial(predict_block, block_start) ) )
+            pool.wait()
+            pool.clean()
+        return result
+
+    def _readMask(self, start, stop):
+        mask_start = tuple(start[:-1]) + (0,)
+        mask_stop = tuple(stop[:-1]) + (1,)
+        return self.PredictionMask(mask_start, mask_stop).wait().astype(bool)
+
+    def _predictMasked(self, classifier, roi, mask, result):
+        """
+        Predict the pixels of the given roi that are inside the mask (a boolean array without channel axis).
+        """
+        if not mask.any():
+            result[:] = 0.0
+            return
+        if mask.all():
+            self._opPredict.PMaps(*roi).writeInto(result).wait()
+            return
+
+        # Request all feature channels of the spatial roi
+        num_features = self.Image.meta.shape[-1]
+        feature_start = tuple(roi[0][:-1]) + (0,)
+        feature_stop = tuple(roi[1][:-1]) + (num_features,)
+        features = self.Image(feature_start, feature_stop).wait()
+        features = features.reshape( (-1, num_features) )[mask.reshape(-1)]
+
+        probabilities = classifier.predict_probabilities( features )
+        num_classes = self.PMaps.meta.shape[-1]
+        full_probabilities = numpy.zeros( (mask.size, num_classes), dtype=numpy.float32 )
+        if probabilities.shape[1] < num_classes:
+            # Not every class had labels: the classifier only provides the known classes.
+            for i, label in enumerate(classifier.known_classes):
+                full_probabilities[mask.reshape(-1), label-1] = probabilities[:, i]
+        else:
+            full_probabilities[mask.reshape(-1)] = probabilities
+        full_probabilities.shape = mask.shape + (num_classes,)
+        result[:] = full_probabilities[..., roi[0][-1]:roi[1][-1]]
+
+    def _handleDirtyPrediction(self, slot, roi):
+        self.PMaps.setDirty( roi.start, roi.stop )
+
+    def propagateDirty(self, slot, subindex, roi):
+        # Dirty regions are forwarded from the internal OpClassifierPredict (see __init__).
+        pass
+
 class OpPredictionPipeline(OpPredictionPipelineNoCache):
     """
     This operator extends the cacheless prediction pipeline above with additional outputs for the GUI.
@@ -519,8 +705,8 @@ class OpPredictionPipeline(OpPredictionPipelineNoCache):
         super(OpPredictionPipeline, self).__init__( *args, **kwargs )
 
         # Random forest prediction using CACHED features.
-        self.predict = OpClassifierPredict( parent=self )
-        self.predict.name = "OpClassifierPredict"
+        self.predict = OpMaskedClassifierPredict( parent=self )
+        self.predict.name = "OpMaskedClassifierPredict"
         self.predict.Classifier.connect(self.Classifier) 
         self.predict.Image.connect(self.CachedFeatureImages)
         self.predict.PredictionMask.connect(self.PredictionMask)
@@ -568,6 +754,11 @@ class OpPredictionPipeline(OpPredictionPipelineNoCache):
         self.opUncertaintyCache.fixAtCurrent.connect( self.FreezePredictions )
         self.UncertaintyEstimate.connect( self.opUncertaintyCache.Output )
 
+        # Let the cache registry evict prediction blocks when the RAM budget is exceeded.
+        # (Predictions are expensive to recompute: features + classifier.)
+        CacheRegistry().registerOperatorCache( "prediction_cache_gui", self.prediction_cache_gui, seconds_per_mb=2.0 )
+        CacheRegistry().registerOperatorCache( "opUncertaintyCache", self.opUncertaintyCache, seconds_per_mb=2.0 )
+
     def setupOutputs(self):
         # Set the blockshapes for each input image separately, depending on which axistags it has.
         axisOrder = [ tag.key for tag in self.FeatureImages.meta.axistags ]
@@ -628,14 +819,9 @@ class OpEnsembleMargin(Operator):
         roi.stop[chanAxis] = taggedShape['c']
         pmap = self.Input.get(roi).wait()
 
-        # Sort along channel axis so the every pixel's channels are sorted lowest to highest.
-        pmap.sort(axis=self.Input.meta.axistags.index('c'))
-        pmap = pmap.view(vigra.VigraArray)
-        pmap.axistags = self.Input.meta.axistags
-
         # Subtract the highest channel from the second-highest channel.
-        res = pmap.bindAxis('c', -1) - pmap.bindAxis('c', -2)
-        res = res.withAxes( *taggedShape.keys() ).view(numpy.ndarray)
+        res = top_two_margin( numpy.asarray(pmap), axis=chanAxis )
+        res = numpy.expand_dims( res, chanAxis )
         
         # Subtract from 1 to make this an "uncertainty" measure, not a "certainty" measure
         # e.g. predictions of .99 and .01 -> low uncertainty (0.98)
@@ -690,6 +876,7 @@ class OpWrapperFeatureSelection(Operator):
     # Default classifier it sklearn random forest
     EvaluationFunction = InputSlot(optional=True)  # if this is not connected then we use a default
     ComplexityPenalty = InputSlot(optional=True)
+    MaxSamples = InputSlot(value=MAX_FEATURE_SELECTION_SAMPLES)  # labeled samples are subsampled to this number
 
     SelectedFeatureIDs = OutputSlot()
 
@@ -702,18 +889,20 @@ class OpWrapperFeatureSelection(Operator):
         if self.Classifier.connected():
             self._classifier = self.Classifier.value
         else:
+            # Single-threaded forests: the candidate feature sets are evaluated in parallel instead.
             from sklearn import ensemble
-            self._classifier = ensemble.RandomForestClassifier(n_estimators=100, n_jobs=-1)
+            self._classifier = ensemble.RandomForestClassifier(n_estimators=100, n_jobs=1, random_state=FEATURE_SELECTION_SEED)
 
         if self.EvaluationFunction.connected():
             self._evaluation_fct = self.EvaluationFunction.value
+            self._parallel_evaluation = False
         else:
             if self.ComplexityPenalty.connected():
                 complexity_penalty = self.ComplexityPenalty.value
             else:
                 complexity_penalty = 0.07 # default
-            self._evaluator = ilastik_feature_selection.wrapper_feature_selection.EvaluationFunction(self._classifier, complexity_penalty = complexity_penalty)
-            self._evaluation_fct = self._evaluator.evaluate_feature_set_size_penalty
+            self._evaluation_fct = partial( self._evaluate, complexity_penalty )
+            self._parallel_evaluation = True
 
         # the output slot should maybe contain the internal feature IDs or a bool list of len(internal_feature_ids)
         self.SelectedFeatureIDs.meta.shape = (1,)
@@ -723,28 +912,40 @@ class OpWrapperFeatureSelection(Operator):
 
         feature_label_matrix = self.FeatureLabelMatrix[0].value
 
-        labels = feature_label_matrix[:, 0]  # first row is labels
-        data = feature_label_matrix[:, 1:]  # the rest is data
+        samples = stratifiedSubsample( feature_label_matrix[:, 0], self.MaxSamples.value )
+        labels = feature_label_matrix[samples, 0]  # first row is labels
+        data = feature_label_matrix[samples, 1:]  # the rest is data
 
-
-        feature_selector = ilastik_feature_selection.wrapper_feature_selection.WrapperFeatureSelection(data,
-                                                                                               labels.astype("int"),
-                                                                                               self._evaluation_fct, self._wrapper_method)
-
-
-        selected_features = feature_selector.run(overshoot=3)[0]
+        evaluator = FeatureSetEvaluator( data, labels.astype("int"), self._evaluation_fct, self._parallel_evaluation )
+        if self._wrapper_method == "SFS":
+            selected_features = sequentialForwardSelection( evaluator, data.shape[1], overshoot=3 )[0]
+        else:
+            # The other searches run in the library, but still profit from the subsampling and memoization.
+            evaluation_fct = lambda *args: evaluator.score( args[-1] )
+            feature_selector = ilastik_feature_selection.wrapper_feature_selection.WrapperFeatureSelection(data,
+                                                                                                   labels.astype("int"),
+                                                                                                   evaluation_fct, self._wrapper_method)
+            selected_features = feature_selector.run(overshoot=3)[0]
 
         # selected_features_names = [self.FeatureImages[0].meta['channel_names'][i] for i in selected_features]
 
         result = [selected_features]
         return result
 
+    def _evaluate(self, complexity_penalty, data, labels, test_data, feature_set):
+        # Every evaluation gets its own copy of the classifier, so they can run concurrently.
+        from sklearn.base import clone
+        evaluation = ilastik_feature_selection.wrapper_feature_selection.EvaluationFunction( clone(self._classifier),
+                                                                                            complexity_penalty = complexity_penalty )
+        return evaluation.evaluate_feature_set_size_penalty( data, labels, test_data, feature_set )
+
     def propagateDirty(self, slot, subindex, roi):
         self.SelectedFeatureIDs.setDirty()
 
 class OpGiniFeatureSelection(Operator):
     FeatureLabelMatrix = InputSlot(level=1)
     NumberOfSelectedFeatures = InputSlot()
+    MaxSamples = InputSlot(value=MAX_FEATURE_SELECTION_SAMPLES)  # labeled samples are subsampled to this number
 
     SelectedFeatureIDs = OutputSlot()
 
@@ -757,11 +958,12 @@ class OpGiniFeatureSelection(Operator):
 
         feature_label_matrix = self.FeatureLabelMatrix[0].value
 
-        labels = feature_label_matrix[:, 0]  # first row is labels
-        data = feature_label_matrix[:, 1:]  # the rest is data
+        samples = stratifiedSubsample( feature_label_matrix[:, 0], self.MaxSamples.value )
+        labels = feature_label_matrix[samples, 0]  # first row is labels
+        data = feature_label_matrix[samples, 1:]  # the rest is data
 
         from sklearn import ensemble
-        rf = ensemble.RandomForestClassifier(n_estimators = 100, n_jobs = -1)
+        rf = ensemble.RandomForestClassifier(n_estimators = 100, n_jobs = -1, random_state = FEATURE_SELECTION_SEED)
         rf.fit(data, labels)
         importances = rf.feature_importances_
 
@@ -28,7 +28,7 @@ from lazyflow.operators import OpBlockedArrayCache, OpSingleChannelSelector, OpR
 from ilastik.applets.base.applet import DatasetConstraintError
 
 # local
-from thresholdingTools import OpAnisotropicGaussianSmoothing5d, select_labels
+from thresholdingTools import OpAnisotropicGaussianSmoothing5d, select_labels, label_blockwise
 from ipht import threshold_from_cores
 from _OpGraphCut import segmentGC
 
@@ -192,6 +192,10 @@ class OpLabeledThreshold(Operator):
     FinalThreshold = InputSlot(value=0.2)
     GraphcutBeta = InputSlot(value=0.2) # Graphcut only
 
+    # The 'simple' and 'hysteresis' methods label each time slice block by block (zyx),
+    # so the input data and the thresholded mask are never loaded for the whole frame.
+    BlockShape = InputSlot(value=(256, 256, 256))
+
     Output = OutputSlot()
 
     def __init__(self, *args, **kwargs):
@@ -233,14 +237,16 @@ class OpLabeledThreshold(Operator):
         assert tuple(roi.stop - roi.start) == result.shape
 
         final_threshold = self.FinalThreshold.value
-
-        data = self.Input(roi.start, roi.stop).wait()
-        data = vigra.taggedView(data, self.Input.meta.axistags)
-        
         result = vigra.taggedView(result, self.Output.meta.axistags)
-        
-        binary = (data >= final_threshold).view(np.uint8)
-        vigra.analysis.labelMultiArrayWithBackground(binary[0,...,0], out=result[0,...,0])
+
+        def compute_binary(block_start, block_stop):
+            # block coordinates are zyx, relative to the roi
+            start = np.concatenate( ([roi.start[0]], roi.start[1:4] + block_start, [roi.start[4]]) )
+            stop = np.concatenate( ([roi.stop[0]], roi.start[1:4] + block_stop, [roi.stop[4]]) )
+            data = self.Input(start, stop).wait()
+            return (data[0,...,0] >= final_threshold).view(np.uint8)
+
+        label_blockwise( compute_binary, result[0,...,0], self.BlockShape.value )
 
     def _execute_HYSTERESIS(self, roi, result):
         self._execute_SIMPLE(roi, result)
@@ -29,10 +29,12 @@ import numpy as np
 import vigra
 import psutil
 from itertools import izip
+from functools import partial
 
 # Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import enlargeRoiForHalo, TinyVector
+from lazyflow.roi import enlargeRoiForHalo, TinyVector, roiToSlice
+from lazyflow.request import Request, RequestPool
 
 # ilastik
 from lazyflow.utility import Timer, vigra_bincount
@@ -375,6 +377,146 @@ def select_labels( small_labels, big_labels ):
         vigra.analysis.applyMapping(big_labels_3d, mapping, out=big_labels_3d)
 
 
+def label_blockwise( compute_binary, out, block_shape ):
+    """
+    Compute the connected components of a 3D (zyx) binary image block by block,
+    so that the binary image never has to be held in RAM as a whole.
+
+    The result is identical to vigra.analysis.labelMultiArrayWithBackground() on
+    the whole volume (same neighborhood, same label order).
+
+    compute_binary: A function f(block_start, block_stop) -> uint8 binary array for that block.
+                    Called in parallel.
+    out: A uint32 zyx array for the result.
+    block_shape: The (z,y,x) shape of the blocks.
+
+    Returns the number of labels.
+
+    Algorithm:
+    1. Each block is labeled independently (in parallel), directly into its region of 'out'.
+    2. Equivalences between labels of neighboring blocks are collected from the face-adjacent
+       voxels on both sides of each block boundary, and merged with a union-find table.
+    3. A final (parallel) pass relabels each block through a lookup table.
+       Labels are ordered by the first voxel (in raster order) of each object, like vigra does.
+    """
+    shape = np.array(out.shape)
+    block_shape = np.minimum(block_shape, shape)
+    grid_shape = (shape + block_shape - 1) // block_shape
+    block_indexes = list(np.ndindex(*grid_shape))
+
+    def block_roi(block_index):
+        start = np.array(block_index) * block_shape
+        stop = np.minimum(start + block_shape, shape)
+        return start, stop
+
+    out = vigra.taggedView(out, 'zyx')
+
+    # 1. Label each block independently.
+    num_block_labels = {}
+    first_voxels = {}
+    def label_block(block_index):
+        start, stop = block_roi(block_index)
+        binary = vigra.taggedView( compute_binary(start, stop), 'zyx' )
+        block_out = out[roiToSlice(start, stop)]
+        vigra.analysis.labelMultiArrayWithBackground(binary, out=block_out)
+
+        # Raster order within a block is consistent with the global raster order,
+        # so the first voxel of each local label within the block gives its global 'first voxel'.
+        local_values, local_first = np.unique(np.asarray(block_out).ravel(), return_index=True)
+        if local_values[0] == 0:
+            local_first = local_first[1:]
+        coords = np.unravel_index(local_first, tuple(stop - start))
+        coords = tuple( c + s for c, s in zip(coords, start) )
+        first_voxels[block_index] = np.ravel_multi_index(coords, tuple(shape))
+        num_block_labels[block_index] = len(local_first)
+
+    pool = RequestPool()
+    for block_index in block_indexes:
+        pool.add( Request( partial(label_block, block_index) ) )
+    pool.wait()
+    pool.clean()
+
+    # Provisional global label = local label + block offset
+    offsets = {}
+    total = 0
+    for block_index in block_indexes:
+        offsets[block_index] = total
+        total += num_block_labels[block_index]
+
+    if total == 0:
+        return 0
+
+    # 2. Collect equivalences across block faces
+    parents = range(total+1)
+    def find(label):
+        while parents[label] != label:
+            parents[label] = parents[parents[label]]
+            label = parents[label]
+        return label
+
+    for block_index in block_indexes:
+        start, stop = block_roi(block_index)
+        for axis in range(3):
+            neighbor_index = list(block_index)
+            neighbor_index[axis] += 1
+            neighbor_index = tuple(neighbor_index)
+            if neighbor_index[axis] >= grid_shape[axis]:
+                continue
+
+            face_slicing = list(roiToSlice(start, stop))
+            face_slicing[axis] = stop[axis]-1
+            labels_a = np.asarray(out[tuple(face_slicing)])
+            face_slicing[axis] = stop[axis]
+            labels_b = np.asarray(out[tuple(face_slicing)])
+
+            touching = (labels_a != 0) & (labels_b != 0)
+            if not touching.any():
+                continue
+            pairs = np.zeros( (touching.sum(), 2), dtype=np.int64 )
+            pairs[:,0] = labels_a[touching] + offsets[block_index]
+            pairs[:,1] = labels_b[touching] + offsets[neighbor_index]
+            pairs = np.unique( pairs[:,0] * (total+1) + pairs[:,1] )
+            for a, b in zip(pairs // (total+1), pairs % (total+1)):
+                root_a, root_b = find(int(a)), find(int(b))
+                if root_a != root_b:
+                    parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    roots = np.array( [find(label) for label in range(total+1)], dtype=np.uint32 )
+
+    # Order the merged objects by their first voxel
+    first_voxel = np.zeros( (total+1,), dtype=np.int64 )
+    for block_index in block_indexes:
+        offset = offsets[block_index]
+        first_voxel[offset+1:offset+1+num_block_labels[block_index]] = first_voxels[block_index]
+    object_first_voxel = np.empty_like( first_voxel )
+    object_first_voxel[:] = np.iinfo(np.int64).max
+    np.minimum.at( object_first_voxel, roots[1:], first_voxel[1:] )
+
+    unique_roots = np.unique( roots[1:] )
+    ordered_roots = unique_roots[ np.argsort( object_first_voxel[unique_roots], kind='mergesort' ) ]
+    final_label_of_root = np.zeros( (total+1,), dtype=np.uint32 )
+    final_label_of_root[ordered_roots] = np.arange( 1, len(ordered_roots)+1, dtype=np.uint32 )
+    lut = final_label_of_root[roots]
+    lut[0] = 0
+
+    # 3. Relabel each block
+    def relabel_block(block_index):
+        start, stop = block_roi(block_index)
+        offset = offsets[block_index]
+        block_lut = lut[offset:offset+num_block_labels[block_index]+1].copy()
+        block_lut[0] = 0
+        block_out = out[roiToSlice(start, stop)]
+        block_out[:] = block_lut[np.asarray(block_out)]
+
+    pool = RequestPool()
+    for block_index in block_indexes:
+        pool.add( Request( partial(relabel_block, block_index) ) )
+    pool.wait()
+    pool.clean()
+
+    return len(ordered_roots)
+
+
 if __name__ == "__main__":
     small_labels = np.zeros((100,100), dtype=np.uint32)
     small_labels[10:20, 10:20] = 1
@@ -32,8 +32,8 @@ try:
     import pgmlink
 except:
     import pgmlinkNoIlpSolver as pgmlink
-from ilastik.applets.tracking.base.trackingUtilities import relabel, \
-    get_dict_value
+from ilastik.applets.tracking.base.trackingUtilities import relabel_with_lut, \
+    get_dict_value, traxel_arrays_at, clip_probabilities
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
 from ilastik.applets.objectExtraction import config
 from ilastik.applets.base.applet import DatasetConstraintError
@@ -85,6 +85,7 @@ class OpTrackingBase(Operator, ExportingOperator):
     def __init__(self, parent=None, graph=None):
         super(OpTrackingBase, self).__init__(parent=parent, graph=graph)
         self.label2color = []
+        self._label2color_luts = []
         self.mergers = []
         self.resolvedto = []
 
@@ -162,8 +163,8 @@ class OpTrackingBase(Operator, ExportingOperator):
             t_end = roi.stop[0]
             for t in range(t_start, t_end):
                 if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][
-                    0]) and len(self.label2color) > t:
-                    result[t - t_start, ..., 0] = relabel(result[t - t_start, ..., 0], self.label2color[t])
+                    0]) and len(self._label2color_luts) > t:
+                    result[t - t_start, ..., 0] = relabel_with_lut(result[t - t_start, ..., 0], self._label2color_luts[t], 1)
                 else:
                     result[t - t_start, ...] = 0
             return result
@@ -218,23 +219,51 @@ class OpTrackingBase(Operator, ExportingOperator):
 
         filtered_labels = self.FilteredLabels.value
 
-        label2color = []
-        label2color.append({})
+        # The colors (track ids in export mode) are built as one dense array per timestep,
+        # indexed by object id.  -1 means that the object has not been assigned a color.
+        colors = [np.zeros((0,), dtype=np.int64) for _ in range(time_range[-1] + 2)]
         mergers = []
         resolvedto = []
 
-        maxId = 2  # misdetections have id 1
+        next_id = [2]  # misdetections have id 1
+
+        def new_colors(n):
+            if successive_ids:
+                c = np.arange(next_id[0], next_id[0] + n, dtype=np.int64)
+                next_id[0] += n
+                return c
+            return np.random.randint(1, 255, size=n).astype(np.int64)
+
+        def lookup(t, ids):
+            c = -np.ones(ids.shape, dtype=np.int64)
+            inside = ids < len(colors[t])
+            c[inside] = colors[t][ids[inside]]
+            return c
+
+        def assign(t, ids, values):
+            if len(ids) == 0:
+                return
+            size = int(ids.max()) + 1
+            if size > len(colors[t]):
+                grown = -np.ones((size,), dtype=np.int64)
+                grown[:len(colors[t])] = colors[t]
+                colors[t] = grown
+            colors[t][ids] = values
+
+        def columns(events_at, n):
+            # The last column of each event is its energy.
+            if len(events_at) == 0:
+                return [np.zeros((0,), dtype=np.int64)] * n
+            events_at = np.asarray(events_at)
+            return [events_at[:, i].astype(np.int64) for i in range(n)]
 
         # handle start time offsets
         for i in range(time_range[0]):
-            label2color.append({})
             mergers.append({})
             resolvedto.append({})
 
         extra_track_ids = {}
         if export_mode:
-            multi_move = {}
-            multi_move_next = {}
             divisions = []
 
         for i in time_range:
@@ -249,70 +278,47 @@ class OpTrackingBase(Operator, ExportingOperator):
             logger.debug(" {} mov at {}".format(len(mov), i))
             logger.debug(" {} merger at {}".format(len(merger), i))
 
-            label2color.append({})
             mergers.append({})
-            moves_at = []
             resolvedto.append({})
 
-            if export_mode:
-                moves_to = {}
-
-            for e in app:
-                if successive_ids:
-                    label2color[-1][int(e[0])] = maxId  # in export mode, the label color is used as track ID
-                    maxId += 1
-                else:
-                    label2color[-1][int(e[0])] = np.random.randint(1, 255)
-
-            for e in mov:
+            # appearances get a new color (in export mode, the color is used as track ID)
+            app_ids, = columns(app, 1)
+            assign(i + 1, app_ids, new_colors(len(app_ids)))
+
+            mov_from, mov_to = columns(mov, 2)
+            # alternative way of appearance: the parent has no color yet
+            uncolored = mov_from[lookup(i, mov_from) < 0]
+            if len(uncolored):
+                _, first = np.unique(uncolored, return_index=True)
+                uncolored = uncolored[np.sort(first)]
+                assign(i, uncolored, new_colors(len(uncolored)))
+            # assign color of parent
+            assign(i + 1, mov_to, lookup(i, mov_from))
+
+            div_parent, div_child1, div_child2 = columns(div, 3)  # event(parent, child, child)
+            uncolored = lookup(i, div_parent) < 0
+            if successive_ids:
+                # Parents without a color get a new one.  In export mode, each child
+                # starts a new track.  (Ids are handed out in the order of the events.)
+                increments = uncolored.astype(np.int64)
                 if export_mode:
-                    if e[1] in moves_to:
-                        multi_move.setdefault(i, {})
-                        multi_move[i][e[0]] = e[1]
-                        if len(moves_to[e[1]]) == 1:  # if we are just setting up this multi move
-                            multi_move[i][moves_to[e[1]][0]] = e[1]
-                        multi_move_next[(i, e[1])] = 0
-                    moves_to.setdefault(e[1], [])
-                    moves_to[e[1]].append(e[0])  # moves_to[target] contains list of incoming object ids
-
-                # alternative way of appearance
-                if not label2color[-2].has_key(int(e[0])):
-                    if successive_ids:
-                        label2color[-2][int(e[0])] = maxId
-                        maxId += 1
-                    else:
-                        label2color[-2][int(e[0])] = np.random.randint(1, 255)
-
-                # assign color of parent
-                label2color[-1][int(e[1])] = label2color[-2][int(e[0])]
-                moves_at.append(int(e[0]))
-
-                if export_mode:
-                    key = i - 1, e[0]
-                    if key in multi_move_next:  # captures mergers staying connected over longer time spans
-                        multi_move_next[key] = e[1]  # redirects output of last merger to target in this frame
-                        multi_move_next[(i, e[1])] = 0  # sets current end to zero (might be changed by above line in the future)
-
-            for e in div:  # event(parent, child, child)
-                # if not label2color[-2].has_key(int(e[0])):
-                if not int(e[0]) in label2color[-2]:
-                    if successive_ids:
-                        label2color[-2][int(e[0])] = maxId
-                        maxId += 1
-                    else:
-                        label2color[-2][int(e[0])] = np.random.randint(1, 255)
-                ancestor_color = label2color[-2][int(e[0])]
-                if export_mode:
-                    label2color[-1][int(e[1])] = maxId
-                    label2color[-1][int(e[2])] = maxId + 1
-                    divisions.append((i, int(e[0]), ancestor_color,
-                                      int(e[1]), maxId,
-                                      int(e[2]), maxId + 1
-                    ))
-                    maxId += 2
-                else:
-                    label2color[-1][int(e[1])] = ancestor_color
-                    label2color[-1][int(e[2])] = ancestor_color
+                    increments += 2
+                offsets = next_id[0] + np.cumsum(increments) - increments
+                next_id[0] += int(increments.sum())
+                assign(i, div_parent[uncolored], offsets[uncolored])
+                child_ids = offsets + uncolored
+            else:
+                assign(i, div_parent[uncolored], new_colors(int(uncolored.sum())))
+            ancestor_colors = lookup(i, div_parent)
+            if export_mode:
+                assign(i + 1, div_child1, child_ids)
+                assign(i + 1, div_child2, child_ids + 1)
+                divisions += zip([i] * len(div_parent), div_parent.tolist(), ancestor_colors.tolist(),
+                                 div_child1.tolist(), child_ids.tolist(),
+                                 div_child2.tolist(), (child_ids + 1).tolist())
+            else:
+                assign(i + 1, div_child1, ancestor_colors)
+                assign(i + 1, div_child2, ancestor_colors)
 
             for e in merger:
                 mergers[-1][int(e[0])] = int(e[1])
@@ -345,12 +351,18 @@ class OpTrackingBase(Operator, ExportingOperator):
 
         # mark the filtered objects
         for i in filtered_labels.keys():
-            if int(i) + time_range[0] >= len(label2color):
+            t = int(i) + time_range[0]
+            if t >= len(colors):
                 continue
-            fl_at = filtered_labels[i]
-            for l in fl_at:
-                assert l not in label2color[int(i) + time_range[0]]
-                label2color[int(i) + time_range[0]][l] = 0
+            fl_at = np.asarray(filtered_labels[i], dtype=np.int64)
+            assert (lookup(t, fl_at) < 0).all()
+            assign(t, fl_at, 0)
+
+        # Other users (GUI, export, subclasses) expect a dict per timestep
+        label2color = []
+        for colors_at in colors:
+            ids = np.flatnonzero(colors_at >= 0)
+            label2color.append(dict(zip(ids.tolist(), colors_at[ids].tolist())))
 
         if export_mode:  # don't set fields when in export_mode
             self.track_id = label2color
@@ -364,6 +376,16 @@ class OpTrackingBase(Operator, ExportingOperator):
         self.resolvedto = resolvedto
         self.mergers = mergers
 
+        # ...but execute() relabels with the dense arrays directly.
+        # Objects without a color are misdetections (1), the background stays 0.
+        label2color_luts = []
+        for colors_at in colors:
+            lut = np.where(colors_at >= 0, colors_at, 1)
+            if len(lut) > 0:
+                lut[0] = 0
+            label2color_luts.append(lut)
+        self._label2color_luts = label2color_luts
+
         self.Output._value = None
         self.Output.setDirty(slice(None))
 
@@ -455,13 +477,12 @@ class OpTrackingBase(Operator, ExportingOperator):
         empty_frame = False
 
         for t in feats.keys():
-            rc = feats[t][default_features_key]['RegionCenter']
-            lower = feats[t][default_features_key]['Coord<Minimum>']
-            upper = feats[t][default_features_key]['Coord<Maximum>']
-            if rc.size:
-                rc = rc[1:, ...]
-                lower = lower[1:, ...]
-                upper = upper[1:, ...]
+            # All features of this frame as contiguous arrays; the filtering is done on the whole frame at once.
+            try:
+                com, lower, upper, ct, inside = traxel_arrays_at(feats[t][default_features_key],
+                                                                 x_range, y_range, z_range, size_range)
+            except ValueError as e:
+                raise DatasetConstraintError("Tracking", str(e))
 
             if with_opt_correction:
                 try:
@@ -470,44 +491,38 @@ class OpTrackingBase(Operator, ExportingOperator):
                     raise Exception, 'Can not consider optical correction since it has not been computed before'
                 if rc_corr.size:
                     rc_corr = rc_corr[1:, ...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
-
-            logger.debug("at timestep {}, {} traxels found".format(t, rc.shape[0]))
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:
-                    x, y, z = rc[idx]
-                else:
-                    raise DatasetConstraintError ("Tracking", "The RegionCenter feature must have dimensionality 2 or 3.")
+                rc_corr = rc_corr.tolist()
+
+            logger.debug("at timestep {}, {} traxels found".format(t, len(ct)))
+            kept = np.flatnonzero(inside)
+            count = len(kept)
+            filtered_labels_at = (np.flatnonzero(~inside) + 1).tolist()
+
+            # Convert to python lists once per frame, instead of converting each value separately
+            com = com.tolist()
+            lower = lower.tolist()
+            upper = upper.tolist()
+            ct = ct.tolist()
+            if with_div:
+                # idx+1 because rc and ct start from 1, divProbs starts from 0
+                div_prob = np.asarray(divProbs[t], dtype=np.float64)[1:, 1].tolist()
+            if with_classifier_prior:
+                det_prob = clip_probabilities(np.asarray(detProbs[t])[1:]).tolist()
+
+            for idx in kept.tolist():
                 size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                            y < y_range[0] or y >= y_range[1] or
-                            z < z_range[0] or z >= z_range[1] or
-                            size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
                 tr = pgmlink.Traxel()
                 tr.set_feature_store(fs)
                 tr.set_x_scale(x_scale)
                 tr.set_y_scale(y_scale)
                 tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
+                tr.Id = idx + 1
                 tr.Timestep = int(t)
 
                 # pgmlink expects always 3 coordinates, z=0 for 2d data
                 tr.add_feature_array("com", 3)
-                for i, v in enumerate([x, y, z]):
-                    tr.set_feature_value('com', i, float(v))
+                for i, v in enumerate(com[idx]):
+                    tr.set_feature_value('com', i, v)
 
                 tr.add_feature_array("CoordMinimum", 3)
                 for i, v in enumerate(lower[idx]):
@@ -525,18 +540,12 @@ class OpTrackingBase(Operator, ExportingOperator):
 
                 if with_div:
                     tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx + 1][1]))
+                    tr.set_feature_value("divProb", 0, div_prob[idx])
 
                 if with_classifier_prior:
-                    tr.add_feature_array("detProb", len(detProbs[t][idx + 1]))
-                    for i, v in enumerate(detProbs[t][idx + 1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        tr.set_feature_value("detProb", i, float(val))
+                    tr.add_feature_array("detProb", len(det_prob[idx]))
+                    for i, v in enumerate(det_prob[idx]):
+                        tr.set_feature_value("detProb", i, v)
 
 
                 # FIXME: check whether it is 2d or 3d data!
@@ -559,7 +568,7 @@ class OpTrackingBase(Operator, ExportingOperator):
             if len(filtered_labels_at) > 0:
                 filtered_labels[str(int(t) - time_range[0])] = filtered_labels_at
             logger.debug("at timestep {}, {} traxels passed filter".format(t, count))
-            max_traxel_id_at.append(int(rc.shape[0]))
+            max_traxel_id_at.append(len(ct))
             if count == 0:
                 empty_frame = True
 
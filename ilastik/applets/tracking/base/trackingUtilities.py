@@ -26,31 +26,88 @@ import vigra
 import logging
 logger = logging.getLogger(__name__)
 
+def dict_to_lut(replace, size, default):
+    """
+    Convert a dict {label: value} to a dense lookup table of the given size.
+    Labels that are not in the dict (and label 0) are mapped to default (resp. 0).
+    Labels >= size are ignored.
+    """
+    lut = np.empty((size,), dtype=np.int64)
+    lut[:] = default
+    if len(replace) > 0:
+        keys = np.fromiter(replace.iterkeys(), dtype=np.int64, count=len(replace))
+        values = np.fromiter(replace.itervalues(), dtype=np.int64, count=len(replace))
+        inside = (keys >= 0) & (keys < size)
+        lut[keys[inside]] = values[inside]
+    if size > 0:
+        lut[0] = 0
+    return lut
+
+def relabel_with_lut(volume, lut, default):
+    """
+    Map a label volume through a dense lookup table (see dict_to_lut).
+    Labels beyond the end of the table are mapped to default, the background (0)
+    stays 0 even if the table is empty.
+    """
+    max_label = int(np.amax(volume)) if volume.size else 0
+    if max_label >= len(lut):
+        padded = np.empty((max_label + 1,), dtype=lut.dtype)
+        padded[:len(lut)] = lut
+        padded[len(lut):] = default
+        if len(lut) == 0:
+            padded[0] = 0
+        lut = padded
+    return lut.astype(volume.dtype)[volume]
+
 def relabel(volume, replace):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-    mp[1:] = 1
-    labels = np.sort(vigra.analysis.unique(volume))
-    for label in labels:
-        if label > 0:
-            try:
-                r = replace[label]
-                mp[label] = r
-            except:                
-                pass
-#    mp[replace.keys()] = replace.values()
-    return mp[volume]
+    size = int(np.amax(volume)) + 1 if volume.size else 1
+    return relabel_with_lut(volume, dict_to_lut(replace, size, 1), 1)
 
 def highlightMergers(volume, merger):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-    mp[:] = 0
-    labels = np.sort(vigra.analysis.unique(volume))
-    for label in labels:
-        if label > 0:
-            if label in merger:
-                mp[label] = merger[label]
-            else:
-                mp[label] = 0
-    return mp[volume]
+    size = int(np.amax(volume)) + 1 if volume.size else 1
+    return relabel_with_lut(volume, dict_to_lut(merger, size, 0), 0)
+
+def traxel_arrays_at(features_at, x_range, y_range, z_range, size_range):
+    """
+    Collect the features of all objects in one frame that are needed to build traxels,
+    as contiguous arrays without the background object.
+    features_at is the default features group (e.g. feats[t][default_features_key]).
+
+    Returns (com, lower, upper, count, inside), where com always has 3 columns (z=0 for 2d data),
+    and inside marks the objects within the given (half-open) coordinate and size ranges.
+    """
+    rc = np.asarray(features_at['RegionCenter'], dtype=np.float64)
+    lower = np.asarray(features_at['Coord<Minimum>'])
+    upper = np.asarray(features_at['Coord<Maximum>'])
+    if rc.size:
+        rc = rc[1:, ...]
+        lower = lower[1:, ...]
+        upper = upper[1:, ...]
+
+    count = np.asarray(features_at['Count'], dtype=np.float64).reshape(-1)
+    if count.size:
+        count = count[1:]
+
+    if len(count) == 0:
+        rc = np.zeros((0, 3))
+    else:
+        rc = rc.reshape((len(count), -1))
+    if rc.shape[1] not in (2, 3):
+        raise ValueError("The RegionCenter feature must have dimensionality 2 or 3.")
+    com = np.zeros((len(count), 3), dtype=np.float64)
+    com[:, :rc.shape[1]] = rc
+
+    range_lower = np.array([x_range[0], y_range[0], z_range[0]])
+    range_upper = np.array([x_range[1], y_range[1], z_range[1]])
+    inside = ((com >= range_lower) & (com < range_upper)).all(axis=1)
+    inside &= (count >= size_range[0]) & (count < size_range[1])
+    return com, lower, upper, count, inside
+
+def clip_probabilities(probs):
+    """
+    Keep probabilities away from 0 and 1, so the solver's -log() costs stay finite.
+    """
+    return np.clip(np.asarray(probs, dtype=np.float64), 0.0000001, 0.99999999)
 
 def get_dict_value(dic, key, default=[]):
     if key not in dic:
@@ -110,6 +110,10 @@ class ConservationTrackingGui(TrackingBaseGui, ExportingGui):
             self._drawer.maxNearestNeighborsSpinBox.setValue(parameters['max_nearest_neighbors'])
         if 'numFramesPerSplit' in parameters.keys():
             self._drawer.numFramesPerSplitSpinBox.setValue(parameters['numFramesPerSplit'])
+        if 'windowSize' in parameters.keys():
+            self._drawer.windowSizeSpinBox.setValue(parameters['windowSize'])
+        if 'windowOverlap' in parameters.keys():
+            self._drawer.windowOverlapSpinBox.setValue(parameters['windowOverlap'])
         
 
         # solver: use stored value only if that solver is available
@@ -232,6 +236,11 @@ class ConservationTrackingGui(TrackingBaseGui, ExportingGui):
         if not self.mainOperator.ObjectFeatures.ready():
             self._criticalMessage("You have to compute object features first.")            
             return
+
+        windowSize = self._drawer.windowSizeSpinBox.value()
+        if windowSize and windowSize <= self._drawer.windowOverlapSpinBox.value():
+            self._criticalMessage("The tracking windows must be larger than their overlap.")
+            return
         
         def _track():    
             self.applet.busy = True
@@ -312,6 +321,8 @@ class ConservationTrackingGui(TrackingBaseGui, ExportingGui):
                     force_build_hypotheses_graph =False,
                     max_nearest_neighbors=self._drawer.maxNearestNeighborsSpinBox.value(),
                     numFramesPerSplit=self._drawer.numFramesPerSplitSpinBox.value(),
+                    windowSize=self._drawer.windowSizeSpinBox.value(),
+                    windowOverlap=self._drawer.windowOverlapSpinBox.value(),
                     solverName=solver
                     )
 
@@ -12,6 +12,8 @@ from lazyflow.operators import OpBlockedArrayCache
 from lazyflow.operators.valueProviders import OpZeroDefault
 from lazyflow.roi import sliceToRoi
 from opRelabeledMergerFeatureExtraction import OpRelabeledMergerFeatureExtraction
+from ilastik.applets.tracking.base.trackingUtilities import traxel_arrays_at, clip_probabilities
+from windowedTracking import trackWindowed
 
 from functools import partial
 from lazyflow.request import Request, RequestPool
@@ -352,11 +354,16 @@ class OpConservationTracking(Operator):
             force_build_hypotheses_graph = False,
             max_nearest_neighbors = 2,
             numFramesPerSplit=1000,
+            windowSize=0,
+            windowOverlap=10,
             withBatchProcessing = False,
             solverName="Flow-based"
             ):
         """
         Main conservation tracking function. Runs tracking solver, generates hypotheses graph, and resolves mergers.
+
+        If windowSize is given, the solver is run on overlapping time windows of that many frames
+        (sharing windowOverlap frames), which are solved in parallel and stitched (see windowedTracking.py).
         """
         
         if not self.Parameters.ready():
@@ -394,6 +401,8 @@ class OpConservationTracking(Operator):
         parameters['z_range'] = z_range
         parameters['max_nearest_neighbors'] = max_nearest_neighbors
         parameters['numFramesPerSplit'] = numFramesPerSplit
+        parameters['windowSize'] = windowSize
+        parameters['windowOverlap'] = windowOverlap
         parameters['solver'] = str(solverName)
 
         # Set a size range with a minimum area equal to the max number of objects (since the GMM throws an error if we try to fit more gaussians than the number of pixels in the object)
@@ -433,7 +442,11 @@ class OpConservationTracking(Operator):
         detWeight = 10.0 # FIXME: Should we store this weight in the parameters slot?
         weights = trackingGraph.weightsListToDict([transWeight, detWeight, divWeight, appearance_cost, disappearance_cost])
 
-        if solverName == 'Flow-based' and dpct:
+        if windowSize and solverName == 'Flow-based' and dpct:
+            result = trackWindowed(model, weights, dpct.trackFlowBased, windowSize, windowOverlap)
+        elif windowSize and solverName == 'ILP' and mht:
+            result = trackWindowed(model, weights, mht.track, windowSize, windowOverlap)
+        elif solverName == 'Flow-based' and dpct:
             if numFramesPerSplit:
                 # Run solver with frame splits (split, solve, and stitch video to improve running-time)
                 from hytra.core.splittracking import SplitTracking 
@@ -696,43 +709,32 @@ class OpConservationTracking(Operator):
         empty_frame = False
 
         for t in feats.keys():
-            rc = feats[t][default_features_key]['RegionCenter']
-            lower = feats[t][default_features_key]['Coord<Minimum>']
-            upper = feats[t][default_features_key]['Coord<Maximum>']
-            if rc.size:
-                rc = rc[1:, ...]
-                lower = lower[1:, ...]
-                upper = upper[1:, ...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
-
-            logger.debug("at timestep {}, {} traxels found".format(t, rc.shape[0]))
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
+            # All features of this frame as contiguous arrays; the filtering is done on the whole frame at once.
+            try:
+                com, lower, upper, count, inside = traxel_arrays_at(feats[t][default_features_key],
+                                                                    x_range, y_range, z_range, size_range)
+            except ValueError as e:
+                raise DatasetConstraintError("Tracking", str(e))
+            logger.debug("at timestep {}, {} traxels found".format(t, len(count)))
+
+            kept = np.flatnonzero(inside)
+            filtered_labels_at = (np.flatnonzero(~inside) + 1).tolist()
+
+            # Convert to python lists once per frame, instead of converting each value separately
+            com = com.tolist()
+            lower = lower.tolist()
+            upper = upper.tolist()
+            count = count.tolist()
+            if with_div:
+                # idx+1 because rc and ct start from 1, divProbs starts from 0
+                div_prob = clip_probabilities(np.asarray(divProbs[t])[1:, 1]).tolist()
+            if with_classifier_prior:
+                det_prob = clip_probabilities(np.asarray(detProbs[t])[1:]).tolist()
+
+            traxels_at = {}
+            for idx in kept.tolist():
                 traxel = Traxel()
-                
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:
-                    x, y, z = rc[idx]
-                else:
-                    raise DatasetConstraintError ("Tracking", "The RegionCenter feature must have dimensionality 2 or 3.")
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                            y < y_range[0] or y >= y_range[1] or
-                            z < z_range[0] or z >= z_range[1] or
-                            size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
-                
-                traxel.Id = int(idx + 1)
+                traxel.Id = idx + 1
                 traxel.Timestep = int(t) 
                 traxel.set_x_scale(x_scale)
                 traxel.set_y_scale(y_scale)
@@ -740,8 +742,8 @@ class OpConservationTracking(Operator):
 
                 # Expects always 3 coordinates, z=0 for 2d data
                 traxel.add_feature_array("com", 3)
-                for i, v in enumerate([x, y, z]):
-                    traxel.set_feature_value('com', i, float(v))
+                for i, v in enumerate(com[idx]):
+                    traxel.set_feature_value('com', i, v)
 
                 traxel.add_feature_array("CoordMinimum", 3)
                 for i, v in enumerate(lower[idx]):
@@ -752,25 +754,13 @@ class OpConservationTracking(Operator):
 
                 if with_div:
                     traxel.add_feature_array("divProb", 2)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    prob = float(divProbs[t][idx + 1][1])
-                    prob = float(prob)
-                    if prob < 0.0000001:
-                        prob = 0.0000001
-                    if prob > 0.99999999:
-                        prob = 0.99999999
-                    traxel.set_feature_value("divProb", 0, 1.0 - prob)
-                    traxel.set_feature_value("divProb", 1, prob)
+                    traxel.set_feature_value("divProb", 0, 1.0 - div_prob[idx])
+                    traxel.set_feature_value("divProb", 1, div_prob[idx])
 
                 if with_classifier_prior:
-                    traxel.add_feature_array("detProb", len(detProbs[t][idx + 1]))
-                    for i, v in enumerate(detProbs[t][idx + 1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        traxel.set_feature_value("detProb", i, float(val))
+                    traxel.add_feature_array("detProb", len(det_prob[idx]))
+                    for i, v in enumerate(det_prob[idx]):
+                        traxel.set_feature_value("detProb", i, v)
 
                 # FIXME: check whether it is 2d or 3d data!
                 if with_local_centers:                   
@@ -784,27 +774,22 @@ class OpConservationTracking(Operator):
                         traxel.set_feature_value("localCentersZ", i, float(v[2]))
                 
                 traxel.add_feature_array("count", 1)
-                traxel.set_feature_value("count", 0, float(size))
-
-                # Add traxel to traxelstore after checking position, time, and size ranges
-                if (x < x_range[0] or x >= x_range[1] or
-                            y < y_range[0] or y > y_range[1] or
-                            z < z_range[0] or z > z_range[1] or
-                            size < size_range[0] or size > size_range[1]):
-                    logger.info("Omitting traxel with ID: {}".format(traxel.Id))
-                else:
-                    traxelstore.TraxelsPerFrame.setdefault(int(t), {})[int(idx + 1)] = traxel
+                traxel.set_feature_value("count", 0, count[idx])
+
+                traxels_at[idx + 1] = traxel
 
+            if traxels_at:
+                traxelstore.TraxelsPerFrame.setdefault(int(t), {}).update(traxels_at)
             if len(filtered_labels_at) > 0:
                 filtered_labels[str(int(t) - time_range[0])] = filtered_labels_at
                 
-            logger.debug("at timestep {}, {} traxels passed filter".format(t, count))
+            logger.debug("at timestep {}, {} traxels passed filter".format(t, len(kept)))
 
-            if count == 0:
+            if len(kept) == 0:
                 empty_frame = True
                 logger.info('Found empty frames')
 
-            total_count += count
+            total_count += len(kept)
 
         self.FilteredLabels.setValue(filtered_labels, check_changed=True)
 
@@ -0,0 +1,272 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Windowed conservation tracking for long movies.
+
+The tracking model (in the hytra JSON format) is split into overlapping time windows,
+which are solved independently (in parallel on the request pool).  The solutions are
+stitched in the middle of each overlap: every frame takes its detections (and the
+links and divisions that start in it) from exactly one window, namely the one in
+which that frame is farthest from the window borders.
+
+Objects in the first (last) frame of a window may appear (disappear) for free,
+just like objects at the start (end) of the whole movie.
+"""
+import copy
+import logging
+from functools import partial
+
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+def uuidTimesteps(model):
+    """
+    Map every hypothesis uuid in the model to the (first, last) timestep it covers.
+    (With tracklets, one hypothesis can cover several timesteps.)
+    """
+    timesteps = {}
+    for t, traxels in model['traxelToUniqueId'].iteritems():
+        t = int(t)
+        for uuid in traxels.itervalues():
+            first, last = timesteps.get(uuid, (t, t))
+            timesteps[uuid] = (min(first, t), max(last, t))
+    return timesteps
+
+def computeWindows(t_begin, t_end, window_size, overlap):
+    """
+    Split the frames [t_begin, t_end) into windows [start, stop) of (at most) window_size frames,
+    where consecutive windows share overlap frames.  Returns a list of (start, stop, own_start, own_stop):
+    the frames [own_start, own_stop) take their solution from this window.
+    """
+    assert window_size > overlap >= 2, "Windows must be larger than their overlap, which needs at least 2 frames"
+    windows = []
+    start = t_begin
+    while True:
+        stop = min(start + window_size, t_end)
+        windows.append([start, stop])
+        if stop >= t_end:
+            break
+        start = stop - overlap
+
+    result = []
+    for i, (start, stop) in enumerate(windows):
+        own_start = t_begin if i == 0 else (start + windows[i-1][1]) // 2
+        own_stop = t_end if i == len(windows) - 1 else (windows[i+1][0] + stop) // 2
+        result.append( (start, stop, own_start, own_stop) )
+    return result
+
+def extractWindow(model, timesteps, start, stop, freeAppearance=True, freeDisappearance=True):
+    """
+    Return the part of the model with all hypotheses that lie within the frames [start, stop).
+    If requested, appearance at the first and disappearance at the last frame of the window are free
+    (which should be the case wherever the window border is not the border of the whole movie).
+    """
+    def inside(uuid):
+        first, last = timesteps[uuid]
+        return start <= first and last < stop
+
+    window = dict( (k, v) for k, v in model.iteritems()
+                   if k not in ('segmentationHypotheses', 'linkingHypotheses', 'divisionHypotheses',
+                                'exclusions', 'traxelToUniqueId') )
+
+    segmentations = []
+    for hypothesis in model['segmentationHypotheses']:
+        if not inside(hypothesis['id']):
+            continue
+        first, last = timesteps[hypothesis['id']]
+        zeroAppearance = freeAppearance and first == start and 'appearanceFeatures' in hypothesis
+        zeroDisappearance = freeDisappearance and last == stop - 1 and 'disappearanceFeatures' in hypothesis
+        if zeroAppearance or zeroDisappearance:
+            hypothesis = copy.copy(hypothesis)
+            if zeroAppearance:
+                hypothesis['appearanceFeatures'] = [[0.0] * len(f) for f in hypothesis['appearanceFeatures']]
+            if zeroDisappearance:
+                hypothesis['disappearanceFeatures'] = [[0.0] * len(f) for f in hypothesis['disappearanceFeatures']]
+        segmentations.append(hypothesis)
+    window['segmentationHypotheses'] = segmentations
+
+    window['linkingHypotheses'] = [ l for l in model.get('linkingHypotheses', [])
+                                    if inside(l['src']) and inside(l['dest']) ]
+    if 'divisionHypotheses' in model:
+        window['divisionHypotheses'] = [ d for d in model['divisionHypotheses']
+                                         if inside(d['parent']) and all(inside(c) for c in d['children']) ]
+    if 'exclusions' in model:
+        window['exclusions'] = [ e for e in model['exclusions'] if all(inside(uuid) for uuid in e) ]
+    window['traxelToUniqueId'] = dict( (t, traxels) for t, traxels in model['traxelToUniqueId'].iteritems()
+                                       if start <= int(t) < stop )
+    return window
+
+def _owningTimestep(entry, timesteps):
+    """
+    The timestep that decides which window an entry of a result is taken from:
+    the node itself, or the source of a link.
+    """
+    if 'src' in entry:
+        return timesteps[entry['src']][1]
+    return timesteps[entry['id']][0]
+
+def _crossesCut(link, cut, timesteps):
+    """
+    True if the link starts before the frame cut and ends in or after it.
+    """
+    return timesteps[link['src']][1] < cut <= timesteps[link['dest']][0]
+
+def reconcileCut(before, after, cut, timesteps, links, detections, divisions):
+    """
+    Choose the links that cross the cut between two neighboring windows.
+
+    The detections before the cut come from the window before, the ones after the cut from the window after,
+    so neither window's crossing links necessarily fit both ends.  Links both windows agree on are taken first,
+    then the remaining links of the window before and the window after, each only as far as the
+    (so far unused) values of its source and destination detections allow.  Links that don't fit are dropped,
+    and divisions that lost a child link are turned off, so the stitched flow is conserved.
+
+    :param before, after: results of the windows before and after the cut
+    :param links: the stitched links that don't cross any cut
+    :param detections: the stitched detection values (uuid -> value)
+    :param divisions: the stitched division values (uuid -> bool), will be updated
+    :returns: the list of crossing links (of both windows, with the chosen values)
+    """
+    def crossing(result):
+        return dict( ( (l['src'], l['dest']), l['value'] ) for l in result.get('linkingResults', [])
+                     if _crossesCut(l, cut, timesteps) )
+    links_before = crossing(before)
+    links_after = crossing(after)
+    agreed = dict( (key, min(value, links_after[key])) for key, value in links_before.iteritems() if key in links_after )
+
+    outgoing = {}
+    incoming = {}
+    for l in links:
+        outgoing[l['src']] = outgoing.get(l['src'], 0) + l['value']
+        incoming[l['dest']] = incoming.get(l['dest'], 0) + l['value']
+    def out_left(uuid):
+        return detections.get(uuid, 0) + int(bool(divisions.get(uuid, False))) - outgoing.get(uuid, 0)
+    def in_left(uuid):
+        return detections.get(uuid, 0) - incoming.get(uuid, 0)
+
+    accepted = {}
+    for candidates in (agreed, links_before, links_after):
+        for (src, dest), value in sorted(candidates.iteritems()):
+            amount = min( value - accepted.get((src, dest), 0), out_left(src), in_left(dest) )
+            if amount > 0:
+                accepted[(src, dest)] = accepted.get((src, dest), 0) + amount
+                outgoing[src] = outgoing.get(src, 0) + amount
+                incoming[dest] = incoming.get(dest, 0) + amount
+
+    # A division needs one more outgoing link than the parent's value
+    for src in set( src for src, _ in links_before ):
+        if divisions.get(src, False) and out_left(src) > 0:
+            divisions[src] = False
+            excess = -out_left(src)
+            for key in sorted( key for key in accepted if key[0] == src ):
+                if excess <= 0:
+                    break
+                amount = min( excess, accepted[key] )
+                accepted[key] -= amount
+                outgoing[src] -= amount
+                incoming[key[1]] -= amount
+                excess -= amount
+
+    dropped = sum( max(links_before.get(key, 0), links_after.get(key, 0)) - accepted.get(key, 0)
+                   for key in set(links_before) | set(links_after) )
+    if dropped:
+        logger.info( "Dropped {} link units at the window cut before frame {}, "
+                     "where the windows disagree".format( dropped, cut ) )
+    return [ { 'src' : src, 'dest' : dest, 'value' : accepted.get((src, dest), 0) }
+             for src, dest in sorted( set(links_before) | set(links_after) ) ]
+
+def stitchResults(window_results, windows, timesteps):
+    """
+    Combine the per-window results into one result for the whole model.
+    The links that cross the cut between two windows are reconciled with reconcileCut().
+    """
+    cuts = [ own_stop for (_, _, _, own_stop) in windows[:-1] ]
+    stitched = {}
+    for result, (_, _, own_start, own_stop) in zip(window_results, windows):
+        for key, entries in result.iteritems():
+            if not isinstance(entries, list):
+                continue
+            owned = [ e for e in entries if own_start <= _owningTimestep(e, timesteps) < own_stop ]
+            if key == 'linkingResults':
+                owned = [ l for l in owned if not any( _crossesCut(l, cut, timesteps) for cut in cuts ) ]
+            stitched.setdefault(key, []).extend(owned)
+
+    detections = dict( (e['id'], e['value']) for e in stitched.get('detectionResults', []) )
+    divisions = dict( (e['id'], e['value']) for e in stitched.get('divisionResults', []) )
+    non_crossing = stitched.get('linkingResults', [])
+    crossing = []
+    for i, cut in enumerate(cuts):
+        crossing += reconcileCut( window_results[i], window_results[i+1], cut, timesteps,
+                                  non_crossing + crossing, detections, divisions )
+    stitched['linkingResults'] = non_crossing + crossing
+    if 'divisionResults' in stitched:
+        stitched['divisionResults'] = [ dict(e, value=divisions[e['id']]) for e in stitched['divisionResults'] ]
+
+    # Report where neighboring windows disagree about the shared frames
+    for i in range(len(windows) - 1):
+        overlap_start, overlap_stop = windows[i+1][0], windows[i][1]
+        values = []
+        for result in window_results[i:i+2]:
+            values.append( dict( (e['id'], e['value']) for e in result.get('detectionResults', [])
+                                 if overlap_start <= timesteps[e['id']][0] < overlap_stop ) )
+        disagreements = [ uuid for uuid in values[0] if uuid in values[1] and values[0][uuid] != values[1][uuid] ]
+        if disagreements:
+            logger.info( "Windows {} and {} disagree on {} of {} detections in frames [{}, {})"
+                         .format( i, i+1, len(disagreements), len(values[0]), overlap_start, overlap_stop ) )
+    return stitched
+
+def trackWindowed(model, weights, solver, window_size, overlap=10):
+    """
+    Solve the given tracking model in overlapping time windows and stitch the results.
+
+    :param model: tracking model in the hytra JSON format (e.g. from TrackingGraph.model)
+    :param weights: weights dict as expected by the solver
+    :param solver: function solver(model, weights) -> result, e.g. dpct.trackFlowBased
+    :param window_size: number of frames per window
+    :param overlap: number of frames shared by consecutive windows
+    :return: the stitched result, in the same format as the solver's result
+    """
+    timesteps = uuidTimesteps(model)
+    if not timesteps:
+        return solver(model, weights)
+    t_begin = min(first for first, _ in timesteps.itervalues())
+    t_end = max(last for _, last in timesteps.itervalues()) + 1
+    windows = computeWindows(t_begin, t_end, window_size, overlap)
+    if len(windows) == 1:
+        return solver(model, weights)
+
+    logger.info( "Tracking {} frames in {} windows of {} frames".format( t_end - t_begin, len(windows), window_size ) )
+    window_results = [None] * len(windows)
+    def solveWindow(i):
+        start, stop, _, _ = windows[i]
+        window = extractWindow( model, timesteps, start, stop,
+                                freeAppearance=(start > t_begin), freeDisappearance=(stop < t_end) )
+        window_results[i] = solver( window, weights )
+        logger.debug( "Solved window {} (frames [{}, {}))".format( i, start, stop ) )
+
+    pool = RequestPool()
+    for i in range(len(windows)):
+        pool.add( Request( partial(solveWindow, i) ) )
+    pool.wait()
+    pool.clean()
+
+    return stitchResults(window_results, windows, timesteps)
@@ -293,11 +293,7 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
 
         activeTrackBox.clear()
 
-        allTracks = set()
-        for t in self.mainOperator.labels.keys():            
-            for oid in self.mainOperator.labels[t].keys():
-                for tr in list(self.mainOperator.labels[t][oid]):
-                    allTracks.add(tr)        
+        allTracks = set(self.mainOperator.allTracks())
         
         items = set()
         for idx in range(activeTrackBox.count()):
@@ -425,10 +421,7 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
         t = position5d[0]
         activeTrack = self._getActiveTrack()
         
-        trackids = []
-        if t in self.mainOperator.labels.keys() and oid in self.mainOperator.labels[t].keys():
-            for l in self.mainOperator.labels[t][oid]:
-                trackids.append(l)
+        trackids = list(self.mainOperator.tracksAt(t, oid))
         
         title = "Object " + str(oid)
         if len(trackids) == 0:
@@ -497,9 +490,8 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
             track2remove = delSubtrackToEnd[selection]
             maxt = self.mainOperator.LabelImage.meta.shape[0]
             for time in range(t,maxt):
-                for oid in self.mainOperator.labels[time].keys():
-                    if track2remove in self.mainOperator.labels[time][oid]:
-                        self._delLabel(time, oid, track2remove)
+                for oid in list(self.mainOperator.objectsOfTrack(track2remove, time)):
+                    self._delLabel(time, oid, track2remove)
             
             self._setDirty(self.mainOperator.TrackImage, range(t,maxt))
             self._setDirty(self.mainOperator.UntrackedImage, range(t, maxt))
@@ -508,9 +500,8 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
         elif selection in delSubtrackToStart.keys():
             track2remove = delSubtrackToStart[selection]
             for time in range(0,t+1):
-                for oid in self.mainOperator.labels[time].keys():
-                    if track2remove in self.mainOperator.labels[time][oid]:
-                        self._delLabel(time, oid, track2remove)
+                for oid in list(self.mainOperator.objectsOfTrack(track2remove, time)):
+                    self._delLabel(time, oid, track2remove)
             
             self._setDirty(self.mainOperator.TrackImage, range(0,t+1))
             self._setDirty(self.mainOperator.UntrackedImage, range(0,t+1))
@@ -581,7 +572,7 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
             self._gotoObject(oid, t)
             return False
         
-        self.mainOperator.labels[t][oid].remove(track2remove)
+        self.mainOperator.removeLabel(t, oid, track2remove)
         self._setDirty(self.mainOperator.Labels, [t])
         self._setDirty(self.mainOperator.TrackImage, [t])
         self._setDirty(self.mainOperator.UntrackedImage, [t])
@@ -597,13 +588,12 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
 
         affectedT = []
         success = True
-        for t in self.mainOperator.labels.keys():
-            for oid in self.mainOperator.labels[t].keys():
-                if track2remove in self.mainOperator.labels[t][oid]:
-                    if self._delLabel(t,oid,track2remove):                    
-                        affectedT.append(t)
-                    else:
-                        success = False
+        for t, oids in self.mainOperator.objectsOfTrack(track2remove).items():
+            for oid in list(oids):
+                if self._delLabel(t,oid,track2remove):                    
+                    affectedT.append(t)
+                else:
+                    success = False
         
         if success:
             activeTrackBox.removeItem(idx2remove)
@@ -614,25 +604,21 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
             self._setDirty(self.mainOperator.Labels, affectedT)
     
     def _addObjectToTrack(self, activeTrack, oid, t):
-        if t not in self.mainOperator.labels.keys():
-            self.mainOperator.labels[t] = {}
-        if oid not in self.mainOperator.labels[t].keys():
-            self.mainOperator.labels[t][oid] = set()
+        tracks = self.mainOperator.tracksAt(t, oid)
         if activeTrack == self.misdetIdx:
-            if len(self.mainOperator.labels[t][oid]) > 0:
+            if len(tracks) > 0:
                 self._criticalMessage("Error: This object is already marked as part of a track, cannot mark it as a misdetection.")            
                 return -1
         else:
-            for tracklist in self.mainOperator.labels[t].values():
-                if activeTrack in tracklist:                    
-                    self._criticalMessage("Error: There is already an object with this track id in this time step")            
-                    return -1
+            if len(self.mainOperator.objectsOfTrack(activeTrack, t)) > 0:
+                self._criticalMessage("Error: There is already an object with this track id in this time step")            
+                return -1
         
-        if self.misdetIdx in self.mainOperator.labels[t][oid]:
+        if self.misdetIdx in tracks:
             self._criticalMessage("Error: This object is already marked as a misdetection. Cannot mark it as part of a track.")            
             return -1
         
-        self.mainOperator.labels[t][oid].add(activeTrack)  
+        self.mainOperator.addLabel(t, oid, activeTrack)
         self._setDirty(self.mainOperator.Labels, [t])
         self._log('(t,object_id,track_id) = ' + str((t,oid, activeTrack)) + ' added.')
         
@@ -757,17 +743,12 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
         parent = int(str(self._drawer.divisionsList.currentItem().text()).split(':')[0])
         t = self.mainOperator.divisions[parent][1]        
                 
-        found = False
-        for oid in self.mainOperator.labels[t].keys():
-            if parent in self.mainOperator.labels[t][oid]:
-                found = True
-                break
-        
-        if not found:
+        oids = self.mainOperator.objectsOfTrack(parent, t)
+        if len(oids) == 0:
             self._criticalMessage("Error: Cannot find the division label.")
             return
         
-        self._gotoObject(oid, t)
+        self._gotoObject(min(oids), t)
     
 
     def _onMarkMisdetectionPressed(self):
@@ -1117,12 +1098,6 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
         def _export():
             self.applet.busy = True
             self.applet.appletStateUpdateRequested.emit()
-            divisions = self.mainOperator.divisions
-            inverseDivisions = {}
-            for k, vals in divisions.items():
-                for v in vals[0]:
-                    inverseDivisions[v] = k
-            replace = {}
             activeTrackBox = self._drawer.activeTrackBox
             tids = set()
             for idx in range(activeTrackBox.count()):
@@ -1135,15 +1110,9 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
                 tids.remove(0)
             if -1 in tids:
                 tids.remove(-1)
-            for tid in tids:
-                replace[tid] = [tid] # identity
-                
-            for tid in inverseDivisions.keys():
-                rootTid = inverseDivisions[tid]
-                while rootTid in inverseDivisions.keys():
-                    rootTid = inverseDivisions[rootTid]
-                replace[tid] = [rootTid]
-                    
+            # each track is labeled with the id of the track it descends from
+            lineages = self.mainOperator.lineageIds(tids)
+
             shape = list(self.mainOperator.TrackImage.meta.shape)
             num_files = float(shape[0]-1)
             for t in range(shape[0]):
@@ -1151,7 +1120,7 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
                 
                 roi = SubRegion(self.mainOperator.TrackImage, start=[t,] + 4*[0,], stop=[t+1,] + list(shape[1:]))
                 trackImage = self.mainOperator.TrackImage.get(roi).wait()
-                relabeled = self.mainOperator._relabel(trackImage[0,...,0], replace)
+                relabeled = self.mainOperator.relabelToLineages(trackImage[0,...,0], lineages)
                 for i in range(relabeled.shape[2]):
                     out_im = relabeled[:,:,i]
                     out_fn = str(directory) + '/vis_t' + str(t).zfill(4) + '_z' + str(i).zfill(4) + '.tif'
@@ -1202,17 +1171,12 @@ class ManualTrackingGui(LayerViewerGui, ExportingGui):
             self._criticalMessage("Error: Cannot access time step "  + str(t) + ".")
             return
         
-        found = False
-        for oid in self.mainOperator.labels[t].keys():
-            if tid in self.mainOperator.labels[t][oid]:
-                found = True
-                break
-        
-        if not found:
+        oids = self.mainOperator.objectsOfTrack(tid, t)
+        if len(oids) == 0:
             self._criticalMessage("Error: Cannot find track id " + str(tid) + " at time " + str(t) + ".")
             return
           
-        self._gotoObject(oid, t)
+        self._gotoObject(min(oids), t)
 
 
     @threadRouted
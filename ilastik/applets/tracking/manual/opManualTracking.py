@@ -20,17 +20,17 @@
 ###############################################################################
 from ilastik.applets.base.applet import DatasetConstraintError
 from ilastik.utility.exportingOperator import ExportingOperator
-from ilastik.utility.exportFile import objects_per_frame, ExportFile, ilastik_ids, Mode, Default
+from ilastik.utility.exportFile import ExportFile, ilastik_ids, Mode, Default
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.tracking.base.trackingUtilities import relabel_with_lut, dict_to_lut
 from operator import itemgetter
 from itertools import compress
-from functools import partial
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.rtype import List, SubRegion
+from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 
 import numpy as np
-import vigra
 
 import os
 import logging
@@ -82,8 +82,59 @@ class OpManualTracking(Operator, ExportingOperator):
         self.UntrackedImage.meta.assignFrom(self.LabelImage.meta)
 
         for t in range(self.LabelImage.meta.shape[0]):
-            if t not in self.labels.keys():
-                self.labels[t] = {}
+            self._labels.setdefault(t, {})
+
+    # The annotations are kept as self.labels[t][oid] = set(track ids).
+    # Edit them only via addLabel()/removeLabel() (or by assigning a new dict
+    # to self.labels), so the track index and the lookup tables stay in sync.
+    @property
+    def labels(self):
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        self._labels = labels
+        # track id -> {t: set(object ids)}
+        self._tid2oids = {}
+        for t, labels_at in labels.iteritems():
+            for oid, tids in labels_at.iteritems():
+                for tid in tids:
+                    self._tid2oids.setdefault(tid, {}).setdefault(t, set()).add(oid)
+        # t -> (track image lut, untracked image lut)
+        self._luts = {}
+
+    def addLabel(self, t, oid, tid):
+        self._labels.setdefault(t, {}).setdefault(oid, set()).add(tid)
+        self._tid2oids.setdefault(tid, {}).setdefault(t, set()).add(oid)
+        self._luts.pop(t, None)
+
+    def removeLabel(self, t, oid, tid):
+        self._labels[t][oid].remove(tid)
+        oids_of_track = self._tid2oids[tid]
+        oids_of_track[t].discard(oid)
+        if len(oids_of_track[t]) == 0:
+            del oids_of_track[t]
+            if len(oids_of_track) == 0:
+                del self._tid2oids[tid]
+        self._luts.pop(t, None)
+
+    def tracksAt(self, t, oid):
+        """
+        Return the set of track ids of the given object (empty if it isn't annotated).
+        """
+        return self._labels.get(t, {}).get(oid, set())
+
+    def objectsOfTrack(self, tid, t=None):
+        """
+        Return {t: set(object ids)} for the given track id,
+        or only the set of object ids at time t if t is given.
+        """
+        if t is None:
+            return self._tid2oids.get(tid, {})
+        return self._tid2oids.get(tid, {}).get(t, set())
+
+    def allTracks(self):
+        return self._tid2oids.keys()
         
     def _checkConstraints(self, *args):
         if self.RawImage.ready():
@@ -128,21 +179,19 @@ class OpManualTracking(Operator, ExportingOperator):
                 result[t] = self.labels[t]
 
         elif slot is self.TrackImage:
+            result[:] = self.LabelImage.get(roi).wait()
             for t in range(roi.start[0], roi.stop[0]):
-                if t not in self.labels.keys():
-                    result[t - roi.start[0], ...][:] = 0
-                    return result
-
-                result[t - roi.start[0], ...] = self.LabelImage.get(roi).wait()[t - roi.start[0], ...]
-                result[t - roi.start[0], ..., 0] = self._relabel(result[t - roi.start[0], ..., 0], self.labels[t])
+                if t not in self._labels:
+                    result[t - roi.start[0], ...] = 0
+                    continue
+                track_lut, _ = self._lutsAt(t)
+                result[t - roi.start[0], ..., 0] = relabel_with_lut(result[t - roi.start[0], ..., 0], track_lut, 0)
 
         elif slot is self.UntrackedImage:
+            result[:] = self.LabelImage.get(roi).wait()
             for t in range(roi.start[0], roi.stop[0]):
-                result[t - roi.start[0], ...] = self.LabelImage.get(roi).wait()[t - roi.start[0], ...]
-                labels_at = {}
-                if t in self.labels.keys():
-                    labels_at = self.labels[t]
-                result[t - roi.start[0], ..., 0] = self._relabelUntracked(result[t - roi.start[0], ..., 0], labels_at)
+                _, untracked_lut = self._lutsAt(t)
+                result[t - roi.start[0], ..., 0] = relabel_with_lut(result[t - roi.start[0], ..., 0], untracked_lut, 1)
 
         return result
 
@@ -151,55 +200,51 @@ class OpManualTracking(Operator, ExportingOperator):
             self.labels = {}
             self.divisions = {}
 
-    def _relabel(self, volume, replace):
-        mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-        mp[1:] = 0
-        labels = np.sort(vigra.analysis.unique(volume)).tolist()
-        if 0 in labels:
-            labels.remove(0)
-        for label in labels:
-            if label in replace and len(replace[label]) > 0:
-                l = list(replace[label])[-1]
-                if l == -1:
-                    mp[label] = 2 ** 16 - 1
-                else:
-                    mp[label] = l
-        return mp[volume]
-
-    def _relabelUntracked(self, volume, tracked_at):
-        mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-        mp[1:] = 1
-        labels = np.sort(vigra.analysis.unique(volume)).tolist()
-        if 0 in labels:
-            labels.remove(0)
-        for label in labels:
-            if (label in tracked_at.keys()) and (len(tracked_at[label]) > 0):
-                mp[label] = 0
-        return mp[volume]
+    def _lutsAt(self, t):
+        """
+        Return the lookup tables (indexed by object id) for the track image
+        and for the untracked image at time t.
+        """
+        luts = self._luts.get(t)
+        if luts is None:
+            labels_at = self._labels.get(t, {})
+            size = max(labels_at.keys()) + 1 if labels_at else 1
+            track_lut = np.zeros((size,), dtype=np.int64)
+            untracked_lut = np.ones((size,), dtype=np.int64)
+            untracked_lut[0] = 0
+            for oid, tids in labels_at.iteritems():
+                if len(tids) > 0:
+                    tid = list(tids)[-1]
+                    track_lut[oid] = 2 ** 16 - 1 if tid == -1 else tid
+                    untracked_lut[oid] = 0
+            luts = (track_lut, untracked_lut)
+            self._luts[t] = luts
+        return luts
 
     def _getObjects(self, trange, misdet_idx):
-        filtered_labels = {}
         oid2tids = {}
         alltids = set()
         for t in range(trange[0], trange[1]):
             count = 0
-            filtered_labels[t] = []
             oid2tids[t] = {}
-            troi = SubRegion(self.LabelImage, start=[t, ] + [0, ] * len(self.LabelImage.meta.shape[1:]),
-                             stop=[t + 1, ] + list(self.LabelImage.meta.shape[1:]))
-            max_oid = np.max(self.LabelImage.get(troi).wait())
-            for idx in range(max_oid + 1):
-                oid = int(idx) + 1
-                if t in self.labels.keys() and oid in self.labels[t].keys():
-                    if misdet_idx not in self.labels[t][oid]:
-                        oid2tids[t][oid] = self.labels[t][oid]
-                        for l in self.labels[t][oid]:
-                            alltids.add(l)
-                        count += 1
+            for oid, tids in self._labels.get(t, {}).iteritems():
+                if misdet_idx not in tids:
+                    oid2tids[t][oid] = tids
+                    alltids.update(tids)
+                    count += 1
 
             logger.info("at timestep {}, {} traxels found".format(t, count))
         return oid2tids, alltids
 
+    def _objectsPerFrame(self):
+        """
+        Number of objects in each frame, taken from the region features
+        (which have one row for the background).
+        """
+        num_frames = self.LabelImage.meta.shape[0]
+        feats = self.ObjectFeatures(range(num_frames)).wait()
+        return [max(len(feats[t][default_features_key]['Count']) - 1, 0) for t in range(num_frames)]
+
     def save_export_progress_dialog(self, dialog):
         """
         Implements ExportOperator.save_export_progress_dialog
@@ -208,13 +253,36 @@ class OpManualTracking(Operator, ExportingOperator):
         """
         self.export_progress_dialog = dialog
 
-    @staticmethod
-    def lookup_oid_for_tid(oid2tid, tid, t):
-        mapping = oid2tid[t]
-        for oid, tids in mapping.iteritems():
-            if tid in tids:
-                return oid
-        raise ValueError("TID {} at t={} not found!".format(tid, t))
+    def lookup_oid_for_tid(self, tid, t):
+        oids = self.objectsOfTrack(tid, t)
+        if len(oids) == 0:
+            raise ValueError("TID {} at t={} not found!".format(tid, t))
+        return min(oids)
+
+    def lineageIds(self, tids):
+        """
+        Map the given track ids, and all tracks that emerged from a division, to the id
+        of the track they descend from (the track itself if it has no parent).
+        """
+        parents = {}
+        for parent, (children, _) in self.divisions.items():
+            for child in children:
+                parents[child] = parent
+        lineages = dict((tid, tid) for tid in tids)
+        for tid in parents.keys():
+            root = parents[tid]
+            while root in parents:
+                root = parents[root]
+            lineages[tid] = root
+        return lineages
+
+    def relabelToLineages(self, trackImage, lineages):
+        """
+        Relabel (a frame of) the track image with the lineage ids given as {track id: lineage id}.
+        Tracks without a lineage id become background.
+        """
+        size = int(np.amax(trackImage)) + 1 if trackImage.size else 1
+        return relabel_with_lut(trackImage, dict_to_lut(lineages, size, 0), 0)
 
     def do_export(self, settings, selected_features, progress_slot, lane_index, filename_suffix=""):
         """
@@ -228,10 +296,10 @@ class OpManualTracking(Operator, ExportingOperator):
         :return:
         """
         
-        obj_count = list(objects_per_frame(self.LabelImage))  # slow
+        obj_count = self._objectsPerFrame()
         divisions = self.divisions
         t_range = (0, self.LabelImage.meta.shape[self.LabelImage.meta.axistags.index("t")])
-        oid2tid, _ = self._getObjects(t_range, None)  # slow
+        oid2tid, _ = self._getObjects(t_range, None)
         max_tracks = max(max(map(len, i.values())) if map(len, i.values()) else 0 for i in oid2tid.values())
         ids = ilastik_ids(obj_count)
 
@@ -253,7 +321,7 @@ class OpManualTracking(Operator, ExportingOperator):
                                 {"selection": selected_features})
 
         if divisions:
-            ott = partial(self.lookup_oid_for_tid, oid2tid)
+            ott = self.lookup_oid_for_tid
             divs = [(value[1], ott(key, value[1]), key, ott(value[0][0], value[1] + 1), value[0][0],
                      ott(value[0][1], value[1] + 1), value[0][1])
                     for key, value in sorted(divisions.iteritems(), key=itemgetter(0))]
@@ -23,6 +23,11 @@ import numpy as np
 import math
 import vigra
 
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
 def dotproduct(v1, v2):
     return sum((a*b) for a, b in zip(v1, v2))
 
@@ -64,6 +69,17 @@ class Feature( object ):
     def compute(self, feats_cur, feats_next, **kwargs):
         raise NotImplementedError('Feature not fully implemented yet.')
 
+    def compute_vectorized(self, feats_cur, feats_next, num_next):
+        '''
+        computes the feature for all objects at once
+        feats_cur: (n_objects, feat_dim) array
+        feats_next: (n_objects, n_best, feat_dim) array, the features of the closest objects in the next frame,
+                    sorted by distance. Only the first num_next[i] rows of feats_next[i] are valid.
+        returns an (n_objects, dim) array
+        '''
+        result = [self.compute(f_cur, f_next[:n]) for f_cur, f_next, n in zip(feats_cur, feats_next, num_next)]
+        return np.array(result).reshape((len(feats_cur), -1))
+
     def getName(self):
         return self.name
 
@@ -87,6 +103,15 @@ class ParentChildrenRatio( Feature ):
                 result[i] = self.default_value
         return result
 
+    def compute_vectorized(self, feats_cur, feats_next, num_next):
+        result = np.ones(feats_cur.shape) * self.default_value
+        has_children = num_next >= 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = feats_cur[has_children] / (feats_next[has_children, 0] + feats_next[has_children, 1])
+        ratio[np.isnan(ratio)] = self.default_value
+        result[has_children] = ratio
+        return result
+
     def dim(self):
         return self.dimensionality * self.feat_dim
 
@@ -105,6 +130,16 @@ class ChildrenRatio( Feature ):
                 ratio[i] = 1./ratio[i]
         return ratio
 
+    def compute_vectorized(self, feats_cur, feats_next, num_next):
+        result = np.ones(feats_cur.shape) * self.default_value
+        has_children = num_next >= 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = feats_next[has_children, 0] / feats_next[has_children, 1]
+            ratio[np.isnan(ratio)] = self.default_value
+            ratio = np.where(ratio > 1, 1. / ratio, ratio)
+        result[has_children] = ratio
+        return result
+
     def dim(self):
         return self.dimensionality * self.feat_dim
 
@@ -139,6 +174,28 @@ class ParentChildrenAngle( Feature ):
 
         return max(angles)
 
+    def compute_vectorized(self, feats_cur, feats_next, num_next):
+        n_objects, n_best, ndim = feats_next.shape
+        vectors = (feats_next - feats_cur[:, np.newaxis, :]) * self.scales[0:ndim]
+        lengths = np.sqrt((vectors ** 2).sum(axis=-1))
+
+        max_angles = np.ones(n_objects) * -np.inf
+        for idx1 in range(n_best):
+            for idx2 in range(idx1 + 1, n_best):
+                lengths_product = lengths[:, idx1] * lengths[:, idx2]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    cosines = (vectors[:, idx1] * vectors[:, idx2]).sum(axis=-1) / lengths_product
+                # like angle(): 0 for zero-length vectors and if rounding errors leave the range of acos
+                valid = (lengths_product != 0) & (np.abs(cosines) <= 1)
+                angles = np.where(valid, np.degrees(np.arccos(np.clip(cosines, -1, 1))), 0)
+                is_pair = num_next > idx2
+                max_angles[is_pair] = np.maximum(max_angles[is_pair], angles[is_pair])
+
+        result = np.ones((n_objects, 1)) * self.default_value
+        has_pairs = num_next >= 2
+        result[has_pairs, 0] = max_angles[has_pairs]
+        return result
+
 
 
 
@@ -148,6 +205,9 @@ class ParentIdentity( Feature ):
     def compute(self, feats_cur, feats_next, **kwargs):
         return feats_cur
 
+    def compute_vectorized(self, feats_cur, feats_next, num_next):
+        return feats_cur
+
 
 class FeatureManager( object ):
     
@@ -172,34 +232,73 @@ class FeatureManager( object ):
         self.size_filter = size_filter
         self.squared_distance_default = squared_distance_default
 
-    def _getBestSquaredDistances(self, com_cur, coms_next, size_filter = None, sizes_next = [], default_value = 9999):
-        ''' returns the squared distances to the objects in the neighborhood of com_curr, optionally with size filter '''
-        squaredDistances = []
-
-        for label_next in coms_next.keys():
-            assert label_next in sizes_next.keys()
-            if size_filter != None and sizes_next[label_next] >= size_filter:
-                dist = np.linalg.norm(coms_next[label_next] - com_cur * self.scales)                
-                squaredDistances.append([label_next,dist])
-
-        squaredDistances = np.array(squaredDistances)
-        # sort the array in the second column in ascending order
-        squaredDistances = np.array(sorted(squaredDistances, key=lambda a_entry: a_entry[1]))        
-        
-        # initialize with label -1 and default value
-        result = np.array([ [-1, default_value] for x in range(self.n_best) ], dtype=np.float32)
-        if squaredDistances.shape[0] != 0:
-            result[0:min(squaredDistances.shape[0],result.shape[0]),:] = squaredDistances[0:min(squaredDistances.shape[0],result.shape[0]),:]
-
-        return result
- 
+    def _getNearestNeighbors(self, coms_cur, coms_next, sizes_next):
+        ''' 
+        returns the distances to and the labels of the n_best objects in the next frame that are closest to each object
+        in the current frame (in terms of the scaled centers of mass). Only objects with a size of at least size_filter
+        and a center within template_size/2 of the current object are considered.
+        Both arrays have the shape (n_objects_cur, n_best) and are sorted by distance. Missing neighbors have
+        label -1 and distance squared_distance_default.
+        '''
+        n_cur = coms_cur.shape[0]
+        distances = np.ones((n_cur, self.n_best)) * self.squared_distance_default
+        labels = -np.ones((n_cur, self.n_best), dtype=np.int64)
+        if self.size_filter is None:
+            return distances, labels
+
+        # label 0 is the background
+        is_candidate = (sizes_next >= self.size_filter) & np.isfinite(coms_next).all(axis=1)
+        is_candidate[0] = False
+        candidates = np.flatnonzero(is_candidate)
+        valid_cur = np.flatnonzero(np.isfinite(coms_cur).all(axis=1))
+        if len(candidates) == 0 or len(valid_cur) == 0:
+            return distances, labels
+
+        scales = np.asarray(self.scales[0:coms_cur.shape[1]])
+        points_cur = coms_cur[valid_cur] * scales
+        points_next = coms_next[candidates] * scales
+        radius = self.template_size / 2
+
+        if cKDTree is not None:
+            # one tree per frame, queried for all objects at once
+            dist, idx = cKDTree(points_next).query(points_cur, k=self.n_best, distance_upper_bound=radius)
+            dist = dist.reshape((len(valid_cur), -1))
+            idx = idx.reshape((len(valid_cur), -1))
+        else:
+            dist, idx = self._bruteForceNearest(points_cur, points_next, radius)
+
+        # the tree marks missing neighbors with index len(points_next)
+        found = idx < len(candidates)
+        k = dist.shape[1]
+        distances[valid_cur, 0:k] = np.where(found, dist, self.squared_distance_default)
+        labels[valid_cur, 0:k] = np.where(found, candidates[np.minimum(idx, len(candidates) - 1)], -1)
+        return distances, labels
+
+    def _bruteForceNearest(self, points_cur, points_next, radius):
+        ''' same result as cKDTree.query(), for when scipy is not available '''
+        k = min(self.n_best, len(points_next))
+        dist = np.empty((len(points_cur), k))
+        idx = np.empty((len(points_cur), k), dtype=np.int64)
+        # limit the size of the distance matrix
+        chunk_size = max(1, 2**20 // len(points_next))
+        for start in range(0, len(points_cur), chunk_size):
+            stop = min(start + chunk_size, len(points_cur))
+            d = np.sqrt(((points_cur[start:stop, np.newaxis, :] - points_next[np.newaxis, :, :]) ** 2).sum(axis=-1))
+            nearest = np.argsort(d, axis=1, kind='mergesort')[:, 0:k]
+            nearest_dist = d[np.arange(stop - start)[:, np.newaxis], nearest]
+            nearest[nearest_dist >= radius] = len(points_next)
+            dist[start:stop] = nearest_dist
+            idx[start:stop] = nearest
+        return dist, idx
 
     def computeFeatures_at(self, feats_cur, feats_next, img_next, feat_names): 
-
-#         n_labels = feats_cur.values()[0].shape[0]
+        '''
+        computes the division features for all objects in feats_cur. The candidate children of an object are the
+        n_best objects in feats_next that are closest to it. If feats_next is None (last time step), there are no candidates.
+        img_next is not used anymore, it is only kept for backwards compatibility.
+        '''
+        n_labels = feats_cur.values()[0].shape[0]
         result = {}
-        
-        vigra_feat_names = set([self.com_name_cur, self.com_name_next, self.size_name])
 
         feat_classes = {}
 
@@ -213,68 +312,37 @@ class FeatureManager( object ):
             feat_dim = len(feats_cur[name_split[1]][0])
             feat_classes[name] = self.feature_mappings[name_split[0]](name_split[1], delim=self.delim, ndim=self.ndim, feat_dim=feat_dim)
 
-            shape = (feats_cur.values()[0].shape[0],feat_classes[name].dim())
+            shape = (n_labels, feat_classes[name].dim())
             result[name] = np.ones(shape) * feat_classes[name].default_value
 
-            vigra_feat_names.add(name_split[1])
-        
+        coms_cur = np.asarray(feats_cur[self.com_name_cur]).reshape((n_labels, -1))
+        if feats_next is not None:
+            n_labels_next = feats_next.values()[0].shape[0]
+            coms_next = np.asarray(feats_next[self.com_name_next]).reshape((n_labels_next, -1))
+            sizes_next = np.asarray(feats_next[self.size_name]).reshape((n_labels_next, -1))[:, 0]
+            distances, labels = self._getNearestNeighbors(coms_cur, coms_next, sizes_next)
+        else:
+            distances = np.ones((n_labels, self.n_best)) * self.squared_distance_default
+            labels = -np.ones((n_labels, self.n_best), dtype=np.int64)
 
+        # first add squared distances
         for idx in range(self.n_best):
             name = 'SquaredDistances_' + str(idx)
-            result[name] = np.ones((feats_cur.values()[0].shape[0], 1)) * self.squared_distance_default
-
-        for label_cur, com_cur in enumerate(feats_cur[self.com_name_cur]):
-            if label_cur == 0:
-                continue
-
-            feats_next_subset = {}
-            for k in vigra_feat_names:
-                feats_next_subset[k] = {}
-
-            if feats_next is not None and img_next is not None:
-                idx_cur = [round(x) for x in com_cur]
-
-                roi = []
-                for idx,coord in enumerate(idx_cur):
-                    start = max(coord - self.template_size//2, 0)
-                    stop = min(coord + self.template_size//2, img_next.shape[idx])
-                    roi.append(slice(int(start),int(stop)))
-
-
-                # find all coms in the neighborhood of com_cur
-                subimg_next = img_next[roi]
-                labels_next = np.sort(vigra.analysis.unique(subimg_next)).tolist()
-
-                for l in labels_next:
-                    if l != 0:
-                        for n in vigra_feat_names:
-                            feats_next_subset[n][l] = np.array([feats_next[n][l]]).flatten()                            
-
-            sq_dist_label = self._getBestSquaredDistances(com_cur, feats_next_subset[self.com_name_next], 
-                                self.size_filter, feats_next_subset[self.size_name], default_value=self.squared_distance_default)
-
-            feats_next_subset_best = {}
-            for n in vigra_feat_names:
-                feats_next_subset_best[n] = []
-                for idx, row in enumerate(sq_dist_label):
-                    l = row[0]
-                    if l != -1:
-                        feats_next_subset_best[n].append(feats_next_subset[n][l])
-
-            # first add squared distances
-            for idx in range(self.n_best):
-                name = 'SquaredDistances_' + str(idx)                
-                result[name][label_cur] = sq_dist_label[idx][1]
-
-            # add all other features
-            for name, feat_class in feat_classes.items():
-                if feat_class.feats_name == 'SquaredDistances':
-                    f_next = sq_dist_label[0:2,1]
-                    f_cur = None
-                else:   
-                    f_cur = np.array([feats_cur[feat_class.feats_name][label_cur]]).flatten()
-                    f_next = np.array([feats_next_subset_best[feat_class.feats_name]]).reshape((-1,f_cur.shape[0]))
-                result[name][label_cur] = feat_class.compute(f_cur, f_next)
+            result[name] = distances[:, idx:idx+1].copy()
+            result[name][0] = self.squared_distance_default
+
+        # add all other features (the neighbors are sorted, so the valid ones come first)
+        num_next = (labels != -1).sum(axis=1)
+        for name, feat_class in feat_classes.items():
+            f_cur = np.asarray(feats_cur[feat_class.feats_name]).reshape((n_labels, -1))
+            if feats_next is not None:
+                f_next_all = np.asarray(feats_next[feat_class.feats_name]).reshape((n_labels_next, -1))
+                f_next = f_next_all[np.maximum(labels, 0)]
+            else:
+                f_next = np.zeros((n_labels, self.n_best, f_cur.shape[1]))
+            values = feat_class.compute_vectorized(f_cur, f_next, num_next)
+            # label 0 is the background
+            result[name][1:] = values[1:]
 
         return result
 
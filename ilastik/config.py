@@ -31,6 +31,12 @@ Example:
 debug: false
 plugin_directories: ~/.ilastik/plugins,
 logging_config: ~/custom_ilastik_logging_config.json
+
+# Storage of data copied into the project file
+# (compression: none, lzf or gzip; chunk_layout: auto, tiles or cubes)
+[project data]
+compression: lzf
+chunk_layout: auto
 """
 
 default_config = """
@@ -42,9 +48,14 @@ plugin_directories: ~/.ilastik/plugins,
 threads: -1
 total_ram_mb: 0
 
+[project data]
+compression: none
+chunk_layout: auto
+
 [ipc raw tcp]
 autostart: false
 autoaccept: true
+persistent: false
 port: 9999
 interface: localhost
 
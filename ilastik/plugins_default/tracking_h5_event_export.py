@@ -1,8 +1,9 @@
 import os
+import collections
 import numpy as np
 import h5py
 from functools import partial
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request
 
 from ilastik.plugins import TrackingExportFormatPlugin
 from hytra.core.jsongraph import getMappingsBetweenUUIDsAndTraxels, getMergersDetectionsLinksDivisions, getMergersPerTimestep, getLinksPerTimestep, getDetectionsPerTimestep, getDivisionsPerTimestep
@@ -10,9 +11,25 @@ from hytra.core.jsongraph import getMappingsBetweenUUIDsAndTraxels, getMergersDe
 import logging
 logger = logging.getLogger(__name__)
 
-def writeEvents(timestep, activeLinks, activeDivisions, mergers, detections, fn, labelImage, verbose=False):
+def getObjectIds(objectFeaturesSlot, timestep):
+    '''
+    Returns the ids of the objects in the given frame, taken from the object sizes in the feature table,
+    or None if the sizes are not available.
+    '''
+    features = objectFeaturesSlot([timestep]).wait()[timestep]
+    try:
+        counts = features['Standard Object Features']['Count']
+    except KeyError:
+        return None
+    counts = np.asarray(counts).reshape((len(counts), -1))[:, 0]
+    ids = np.flatnonzero(counts > 0)
+    return ids[ids > 0]
+
+def writeEvents(timestep, activeLinks, activeDivisions, mergers, detections, fn, labelImage, verbose=False, objectIds=None):
     '''
     Warning: every error in this function is somehow not thrown, not even as the logger warning.
+
+    If the ids of the objects in the label image are not given, they are computed from the label image.
     '''
     dis = []
     app = []
@@ -36,8 +53,11 @@ def writeEvents(timestep, activeLinks, activeDivisions, mergers, detections, fn,
             seg = dest_file.create_group('segmentation')
             seg.create_dataset("labels", data=labelImage, compression='gzip')
             meta = dest_file.create_group('objects/meta')
-            ids = np.unique(labelImage)
-            ids = ids[ids > 0]
+            if objectIds is None:
+                ids = np.unique(labelImage)
+                ids = ids[ids > 0]
+            else:
+                ids = objectIds
             valid = np.ones(ids.shape)
             meta.create_dataset("id", data=ids, dtype=np.uint32)
             meta.create_dataset("valid", data=valid, dtype=np.uint32)
@@ -79,6 +99,10 @@ class TrackingH5EventExportFormatPlugin(TrackingExportFormatPlugin):
 
     exportsToFile = False
 
+    # Number of frames that are read or written at the same time.
+    # Bounds the memory usage, independent of the number of frames.
+    maxTimestepsInFlight = 4
+
     def checkFilesExist(self, filename):
         ''' Check whether the files we want to export are already present '''
         return os.path.exists(os.path.join(filename, 'H5-Event-Sequence'))
@@ -107,29 +131,40 @@ class TrackingH5EventExportFormatPlugin(TrackingExportFormatPlugin):
         detectionsPerTimestep = getDetectionsPerTimestep(detections, timesteps)
         divisionsPerTimestep = getDivisionsPerTimestep(divisions, linksPerTimestep, timesteps)
 
-        # save to disk in parallel
-        pool = RequestPool()
+        if not os.path.exists(filename + '/H5-Event-Sequence'):
+            os.makedirs(filename + '/H5-Event-Sequence')
 
         timeIndex = labelImageSlot.meta.axistags.index('t')
 
-        for timestep in traxelIdPerTimestepToUniqueIdMap.keys():
+        def exportTimestep(timestep):
             # extract current frame lable image
             roi = [slice(None) for i in range(len(labelImageSlot.meta.shape))]
             roi[timeIndex] = slice(int(timestep), int(timestep)+1)
             roi = tuple(roi)
             labelImage = labelImageSlot[roi].wait()
+            objectIds = getObjectIds(objectFeaturesSlot, int(timestep))
 
-            if not os.path.exists(filename + '/H5-Event-Sequence'):
-                os.makedirs(filename + '/H5-Event-Sequence')
             fn = os.path.join(filename, "H5-Event-Sequence/{0:05d}.h5".format(int(timestep)))
-            pool.add(Request(partial(writeEvents,
-                                        int(timestep),
-                                         linksPerTimestep[timestep],
-                                         divisionsPerTimestep[timestep],
-                                         mergersPerTimestep[timestep],
-                                         detectionsPerTimestep[timestep],
-                                         fn,
-                                         labelImage)))
-        pool.wait()
+            writeEvents(int(timestep),
+                        linksPerTimestep[timestep],
+                        divisionsPerTimestep[timestep],
+                        mergersPerTimestep[timestep],
+                        detectionsPerTimestep[timestep],
+                        fn,
+                        labelImage,
+                        objectIds=objectIds)
+
+        # Read and write the frames in parallel, but with at most maxTimestepsInFlight frames in memory:
+        # before the next frame is started, wait for the oldest one to be written.
+        inFlight = collections.deque()
+        for timestep in sorted(traxelIdPerTimestepToUniqueIdMap.keys(), key=int):
+            if len(inFlight) >= self.maxTimestepsInFlight:
+                inFlight.popleft().wait()
+            request = Request(partial(exportTimestep, timestep))
+            request.submit()
+            inFlight.append(request)
+
+        for request in inFlight:
+            request.wait()
 
         return True
@@ -1,9 +1,13 @@
 import os.path
 import random
+import itertools
+import xml.etree.ElementTree as ET
 import numpy as np
+import h5py
+from functools import partial
+from lazyflow.request import Request, RequestPool
 from ilastik.plugins import TrackingExportFormatPlugin
 from mamutexport.mamutxmlbuilder import MamutXmlBuilder
-from mamutexport.bigdataviewervolumeexporter import BigDataViewerVolumeExporter
 import vigra
 
 def convertKeyName(key):
@@ -30,6 +34,235 @@ def getShortname(string):
             break
     return shortname.strip()
 
+def addFeatureNames(builder, frameFeatures):
+    ''' declare the MaMuT attributes for all features of a frame '''
+    for category in frameFeatures.keys():
+        for key in frameFeatures[category].keys():
+            feature_string = convertKeyName(key)
+            if len(feature_string) > 15:
+                shortname = getShortname(feature_string).replace('_', '')
+            else:
+                shortname = feature_string.replace('_', '')
+
+            isInt = isinstance(frameFeatures[category][key], int)
+
+            if (np.asarray(frameFeatures[category][key])).ndim == 2:
+                if key != 'Histogram':
+                    for column in xrange((np.asarray(frameFeatures[category][key])).shape[1]):
+                        builder.addFeatureName(feature_string + '_' + str(column), feature_string, shortname + '_' + str(column), isInt)
+            else:
+                builder.addFeatureName(feature_string, feature_string, shortname, isInt)
+
+def padColumn(column, numRows, default):
+    ''' extend a feature column with the default value, for labels that are not in the feature table '''
+    if len(column) >= numRows:
+        return column
+    return np.concatenate((column, np.ones(numRows - len(column), dtype=column.dtype) * default))
+
+def flattenFrameFeatures(frameFeatures, numRows):
+    '''
+    Flatten the features of one frame ({category: {featureName: values}}) into a list of MaMuT attribute names
+    and a list of columns, one entry per label. Histograms are skipped. Labels that are missing in a
+    feature table (e.g. division features of the last frame) get 9999 for squared distances and 0 otherwise.
+    '''
+    names = []
+    columns = []
+    for category in frameFeatures.keys():
+        for key in frameFeatures[category].keys():
+            if key == 'Histogram':
+                continue
+            values = np.asarray(frameFeatures[category][key])
+            name = convertKeyName(key)
+            if values.ndim == 0:
+                names.append(name)
+                columns.append([frameFeatures[category][key]] * numRows)
+            elif values.ndim == 1:
+                names.append(name)
+                columns.append(padColumn(values, numRows, 0.))
+            elif values.ndim == 2:
+                default = 9999. if 'SquaredDistances' in key else 0.
+                for j in xrange(values.shape[1]):
+                    names.append(name + '_{}'.format(str(j)))
+                    columns.append(padColumn(values[:, j], numRows, default))
+    return names, columns
+
+class BigDataViewerExporter(object):
+    '''
+    Writes a txyzc image into an HDF5 file in BigDataViewer's multi-resolution layout
+    (t<t>/s<channel>/<level>/cells, int16 zyx datasets), together with the BigDataViewer XML file.
+    The image is read and written blockwise, so it never has to fit in RAM, and the downscaled
+    pyramid levels are computed blockwise from the previous level in the file.
+    '''
+    # Chunk shape (x, y, z) of the cells datasets
+    chunkShape = (64, 64, 16)
+
+    # Shape (x, y, z) of the blocks that are processed at once, and how many are read in parallel
+    blockShape = (512, 512, 16)
+    parallelBlocks = 8
+
+    # Levels are added until each axis of the coarsest level is at most this large
+    minLevelSize = 64
+
+    def __init__(self, imageSlot):
+        self.imageSlot = imageSlot
+        taggedShape = imageSlot.meta.getTaggedShape()
+        self.axisIndex = dict((key, i) for i, key in enumerate(taggedShape.keys()))
+        self.numTimesteps = taggedShape.get('t', 1)
+        self.numChannels = taggedShape.get('c', 1)
+        self.shape = np.array([taggedShape.get(k, 1) for k in 'xyz'])
+        self.resolutions = self._computeResolutions()
+        self.conversion = None
+
+    def _computeResolutions(self):
+        resolutions = [np.ones(3, dtype=np.int64)]
+        while True:
+            levelShape = self.shape // resolutions[-1]
+            factors = np.where(levelShape > self.minLevelSize, 2, 1)
+            if (factors == 1).all():
+                return np.array(resolutions)
+            resolutions.append(resolutions[-1] * factors)
+
+    def _levelShape(self, level):
+        ''' (x, y, z) shape of a pyramid level '''
+        return np.maximum(self.shape // self.resolutions[level], 1)
+
+    def _blocks(self, shape):
+        ''' (start, stop) of the (x, y, z) blocks that cover the given shape '''
+        ranges = [range(0, s, b) for s, b in zip(shape, self.blockShape)]
+        for start in itertools.product(*ranges):
+            start = np.array(start)
+            yield start, np.minimum(start + self.blockShape, shape)
+
+    def _readBlock(self, t, start, stop):
+        ''' read an xyz block of all channels and return it as czyx '''
+        roiStart = [0] * len(self.axisIndex)
+        roiStop = list(self.imageSlot.meta.shape)
+        for key, i in self.axisIndex.items():
+            if key == 't':
+                roiStart[i], roiStop[i] = t, t+1
+            elif key in 'xyz':
+                roiStart[i], roiStop[i] = start['xyz'.index(key)], stop['xyz'.index(key)]
+        data = self.imageSlot(roiStart, roiStop).wait()
+        data = vigra.taggedView(data, self.imageSlot.meta.axistags)
+        return np.asarray(data.withAxes('c', 'z', 'y', 'x'))
+
+    def _setupConversion(self):
+        '''
+        BigDataViewer's HDF5 format stores unsigned 16 bit data (as int16).
+        Unsigned integer data up to 16 bit is stored as is, everything else is rescaled to the full range.
+        '''
+        dtype = np.dtype(self.imageSlot.meta.dtype)
+        if dtype.kind in 'ub' and dtype.itemsize <= 2:
+            self.conversion = None
+            return
+        drange = self.imageSlot.meta.drange
+        if drange is None:
+            # one blockwise pass to find the data range
+            low, high = np.inf, -np.inf
+            for t in range(self.numTimesteps):
+                for start, stop in self._blocks(self.shape):
+                    data = self._readBlock(t, start, stop)
+                    low, high = min(low, data.min()), max(high, data.max())
+            drange = (low, high)
+        low, high = float(drange[0]), float(drange[1])
+        self.conversion = (low, 65535. / max(high - low, 1e-12))
+
+    def _convert(self, data):
+        if self.conversion is None:
+            return data.astype(np.uint16).view(np.int16)
+        low, scale = self.conversion
+        data = np.clip((data - low) * scale, 0, 65535)
+        return np.round(data).astype(np.uint16).view(np.int16)
+
+    def writeHdf5(self, filename):
+        self._setupConversion()
+        with h5py.File(filename, 'w') as f:
+            for c in range(self.numChannels):
+                setup = f.create_group('s{:02d}'.format(c))
+                setup.create_dataset('resolutions', data=self.resolutions.astype(np.float64))
+                subdivisions = [np.minimum(self.chunkShape, self._levelShape(level)) for level in range(len(self.resolutions))]
+                setup.create_dataset('subdivisions', data=np.array(subdivisions, dtype=np.int32))
+
+            for t in range(self.numTimesteps):
+                datasets = []
+                for c in range(self.numChannels):
+                    datasets.append([])
+                    for level in range(len(self.resolutions)):
+                        levelShape = self._levelShape(level)
+                        chunks = tuple(np.minimum(self.chunkShape, levelShape)[::-1])
+                        datasets[c].append(f.create_dataset('t{:05d}/s{:02d}/{}/cells'.format(t, c, level),
+                                                            shape=tuple(levelShape[::-1]), dtype=np.int16,
+                                                            chunks=chunks, compression='gzip'))
+                self._writeFullResolution(t, datasets)
+                for c in range(self.numChannels):
+                    for level in range(1, len(self.resolutions)):
+                        self._writeDownscaled(datasets[c][level-1], datasets[c][level],
+                                              self.resolutions[level] // self.resolutions[level-1])
+
+    def _writeFullResolution(self, t, datasets):
+        blocks = list(self._blocks(self.shape))
+        for batchStart in range(0, len(blocks), self.parallelBlocks):
+            batch = blocks[batchStart:batchStart + self.parallelBlocks]
+            results = [None] * len(batch)
+
+            def readBlock(i, start, stop):
+                results[i] = self._convert(self._readBlock(t, start, stop))
+
+            pool = RequestPool()
+            for i, (start, stop) in enumerate(batch):
+                pool.add(Request(partial(readBlock, i, start, stop)))
+            pool.wait()
+
+            for (start, stop), data in zip(batch, results):
+                zyx = tuple(slice(a, b) for a, b in zip(start[::-1], stop[::-1]))
+                for c in range(self.numChannels):
+                    datasets[c][0][zyx] = data[c]
+
+    def _writeDownscaled(self, source, target, factors):
+        ''' compute a level from the previous one by averaging, one block of the target level at a time '''
+        factorsZyx = factors[::-1]
+        targetShape = np.array(target.shape[::-1])
+        for start, stop in self._blocks(targetShape):
+            startZyx, stopZyx = start[::-1], stop[::-1]
+            sourceSlicing = tuple(slice(a * f, b * f) for a, b, f in zip(startZyx, stopZyx, factorsZyx))
+            data = source[sourceSlicing].view(np.uint16).astype(np.float32)
+            shape = []
+            for size, f in zip(stopZyx - startZyx, factorsZyx):
+                shape += [size, f]
+            data = data.reshape(shape).mean(axis=(1, 3, 5))
+            target[tuple(slice(a, b) for a, b in zip(startZyx, stopZyx))] = np.round(data).astype(np.uint16).view(np.int16)
+
+    def writeXml(self, xmlFilename, hdf5Filename):
+        root = ET.Element('SpimData', version='0.2')
+        ET.SubElement(root, 'BasePath', type='relative').text = '.'
+        sequence = ET.SubElement(root, 'SequenceDescription')
+        loader = ET.SubElement(sequence, 'ImageLoader', format='bdv.hdf5')
+        ET.SubElement(loader, 'hdf5', type='relative').text = os.path.relpath(hdf5Filename, os.path.dirname(os.path.abspath(xmlFilename)))
+
+        setups = ET.SubElement(sequence, 'ViewSetups')
+        for c in range(self.numChannels):
+            setup = ET.SubElement(setups, 'ViewSetup')
+            ET.SubElement(setup, 'id').text = str(c)
+            ET.SubElement(setup, 'name').text = 'channel {}'.format(c + 1)
+            ET.SubElement(setup, 'size').text = ' '.join(str(s) for s in self.shape)
+            voxelSize = ET.SubElement(setup, 'voxelSize')
+            ET.SubElement(voxelSize, 'unit').text = 'pixel'
+            ET.SubElement(voxelSize, 'size').text = '1.0 1.0 1.0'
+
+        timepoints = ET.SubElement(sequence, 'Timepoints', type='range')
+        ET.SubElement(timepoints, 'first').text = '0'
+        ET.SubElement(timepoints, 'last').text = str(self.numTimesteps - 1)
+
+        registrations = ET.SubElement(root, 'ViewRegistrations')
+        for t in range(self.numTimesteps):
+            for c in range(self.numChannels):
+                registration = ET.SubElement(registrations, 'ViewRegistration', timepoint=str(t), setup=str(c))
+                transform = ET.SubElement(registration, 'ViewTransform', type='affine')
+                ET.SubElement(transform, 'affine').text = '1.0 0.0 0.0 0.0 0.0 1.0 0.0 0.0 0.0 0.0 1.0 0.0'
+
+        MamutXmlBuilder.indent(root)
+        ET.ElementTree(root).write(xmlFilename, encoding='utf-8', xml_declaration=True)
+
 class TrackingMamutExportFormatPlugin(TrackingExportFormatPlugin):
     """MaMuT export"""
 
@@ -52,15 +285,10 @@ class TrackingMamutExportFormatPlugin(TrackingExportFormatPlugin):
         """
         bigDataViewerFile = filename + '_bdv.xml'
 
-        rawImage = rawImageSlot([]).wait()
-        vigra.writeHDF5(rawImage, filename + '_raw.h5', 'exported_data')
-
-        bve = BigDataViewerVolumeExporter(filename + '_raw.h5', 'exported_data', rawImage.shape[1:4])
-        for t in range(rawImage.shape[0]):
-            bve.addTimePoint(t)
-        bve._finalizeTimepoints()
-        MamutXmlBuilder.indent(bve.root)
-        bve.writeToFile(filename + '_bdv.xml')
+        # the raw data is streamed blockwise into BigDataViewer's multi-resolution layout
+        bve = BigDataViewerExporter(rawImageSlot)
+        bve.writeHdf5(filename + '_raw.h5')
+        bve.writeXml(bigDataViewerFile, filename + '_raw.h5')
 
         builder = MamutXmlBuilder()
         graph = hypothesesGraph._graph
@@ -68,65 +296,38 @@ class TrackingMamutExportFormatPlugin(TrackingExportFormatPlugin):
         features = objectFeaturesSlot([]).wait() # this is a dict of structure: {frame: {category: {featureNames}}}
         firstPass = True
 
-        for node in graph.nodes_iter():
+        # flatten the features of each frame once, instead of looking them up for every node
+        activeNodes = [node for node in graph.nodes_iter() if graph.node[node]['value'] > 0]
+        numRowsPerFrame = {}
+        for frame, label in activeNodes:
+            numRowsPerFrame[frame] = max(numRowsPerFrame.get(frame, 0), label + 1)
+        flatFeatures = {}
+        for frame, numRows in numRowsPerFrame.items():
+            flatFeatures[frame] = flattenFrameFeatures(features[frame], numRows)
+
+        for node in activeNodes:
             frame, label = node
-            if graph.node[node]['value'] > 0:
-                t = graph.node[node]['traxel']
-
-                radius = 2*features[frame]['Standard Object Features']['RegionRadii'][label, 0]
-                
-                featureDict = {}
-                for category in features[frame].keys():
-                    for key in features[frame][category].keys():
-
-                        if firstPass:
-                            feature_string = key
-                            feature_string = convertKeyName(feature_string)
-                            if len(feature_string) > 15:
-                                shortname = getShortname(feature_string).replace('_', '')
-                            else:
-                                shortname = feature_string.replace('_', '')
-
-                            isInt = isinstance(features[frame][category][key], int)
-
-                            if (np.asarray(features[frame][category][key])).ndim == 2:
-                                if key != 'Histogram':
-                                    #print key, np.asarray(features[key]).shape
-                                    for column in xrange((np.asarray(features[frame][category][key])).shape[1]):
-                                        builder.addFeatureName(feature_string + '_' + str(column), feature_string, shortname + '_' + str(column), isInt)
-                            else:
-                                #print "ELSE", key, np.asarray(features[key]).shape
-                                builder.addFeatureName(feature_string, feature_string, shortname, isInt)
-
-                        if key != 'Histogram':
-                            if label != 0: # ignoring background
-                                if (np.asarray(features[frame][category][key])).ndim == 0:
-                                    featureDict[convertKeyName(key)] = features[frame][category][key]
-                                if (np.asarray(features[frame][category][key])).ndim == 1:
-                                    featureDict[convertKeyName(key)] = features[frame][category][key][label]
-                                if (np.asarray(features[frame][category][key])).ndim == 2:
-                                    for j in xrange((np.asarray(features[frame][category][key])).shape[1]):
-                                        try:
-                                            exists = features[frame][category][key][label, 0]
-                                        except IndexError:
-                                            if 'SquaredDistances' in key:
-                                                featureDict[convertKeyName(key) + '_{}'.format(str(j))] = 9999.
-                                            else:
-                                                featureDict[convertKeyName(key) + '_{}'.format(str(j))] = 0.
-                                            continue
-                                        featureDict[convertKeyName(key) + '_{}'.format(str(j))] = features[frame][category][key][label, j]
+            if firstPass:
+                addFeatureNames(builder, features[frame])
                 firstPass = False
 
-                # TODO: builder.addSpot(frame, graph.node[node]['id'], t.X(), t.Y(), t.Z(), radius, featureDict)
-                # instead of the next lines
-                xpos = features[frame]['Standard Object Features']['RegionCenter'][label, 0]
-                ypos = features[frame]['Standard Object Features']['RegionCenter'][label, 1]
-                try:
-                    zpos = features[frame]['Standard Object Features']['RegionCenter'][label, 2]
-                except IndexError:
-                    zpos = 0.0
+            radius = 2*features[frame]['Standard Object Features']['RegionRadii'][label, 0]
+
+            featureDict = {}
+            if label != 0: # ignoring background
+                names, columns = flatFeatures[frame]
+                featureDict = dict(zip(names, [column[label] for column in columns]))
+
+            # TODO: builder.addSpot(frame, graph.node[node]['id'], t.X(), t.Y(), t.Z(), radius, featureDict)
+            # instead of the next lines
+            xpos = features[frame]['Standard Object Features']['RegionCenter'][label, 0]
+            ypos = features[frame]['Standard Object Features']['RegionCenter'][label, 1]
+            try:
+                zpos = features[frame]['Standard Object Features']['RegionCenter'][label, 2]
+            except IndexError:
+                zpos = 0.0
 
-                builder.addSpot(frame, 'track-{}'.format(graph.node[node]['trackId']), graph.node[node]['id'], xpos, ypos, zpos, radius, featureDict)
+            builder.addSpot(frame, 'track-{}'.format(graph.node[node]['trackId']), graph.node[node]['id'], xpos, ypos, zpos, radius, featureDict)
 
         for edge in graph.edges_iter():
             if graph.edge[edge[0]][edge[1]]['value'] > 0:
@@ -1,10 +1,13 @@
-from SocketServer import BaseRequestHandler, TCPServer as BaseTCPServer
+from SocketServer import BaseRequestHandler, ThreadingMixIn, TCPServer as BaseTCPServer
 import logging
 import threading
 import atexit
 import json
+import time
+import select
+from socket import create_connection, MSG_PEEK
 from itertools import chain
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from operator import itemgetter
 from PyQt4.QtCore import QObject, pyqtSignal
 from ilastik.utility.commandProcessor import CommandProcessor
@@ -148,7 +151,7 @@ class IPCFacade(object):
         message = json.dumps(command, cls=NumpyJsonEncoder)
         log = Protocol.verbose(command)
         for server in self.senders.itervalues():
-            server.broadcast(message, log)
+            server.broadcast(message, log, command.get("command"))
 
     def show_info(self):
         """
@@ -234,18 +237,19 @@ class Sending(IPCModul):
     """
     Interface for all modules that can broadcast messages
     """
-    def broadcast(self, message, log):
+    def broadcast(self, message, log, name=None):
         """
         Wrapper to only broadcast if running and logging of the message
         """
         if self.running:
-            self._broadcast(message)
+            self._broadcast(message, name)
             self.widget.add_sent_command(log, 0)
 
-    def _broadcast(self, message):
+    def _broadcast(self, message, name=None):
         """
         Implement this to broadcast the message
         :param message: the message to broadcast as a str
+        :param name: the name of the command ( e.g. hilite ), if known
         """
         raise NotImplementedError
 
@@ -344,17 +348,26 @@ class Handler(BaseRequestHandler):
     """
     def handle(self):
         """
-        Receive one Message and emit the signal
+        Receive newline separated messages until the peer closes the connection and emit the signal for each.
+        A peer that sends a single message without a newline and closes the connection is handled as well.
         """
         try:
-            data = self.request.recv(4096).strip()
             host, port = self.request.getpeername()
-            if data == "":
-                return
-            command = json.loads(data)
-        except (socket_error, ValueError) as e:
+            stream = self.request.makefile("rb")
+            for data in iter(stream.readline, ""):
+                data = data.strip()
+                if data == "":
+                    continue
+                try:
+                    command = json.loads(data)
+                except ValueError as e:
+                    logger.exception(e)
+                    continue
+                self._emit(command, host)
+        except socket_error as e:
             logger.exception(e)
-            return
+
+    def _emit(self, command, host):
         name = command.pop("command")
         if name == "handshake":
             command.update({"protocol": "tcp"})
@@ -363,6 +376,14 @@ class Handler(BaseRequestHandler):
         self.server.signal.emit(name, command)
 
 
+class ThreadingTCPServer(ThreadingMixIn, BaseTCPServer):
+    """
+    Peers may keep their connection open, so each connection is handled in its own thread
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
 class TCPServer(Binding, Receiving, QObject):
     """
     raw tcp server. accepts handshakes which will be forwarded to the TCPClient
@@ -407,7 +428,7 @@ class TCPServer(Binding, Receiving, QObject):
 
     def _start(self):
         try:
-            server = BaseTCPServer((self.interface, self.port), Handler)
+            server = ThreadingTCPServer((self.interface, self.port), Handler)
         except socket.error as e:
             self.server = None
             self.info.notify_server_status_update("running", False)
@@ -441,16 +462,183 @@ class TCPServer(Binding, Receiving, QObject):
         self.port = address
 
 
+class CoalescingQueue(object):
+    """
+    A FIFO queue for outgoing messages.
+    A message that is put with a key replaces the queued message with the same key ( latest wins ),
+    but keeps its place in the queue. Messages without a key are never dropped.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._items = deque()
+        self._keyed = {}
+        self._unfinished = 0
+        self._closed = False
+
+    def put(self, message, key=None):
+        with self._condition:
+            if key is not None and key in self._keyed:
+                self._keyed[key][1] = message
+                return
+            item = [key, message]
+            self._items.append(item)
+            if key is not None:
+                self._keyed[key] = item
+            self._unfinished += 1
+            self._condition.notify_all()
+
+    def get(self):
+        """
+        Block until a message is available
+        :return: the next message or None if the queue was closed
+        """
+        with self._condition:
+            while not self._items and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+            key, message = self._items.popleft()
+            if key is not None:
+                del self._keyed[key]
+            return message
+
+    def task_done(self):
+        with self._condition:
+            self._unfinished -= 1
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait until all messages were processed
+        :return: False if the timeout expired first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._unfinished > 0:
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            return True
+
+    def close(self):
+        """
+        Wake up the consumer. Messages that are still queued are discarded ( and count as done for join() ).
+        """
+        with self._condition:
+            self._closed = True
+            self._unfinished -= len(self._items)
+            self._items.clear()
+            self._keyed.clear()
+            self._condition.notify_all()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
+
+
+class PeerConnection(object):
+    """
+    A persistent tcp connection to one peer.
+    If the connection can't be established, the next attempt is delayed with an exponential backoff.
+    """
+    CONNECT_TIMEOUT = 2.0
+    INITIAL_BACKOFF = 0.1
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, address):
+        self.address = tuple(address)
+        self.socket = None
+        self.backoff = 0.0
+        self.retry_time = 0.0
+
+    def send(self, data):
+        """
+        Send the data, (re)connecting if necessary
+        :return: True if the data was sent
+        """
+        for _ in range(2):
+            reused = self.socket is not None
+            if reused and not self._alive():
+                self.close()
+                reused = False
+            if self.socket is None and not self._connect():
+                return False
+            try:
+                self.socket.sendall(data)
+            except socket_error as e:
+                self.close()
+                if not reused:
+                    self._failed(e)
+                    return False
+                # The peer dropped the connection since we last used it. Try once more with a new one.
+            else:
+                self.backoff = 0.0
+                return True
+        return False
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except socket_error:
+                pass
+            self.socket = None
+
+    def _connect(self):
+        if time.time() < self.retry_time:
+            return False
+        try:
+            self.socket = create_connection(self.address, self.CONNECT_TIMEOUT)
+        except socket_error as e:
+            self.socket = None
+            self._failed(e)
+            return False
+        return True
+
+    def _failed(self, error):
+        self.backoff = min(max(2 * self.backoff, self.INITIAL_BACKOFF), self.MAX_BACKOFF)
+        self.retry_time = time.time() + self.backoff
+        logger.warn("Could not send to peer {}: {}. Retrying in {:.1f}s".format(self.address, error, self.backoff))
+
+    def _alive(self):
+        """
+        Peers don't send anything on this connection, so if it is readable the peer closed it ( or reset it ).
+        """
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+            if not readable:
+                return True
+            return self.socket.recv(1, MSG_PEEK) != ""
+        except (socket_error, select.error):
+            return False
+
+
 class TCPClient(Sending, HasPeers):
     """
-    This module keeps a list of peers an connects to them if a message must be broadcast
-    The tcp connection will be closed right after the messages were sent
+    This module keeps a list of peers and sends the broadcast messages to them.
+    Messages are queued and sent by a background thread. Rapid updates of the commands in COALESCED_COMMANDS
+    ( e.g. the viewer position ) are coalesced: only the latest queued message of each of these commands is sent.
+    By default, every message is sent over its own connection, which is closed right after the message.
+    If 'persistent' is enabled in the [ipc raw tcp] config section, the connections are kept open ( one per peer ),
+    and each message is terminated by a newline. Only enable this if all peers read newline-separated messages.
     """
+    COALESCED_COMMANDS = ("setviewerposition",)
+
     def __init__(self):
         self.peers = OrderedDict()
 
         self.info = None
 
+        self.persistent = ilastik_config.getboolean("ipc raw tcp", "persistent")
+        self._queue = CoalescingQueue()
+        self._connections = {}  # only accessed by the sender thread
+        self._sender = None
+        self._sender_lock = threading.Lock()
+
     def connect_widget(self, widget):
         self.info = widget
         widget.connectionChanged.connect(self.update_peer)
@@ -474,20 +662,61 @@ class TCPClient(Sending, HasPeers):
         enabled = kvargs["enabled"]
         self.peers.values()[key]["enabled"] = enabled
 
-    def _broadcast(self, message):
-        count = 0
-        for peer in filter(itemgetter("enabled"), self.peers.itervalues()):
-            try:
-                with socket() as s:
-                    # noinspection PyTypeChecker
-                    host, port = peer["address"]
-                    s.connect((host, port))
-                    s.sendall(message)
-            except socket_error as e:
-                logger.exception(e)
-            else:
-                count += 1
-        return count
+    def _broadcast(self, message, name=None):
+        addresses = [tuple(peer["address"]) for peer in filter(itemgetter("enabled"), self.peers.itervalues())]
+        if not addresses:
+            return
+        key = name if name in self.COALESCED_COMMANDS else None
+        self._ensure_sender_running()
+        self._queue.put((message, addresses), key)
+
+    def _ensure_sender_running(self):
+        with self._sender_lock:
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_loop, args=(self._queue,), name="TCPClient Thread")
+                self._sender.daemon = True
+                self._sender.start()
+
+    def _send_loop(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            message, addresses = item
+            data = message + "\n" if self.persistent else message
+            for address in addresses:
+                connection = self._connections.get(address)
+                if connection is None:
+                    connection = self._connections[address] = PeerConnection(address)
+                if not connection.send(data):
+                    logger.debug("Dropped message for peer {}".format(address))
+                if not self.persistent:
+                    connection.close()
+            queue.task_done()
+
+        for connection in self._connections.itervalues():
+            connection.close()
+        self._connections = {}
+
+    def flush(self, timeout=None):
+        """
+        Wait until all queued messages were sent ( or dropped )
+        :return: False if the timeout expired first
+        """
+        return self._queue.join(timeout)
+
+    def stop(self, kill=True):
+        """
+        Stop the sender thread and close all connections. Queued messages are discarded.
+        The sender will be restarted by the next broadcast.
+        """
+        with self._sender_lock:
+            sender, queue = self._sender, self._queue
+            self._sender = None
+            self._queue = CoalescingQueue()
+        queue.close()
+        if sender is not None:
+            sender.join()
 
     @property
     def widget(self):
@@ -558,7 +787,7 @@ class ZMQPublisher(ZMQBase, Sending):
         self.address = address
         self.info.notify_server_status_update("pub", "address", self.full_addr)
 
-    def _broadcast(self, message):
+    def _broadcast(self, message, name=None):
         self.socket.send_string(message, zmq.NOBLOCK)
 
     @property
@@ -0,0 +1,335 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+A long-running headless server that keeps a project loaded and processes batch jobs.
+
+Starting ilastik and loading a project is expensive, so processing many small images with
+one headless invocation each is dominated by the startup overhead.  Instead, start ilastik once:
+
+    ilastik --headless --project=MyProject.ilp --serve=localhost:9999
+
+and submit jobs to it (e.g. with PredictionClient).  Each job is run through the workflow's
+usual batch export (BatchProcessingApplet.run_export()), one job at a time.
+
+The protocol is newline-separated JSON over a local TCP or UNIX socket; each connection carries
+one request and its reply.  Requests:
+
+    {"command": "submit", "inputs": [path, ...], "export_args": ["--output_format=png", ...]}
+        -> {"status": "ok", "job": {"id": 0, "status": "queued", ...}}
+           (or {"status": "error", ...} if the queue is full)
+    {"command": "status", "id": 0}
+    {"command": "wait", "id": 0, "timeout": 10.0}
+        -> {"status": "ok", "job": {"id": 0, "status": "finished", "outputs": [...], "error": null}}
+    {"command": "shutdown"}
+
+export_args are the same command-line options as for headless batch processing
+(--export_source, --output_filename_format, --input_axes, etc.).  They only apply to their own job.
+Paths should be absolute, since they are interpreted in the server's working directory.
+"""
+import os
+import json
+import socket
+import logging
+import threading
+import Queue
+from collections import OrderedDict
+from SocketServer import StreamRequestHandler, ThreadingMixIn, TCPServer, UnixStreamServer
+
+logger = logging.getLogger(__name__)
+
+class JobStatus(object):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+class Job(object):
+    def __init__(self, job_id, inputs, export_args):
+        self.id = job_id
+        self.inputs = inputs
+        self.export_args = export_args
+        self.status = JobStatus.QUEUED
+        self.outputs = None
+        self.error = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return { "id" : self.id,
+                 "status" : self.status,
+                 "inputs" : self.inputs,
+                 "outputs" : self.outputs,
+                 "error" : self.error }
+
+def batch_export_runner(workflow):
+    """
+    Return a function run_job(inputs, export_args) -> output paths that exports the given
+    input files through the workflow's batch processing applet.
+    The export settings given by export_args are reset to the project's settings after each job.
+    """
+    opDataExport = workflow.dataExportApplet.topLevelOperator
+    setting_slots = [ opDataExport.InputSelection, opDataExport.RegionStart, opDataExport.RegionStop,
+                      opDataExport.InputMin, opDataExport.InputMax, opDataExport.ExportMin, opDataExport.ExportMax,
+                      opDataExport.ExportDtype, opDataExport.OutputAxisOrder, opDataExport.OutputFilenameFormat,
+                      opDataExport.OutputInternalPath, opDataExport.OutputFormat, opDataExport.TableOnly,
+                      opDataExport.ExportRois, opDataExport.ExportRoiMask, opDataExport.RoiExportMode ]
+
+    def run_job(inputs, export_args):
+        # Options for the input files (e.g. --input_axes) may be mixed into the export args.
+        export_parsed_args, unused_args = workflow.dataExportApplet.parse_known_cmdline_args( list(export_args) )
+        input_parsed_args, unused_args = workflow.batchProcessingApplet.parse_known_cmdline_args( unused_args + list(inputs) )
+        if unused_args:
+            raise ValueError( "Unknown arguments: {}".format( unused_args ) )
+
+        saved_settings = [ (slot, slot.value if slot.ready() else None) for slot in setting_slots ]
+        working_dir_partner = opDataExport.WorkingDirectory.partner
+        working_dir = opDataExport.WorkingDirectory.value if opDataExport.WorkingDirectory.ready() else None
+        try:
+            workflow.dataExportApplet.configure_operator_with_parsed_args( export_parsed_args )
+            return workflow.batchProcessingApplet.run_export_from_parsed_args( input_parsed_args )
+        finally:
+            opDataExport.TransactionSlot.disconnect()
+            for slot, value in saved_settings:
+                if value is None:
+                    slot.disconnect()
+                else:
+                    slot.setValue( value )
+            if working_dir_partner is not None:
+                opDataExport.WorkingDirectory.connect( working_dir_partner )
+            elif working_dir is not None:
+                opDataExport.WorkingDirectory.setValue( working_dir )
+            opDataExport.TransactionSlot.setValue( True )
+    return run_job
+
+class _RequestHandler(StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads( line )
+            reply = self.server.prediction_server.handle_request( request )
+        except Exception as ex:
+            logger.error( "Bad request: {}".format( ex ) )
+            reply = { "status" : "error", "error" : str(ex) }
+        self.wfile.write( json.dumps( reply ) + "\n" )
+
+class _ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _ThreadingUnixStreamServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def parse_address(address):
+    """
+    Parse a server address given as 'host:port' (TCP) or as a filesystem path (UNIX socket).
+    """
+    if ':' in address and not os.path.sep in address:
+        host, port = address.rsplit(':', 1)
+        return (host or 'localhost', int(port))
+    return address
+
+class PredictionServer(object):
+    """
+    Accepts jobs over a local socket and runs them, one at a time, with the given run_job function.
+    At most max_queued_jobs jobs may wait in the queue; further submissions are rejected until it drains.
+    """
+    # The number of finished jobs whose status is remembered
+    MAX_JOB_HISTORY = 10000
+
+    def __init__(self, run_job, address=('localhost', 0), max_queued_jobs=16):
+        self._run_job = run_job
+        self._queue = Queue.Queue( max_queued_jobs )
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._next_job_id = 0
+        self._shutdown_requested = threading.Event()
+
+        if isinstance(address, tuple):
+            if address[0] not in ('localhost', '127.0.0.1', '::1'):
+                raise ValueError( "The prediction server only listens on the local host, not on {}".format( address[0] ) )
+            self._server = _ThreadingTCPServer( address, _RequestHandler )
+        else:
+            if os.path.exists( address ):
+                os.remove( address )
+            self._server = _ThreadingUnixStreamServer( address, _RequestHandler )
+        self._server.prediction_server = self
+        self.address = self._server.server_address
+
+        self._worker = threading.Thread( target=self._process_jobs, name="PredictionServerWorker" )
+        self._worker.daemon = True
+        self._worker.start()
+
+    def serve_forever(self):
+        """
+        Handle requests until a shutdown command is received (or shutdown() is called).
+        """
+        logger.info( "Prediction server listening on {}".format( self.address ) )
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if not isinstance(self.address, tuple) and os.path.exists( self.address ):
+                os.remove( self.address )
+            self._stop_worker()
+            self._worker.join()
+
+    def shutdown(self):
+        """
+        Stop accepting requests.  The job that is currently running is finished; queued jobs are discarded.
+        """
+        self._stop_worker()
+        # (This may be called from a request handler, so let the server shut down asynchronously.)
+        threading.Thread( target=self._server.shutdown ).start()
+
+    def _stop_worker(self):
+        self._shutdown_requested.set()
+        try:
+            self._queue.put_nowait( None )
+        except Queue.Full:
+            # The worker will notice the shutdown when it takes the next job.
+            pass
+
+    def handle_request(self, request):
+        command = request.get("command")
+        if command == "submit":
+            return self.submit( request.get("inputs", []), request.get("export_args", []) )
+        if command == "status":
+            return self._job_reply( request["id"] )
+        if command == "wait":
+            return self._job_reply( request["id"], wait=True, timeout=request.get("timeout") )
+        if command == "shutdown":
+            self.shutdown()
+            return { "status" : "ok" }
+        return { "status" : "error", "error" : "Unknown command: {}".format( command ) }
+
+    def submit(self, inputs, export_args):
+        if self._shutdown_requested.is_set():
+            return { "status" : "error", "error" : "The server is shutting down." }
+        if isinstance(inputs, basestring):
+            inputs = [inputs]
+        with self._jobs_lock:
+            job = Job( self._next_job_id, list(inputs), list(export_args) )
+            try:
+                self._queue.put_nowait( job )
+            except Queue.Full:
+                return { "status" : "error", "error" : "The job queue is full.  Try again later." }
+            self._next_job_id += 1
+            self._jobs[job.id] = job
+            self._forget_old_jobs()
+        return { "status" : "ok", "job" : job.to_dict() }
+
+    def _forget_old_jobs(self):
+        # (called with the jobs lock held)
+        while len(self._jobs) > self.MAX_JOB_HISTORY:
+            oldest = next( iter(self._jobs.values()) )
+            if not oldest.done.is_set():
+                break
+            del self._jobs[oldest.id]
+
+    def _job_reply(self, job_id, wait=False, timeout=None):
+        with self._jobs_lock:
+            job = self._jobs.get( job_id )
+        if job is None:
+            return { "status" : "error", "error" : "Unknown job: {}".format( job_id ) }
+        if wait:
+            job.done.wait( timeout )
+        return { "status" : "ok", "job" : job.to_dict() }
+
+    def _process_jobs(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if self._shutdown_requested.is_set():
+                self._discard_job( job )
+                break
+            job.status = JobStatus.RUNNING
+            logger.info( "Starting job {}: {}".format( job.id, job.inputs ) )
+            try:
+                job.outputs = self._run_job( job.inputs, job.export_args )
+                job.status = JobStatus.FINISHED
+                logger.info( "Finished job {}".format( job.id ) )
+            except Exception as ex:
+                logger.error( "Job {} failed: {}".format( job.id, ex ), exc_info=True )
+                job.error = "{}: {}".format( type(ex).__name__, ex )
+                job.status = JobStatus.FAILED
+            finally:
+                job.done.set()
+
+        # Discarded jobs still need an answer
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if job is not None:
+                self._discard_job( job )
+
+    def _discard_job(self, job):
+        job.error = "The server was shut down."
+        job.status = JobStatus.FAILED
+        job.done.set()
+
+class PredictionClient(object):
+    """
+    Submits jobs to a PredictionServer.
+    """
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = timeout
+
+    def _send(self, request):
+        if isinstance(self.address, tuple):
+            s = socket.create_connection( self.address, self.timeout )
+        else:
+            s = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+            s.settimeout( self.timeout )
+            s.connect( self.address )
+        try:
+            s.sendall( json.dumps( request ) + "\n" )
+            reply = json.loads( s.makefile("rb").readline() )
+        finally:
+            s.close()
+        if reply["status"] != "ok":
+            raise RuntimeError( reply["error"] )
+        return reply.get("job")
+
+    def submit(self, inputs, export_args=()):
+        """
+        Submit a job and return its status dict.  Relative input paths are made absolute.
+        """
+        if isinstance(inputs, basestring):
+            inputs = [inputs]
+        inputs = map( os.path.abspath, inputs )
+        return self._send( { "command" : "submit", "inputs" : inputs, "export_args" : list(export_args) } )
+
+    def status(self, job_id):
+        return self._send( { "command" : "status", "id" : job_id } )
+
+    def wait(self, job_id, timeout=None):
+        """
+        Wait until the given job is finished (or failed) and return its status dict.
+        """
+        return self._send( { "command" : "wait", "id" : job_id, "timeout" : timeout } )
+
+    def shutdown(self):
+        self._send( { "command" : "shutdown" } )
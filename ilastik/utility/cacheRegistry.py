@@ -0,0 +1,325 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+import weakref
+import threading
+import logging
+import collections
+
+from ilastik.utility.singleton import Singleton
+
+logger = logging.getLogger(__name__)
+
+"""
+A central registry for the applet-level caches.
+
+The lazyflow CacheMemoryManager only knows about lazyflow cache operators,
+and it only knows about 'least recently used'.  Several applets keep their own
+caches (plain dicts of arrays or of sub-pipelines), which grow without bound.
+Caches of both kinds can be registered here, and the registry will keep the
+total usage of all registered caches below the budget configured via
+``[lazyflow] total_ram_mb`` (or ``LAZYFLOW_TOTAL_RAM_MB``).
+
+When the budget is exceeded, blocks are evicted in order of increasing *value*,
+where the value of a block is its recompute cost (recompute time x size) divided
+by the time since it was last accessed.  Expensive, recently used blocks are
+therefore kept, while cheap and stale blocks are dropped first.
+
+Example::
+
+    registry = CacheRegistry()
+
+    # a dict-based cache
+    self._cache_entry = registry.registerDictCache( "my cache", self._evictBlock )
+    ...
+    self._cache_entry.insert( key, nbytes, compute_seconds )
+    self._cache_entry.touch( key )
+
+    # a lazyflow cache operator
+    registry.registerOperatorCache( "my op cache", self._opCache )
+"""
+
+CacheReport = collections.namedtuple( 'CacheReport', 'name usedMemory lastAccessTime numBlocks' )
+BlockInfo = collections.namedtuple( 'BlockInfo', 'key nbytes lastAccessTime computeSeconds' )
+
+class DictCacheEntry(object):
+    """
+    Bookkeeping for a cache that is maintained by its owner (e.g. a dict of arrays).
+    The owner reports insertions, accesses and removals.  When the registry decides to
+    evict a block, it calls the owner's ``evict_callback(key)``, which must remove the block.
+    The callback may return False to refuse the eviction (e.g. if the block is in use).
+
+    If the callback is a bound method, only a weak reference to its owner is kept,
+    so registering doesn't keep the owner alive.
+    """
+    def __init__(self, name, evict_callback, registry):
+        self.name = name
+        if hasattr( evict_callback, 'im_self' ):
+            self._owner = weakref.ref( evict_callback.im_self )
+            self._evict_func = evict_callback.im_func
+        else:
+            self._owner = None
+            self._evict_func = evict_callback
+        self._registry = registry
+        self._lock = threading.Lock()
+        self._blocks = {} # key -> BlockInfo
+
+    def insert(self, key, nbytes, compute_seconds):
+        with self._lock:
+            self._blocks[key] = BlockInfo( key, nbytes, time.time(), compute_seconds )
+        self._registry.enforceBudget()
+
+    def touch(self, key):
+        with self._lock:
+            try:
+                self._blocks[key] = self._blocks[key]._replace( lastAccessTime=time.time() )
+            except KeyError:
+                pass
+
+    def discard(self, key):
+        with self._lock:
+            self._blocks.pop( key, None )
+
+    def clear(self):
+        with self._lock:
+            self._blocks = {}
+
+    def usedMemory(self):
+        with self._lock:
+            return sum( b.nbytes for b in self._blocks.values() )
+
+    def lastAccessTime(self):
+        with self._lock:
+            return max( [b.lastAccessTime for b in self._blocks.values()] or [0.0] )
+
+    def blocks(self):
+        with self._lock:
+            return self._blocks.values()
+
+    def freeBlock(self, key):
+        if self._owner is None:
+            evicted = self._evict_func( key )
+        else:
+            owner = self._owner()
+            if owner is None:
+                return False
+            evicted = self._evict_func( owner, key )
+        if evicted is False:
+            return False
+        self.discard( key )
+        return True
+
+    def alive(self):
+        return self._owner is None or self._owner() is not None
+
+class OperatorCacheEntry(object):
+    """
+    Adapter for a lazyflow cache operator (and any caches among its children).
+    Recompute time can't be measured for these caches, so the owner supplies an
+    estimate of the recompute cost in seconds per megabyte.
+    """
+    def __init__(self, name, op, seconds_per_mb):
+        self.name = name
+        self._op = weakref.ref( op )
+        self._seconds_per_byte = seconds_per_mb / float(1024**2)
+
+    def _managedCaches(self):
+        op = self._op()
+        if op is None:
+            return []
+        caches = []
+        pending = [op]
+        while pending:
+            o = pending.pop()
+            if hasattr( o, 'getBlockAccessTimes' ) or hasattr( o, 'freeMemory' ):
+                caches.append(o)
+            else:
+                pending += list( getattr( o, 'children', [] ) )
+        return caches
+
+    def usedMemory(self):
+        return sum( c.usedMemory() for c in self._managedCaches() )
+
+    def lastAccessTime(self):
+        return max( [c.lastAccessTime() for c in self._managedCaches()] or [0.0] )
+
+    def blocks(self):
+        blocks = []
+        for cache in self._managedCaches():
+            if hasattr( cache, 'getBlockAccessTimes' ):
+                access_times = list( cache.getBlockAccessTimes() )
+                if not access_times:
+                    continue
+                # Blocked caches don't report per-block sizes, so split the total evenly.
+                nbytes = cache.usedMemory() // len(access_times)
+                for key, t in access_times:
+                    blocks.append( BlockInfo( (cache, key), nbytes, t, self._seconds_per_byte * nbytes ) )
+            else:
+                nbytes = cache.usedMemory()
+                if nbytes > 0:
+                    blocks.append( BlockInfo( (cache, None), nbytes, cache.lastAccessTime(),
+                                              self._seconds_per_byte * nbytes ) )
+        return blocks
+
+    def freeBlock(self, key):
+        cache, block_key = key
+        if block_key is None:
+            cache.freeMemory()
+        else:
+            cache.freeBlock( block_key )
+        return True
+
+    def alive(self):
+        return self._op() is not None
+
+class CacheRegistry(object):
+    """
+    Singleton that tracks the applet-level caches and enforces the shared RAM budget.
+    """
+    __metaclass__ = Singleton
+
+    # Blocks that were accessed more recently than this are never evicted,
+    # since they are likely part of a request that is still in flight.
+    MINIMUM_BLOCK_AGE_SECONDS = 5.0
+
+    # Operator caches don't notify us when they grow, so they are polled at this interval.
+    REFRESH_INTERVAL_SECONDS = 10.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._entries = []
+        self._budget_bytes = None
+        self._monitor_thread = None
+
+    def _ensureMonitorRunning(self):
+        with self._lock:
+            if self._monitor_thread is not None:
+                return
+            self._monitor_thread = threading.Thread( target=self._monitor, name="CacheRegistryMonitor" )
+            self._monitor_thread.daemon = True
+            self._monitor_thread.start()
+
+    def _monitor(self):
+        while True:
+            time.sleep( self.REFRESH_INTERVAL_SECONDS )
+            try:
+                self.enforceBudget()
+            except Exception:
+                logger.exception( "Failed to enforce the cache budget" )
+
+    def setBudget(self, nbytes):
+        """
+        Set the total RAM budget for all registered caches (in bytes).
+        A budget of 0 or None means 'unlimited'.
+        """
+        self._budget_bytes = nbytes or 0
+        self.enforceBudget()
+
+    def budget(self):
+        if self._budget_bytes is None:
+            from ilastik.config import cfg as ilastik_config
+            self._budget_bytes = ilastik_config.getint('lazyflow', 'total_ram_mb') * 1024**2
+        return self._budget_bytes
+
+    def registerDictCache(self, name, evict_callback):
+        entry = DictCacheEntry( name, evict_callback, self )
+        with self._lock:
+            self._entries.append( entry )
+        return entry
+
+    def registerOperatorCache(self, name, op, seconds_per_mb=1.0):
+        entry = OperatorCacheEntry( name, op, seconds_per_mb )
+        with self._lock:
+            self._entries.append( entry )
+        self._ensureMonitorRunning()
+        return entry
+
+    def unregister(self, entry):
+        with self._lock:
+            if entry in self._entries:
+                self._entries.remove( entry )
+
+    def _liveEntries(self):
+        with self._lock:
+            self._entries = filter( lambda e: e.alive(), self._entries )
+            return list( self._entries )
+
+    def report(self):
+        """
+        Return a CacheReport for every registered cache.
+        """
+        return [ CacheReport( e.name, e.usedMemory(), e.lastAccessTime(), len(e.blocks()) )
+                 for e in self._liveEntries() ]
+
+    def totalUsedMemory(self):
+        return sum( e.usedMemory() for e in self._liveEntries() )
+
+    def enforceBudget(self):
+        """
+        If the registered caches use more than the budget, evict the least valuable
+        blocks until the total is below the budget again.
+        Returns the number of bytes that were freed.
+        """
+        budget = self.budget()
+        if not budget:
+            return 0
+
+        # Only one thread evicts at a time.  Others can skip: the budget is being taken care of.
+        if not self._evict_lock.acquire(False):
+            return 0
+        try:
+            entries = self._liveEntries()
+            used = sum( e.usedMemory() for e in entries )
+            if used <= budget:
+                return 0
+
+            now = time.time()
+            candidates = []
+            for entry in entries:
+                for block in entry.blocks():
+                    age = now - block.lastAccessTime
+                    if age < self.MINIMUM_BLOCK_AGE_SECONDS:
+                        continue
+                    cost = block.computeSeconds * block.nbytes
+                    candidates.append( (cost / (1.0 + age), block.lastAccessTime, entry, block) )
+            candidates.sort( key=lambda c: c[:2] )
+
+            freed = 0
+            for _, _, entry, block in candidates:
+                if used - freed <= budget:
+                    break
+                logger.debug( "Evicting block {} from cache '{}' ({} bytes)"
+                              .format( block.key, entry.name, block.nbytes ) )
+                try:
+                    if not entry.freeBlock( block.key ):
+                        continue
+                except Exception:
+                    logger.exception( "Could not evict block {} from cache '{}'".format( block.key, entry.name ) )
+                    continue
+                freed += block.nbytes
+
+            if used - freed > budget:
+                logger.debug( "Cache budget still exceeded after eviction: {} of {} bytes in use"
+                              .format( used - freed, budget ) )
+            return freed
+        finally:
+            self._evict_lock.release()
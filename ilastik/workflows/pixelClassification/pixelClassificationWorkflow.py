@@ -19,6 +19,7 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 from __future__ import division
+import os
 import sys
 import copy
 import argparse
@@ -31,6 +32,7 @@ from ilastik.config import cfg as ilastik_config
 from ilastik.workflow import Workflow
 from ilastik.applets.dataSelection import DataSelectionApplet
 from ilastik.applets.featureSelection import FeatureSelectionApplet
+from ilastik.applets.featureSelection.opPersistentFeatureCache import pruneFeatureCache
 from ilastik.applets.pixelClassification import PixelClassificationApplet, PixelClassificationDataExportApplet
 from ilastik.applets.batchProcessing import BatchProcessingApplet
 
@@ -46,7 +48,8 @@ class PixelClassificationWorkflow(Workflow):
     DATA_ROLE_RAW = 0
     DATA_ROLE_PREDICTION_MASK = 1
     ROLE_NAMES = ['Raw Data', 'Prediction Mask']
-    EXPORT_NAMES = ['Probabilities', 'Simple Segmentation', 'Uncertainty', 'Features', 'Labels']
+    EXPORT_NAMES = ['Probabilities', 'Simple Segmentation', 'Uncertainty', 'Features', 'Labels',
+                    'Probabilities + Segmentation + Uncertainty']
     
     @property
     def applets(self):
@@ -75,6 +78,9 @@ class PixelClassificationWorkflow(Workflow):
         parser.add_argument('--tree-count', help='Number of trees for Vigra RF classifier.', type=int)
         parser.add_argument('--variable-importance-path', help='Location of variable-importance table.', type=str)
         parser.add_argument('--label-proportion', help='Proportion of feature-pixels used to train the classifier.', type=float)
+        parser.add_argument('--persistent-feature-cache', help="Store computed features next to the project file, and re-use them in later sessions. "
+                                                               "Cache files that have not been used for --feature-cache-max-age days are removed when the project is loaded.", action="store_true")
+        parser.add_argument('--feature-cache-max-age', help="Number of days after which unused persistent feature cache files are removed.", default=30, type=float)
 
         # Parse the creation args: These were saved to the project file when this project was first created.
         parsed_creation_args, unused_args = parser.parse_known_args(project_creation_args)
@@ -91,6 +97,8 @@ class PixelClassificationWorkflow(Workflow):
         self.tree_count = parsed_args.tree_count
         self.variable_importance_path = parsed_args.variable_importance_path
         self.label_proportion = parsed_args.label_proportion
+        self.persistent_feature_cache = parsed_args.persistent_feature_cache
+        self.feature_cache_max_age = parsed_args.feature_cache_max_age
 
         if parsed_args.filter and parsed_args.filter != parsed_creation_args.filter:
             logger.error("Ignoring new --filter setting.  Filter implementation cannot be changed after initial project creation.")
@@ -227,6 +235,7 @@ class PixelClassificationWorkflow(Workflow):
         opDataExport.Inputs[2].connect( opClassify.HeadlessUncertaintyEstimate )
         opDataExport.Inputs[3].connect( opClassify.FeatureImages )
         opDataExport.Inputs[4].connect( opClassify.LabelImages )
+        opDataExport.Inputs[5].connect( opClassify.HeadlessFusedPredictions )
         for slot in opDataExport.Inputs:
             assert slot.partner is not None
 
@@ -291,6 +300,18 @@ class PixelClassificationWorkflow(Workflow):
         the workflow for batch mode and export all results.
         (This workflow's headless mode supports only batch mode for now.)
         """
+        if self.persistent_feature_cache and projectManager.currentProjectPath:
+            cache_dir = os.path.splitext( projectManager.currentProjectPath )[0] + "_feature_cache"
+            logger.info("Using persistent feature cache: {}".format( cache_dir ))
+            opFeatureSelection = self.featureSelectionApplet.topLevelOperator
+            opFeatureSelection.PersistentCacheDirectory.setValue( cache_dir )
+
+            # Cache files are keyed by the input data and the feature selection, so files from
+            # old inputs or feature selections are never used again.
+            # We can't tell those apart from the files of batch inputs (which aren't loaded yet),
+            # so we only remove the files that haven't been used for a while.
+            pruneFeatureCache( cache_dir, self.feature_cache_max_age )
+
         if self.generate_random_labels:
             self._generate_random_labels(self.random_label_count, self.random_label_value)
             logger.info("Saving project...")
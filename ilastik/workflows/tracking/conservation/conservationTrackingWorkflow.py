@@ -1,4 +1,6 @@
 import os
+import sys
+import argparse
 from lazyflow.graph import Graph
 from lazyflow.utility import PathComponents, make_absolute, format_known_keys
 from ilastik.workflow import Workflow
@@ -162,9 +164,34 @@ class ConservationTrackingWorkflowBase( Workflow ):
             self._data_export_args = None
             self._batch_input_args = None
 
+        # Windowed tracking settings for headless mode (override the ones stored in the project)
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--tracking-window-size', help="Track in overlapping time windows of this many frames (0: track the whole movie at once).", type=int)
+        parser.add_argument('--tracking-window-overlap', help="Number of frames shared by consecutive tracking windows.", type=int)
+        parsed_args, unused_args = parser.parse_known_args( unused_args or [] )
+        self.tracking_window_size = parsed_args.tracking_window_size
+        self.tracking_window_overlap = parsed_args.tracking_window_overlap
+        self._validate_tracking_window_args( self.tracking_window_size, self.tracking_window_overlap )
+
         if unused_args:
             logger.warn("Unused command-line args: {}".format( unused_args ))
         
+    @staticmethod
+    def _validate_tracking_window_args(window_size, window_overlap):
+        """
+        Exit with an error message if the windowed tracking settings are invalid.
+        None stands for a setting that is taken from the project file.
+        """
+        msg = None
+        if window_size is not None and window_size < 0:
+            msg = "Error: --tracking-window-size must be 0 (no windows) or positive, not {}".format( window_size )
+        elif window_size != 0 and window_overlap is not None and window_overlap < 2:
+            msg = "Error: --tracking-window-overlap must be at least 2 frames, not {}".format( window_overlap )
+        elif window_size and window_overlap is not None and window_size <= window_overlap:
+            msg = "Error: --tracking-window-size ({}) must be larger than --tracking-window-overlap ({})".format( window_size, window_overlap )
+        if msg:
+            sys.exit(msg)
+
     @property
     def applets(self):
         return self._applets
@@ -332,6 +359,11 @@ class ConservationTrackingWorkflowBase( Workflow ):
         else:
             self.prev_z_range = z_range
         
+        windowSize = self.tracking_window_size if self.tracking_window_size is not None else parameters.get('windowSize', 0)
+        windowOverlap = self.tracking_window_overlap if self.tracking_window_overlap is not None else parameters.get('windowOverlap', 10)
+        # One of them may come from the project file, so check the combination again
+        self._validate_tracking_window_args( windowSize, windowOverlap )
+
         self.trackingApplet.topLevelOperator[lane_index].track(
             time_range = time_enum,
             x_range = x_range,
@@ -361,6 +393,8 @@ class ConservationTrackingWorkflowBase( Workflow ):
             disappearance_cost = parameters['disappearanceCost'],
             max_nearest_neighbors = parameters['max_nearest_neighbors'],
             numFramesPerSplit = parameters['numFramesPerSplit'],
+            windowSize = windowSize,
+            windowOverlap = windowOverlap,
             force_build_hypotheses_graph = False,
             withBatchProcessing = True
         )
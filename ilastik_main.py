@@ -33,6 +33,9 @@ parser.add_argument('--playback_speed', help='Speed to play the playback script.
 parser.add_argument('--exit_on_failure', help='Immediately call exit(1) if an unhandled exception occurs.', action='store_true', default=False)
 parser.add_argument('--exit_on_success', help='Quit the app when the playback is complete.', action='store_true', default=False)
 
+parser.add_argument('--serve', help="Headless only: keep the project loaded and process batch jobs submitted to this local address ('host:port' or a UNIX socket path).", required=False)
+parser.add_argument('--max_queued_jobs', help='Maximum number of jobs waiting in the --serve job queue.', default=16, type=int)
+
 def main( parsed_args, workflow_cmdline_args=[], init_logging=True ):
     """
     init_logging: Skip logging config initialization by setting this to False.
@@ -74,6 +77,11 @@ def main( parsed_args, workflow_cmdline_args=[], init_logging=True ):
     if create_fn:
         postinit_funcs.append( create_fn )
 
+    # Must be last: it blocks until the server is shut down.
+    serve_fn = _prepare_prediction_server( parsed_args )
+    if serve_fn:
+        postinit_funcs.append( serve_fn )
+
     _enable_faulthandler()
     _init_excepthooks( parsed_args )
     eventcapture_mode, playback_args = _prepare_test_recording_and_playback( parsed_args )    
@@ -196,6 +204,10 @@ def _validate_arg_compatibility( parsed_args ):
         sys.stderr.write("Some of the command-line options you provided are not supported in headless mode.  Exiting.")
         sys.exit(1)
 
+    if parsed_args.serve and not ( parsed_args.headless and parsed_args.project ):
+        sys.stderr.write("The --serve option requires --headless and --project.  Exiting.")
+        sys.exit(1)
+
 def _import_opengm():
     # Import opengm first if possible, to make sure it is included before vigra.
     # Otherwise the import fails and we will not get access to GraphCut thresholding
@@ -247,6 +259,10 @@ def _prepare_lazyflow_config( parsed_args ):
                 fmt = Memory.format(ram)
                 logger.info("Configuring lazyflow RAM limit to {}".format(fmt))
                 Memory.setAvailableRam(ram)
+
+                # The applet-level caches share the same budget.
+                from ilastik.utility import CacheRegistry
+                CacheRegistry().setBudget(ram)
         return _configure_lazyflow_settings
     return None
 
@@ -320,6 +336,17 @@ def _prepare_auto_create_new_project( parsed_args ):
         shell.createAndLoadNewProject(path, workflow_class)
     return createNewProject
 
+def _prepare_prediction_server( parsed_args ):
+    if parsed_args.serve is None:
+        return None
+    def serve(shell):
+        from ilastik.shell.headless.predictionServer import PredictionServer, batch_export_runner, parse_address
+        server = PredictionServer( batch_export_runner(shell.workflow),
+                                   parse_address(parsed_args.serve),
+                                   parsed_args.max_queued_jobs )
+        server.serve_forever()
+    return serve
+
 def _prepare_test_recording_and_playback( parsed_args ):
     if parsed_args.start_recording or parsed_args.playback_script:
         # Disable the opengl widgets during recording and playback.
@@ -0,0 +1,53 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+
+class OpCountingPiper(Operator):
+    """
+    Pipes the input through and counts what was requested from it:
+    num_requested_pixels counts the requested pixels (of all axes, including channels),
+    num_requested_slices counts the requested slices along the first axis.
+    If fail_at is set, requests that reach beyond that slice (along the first axis) raise an exception.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpCountingPiper, self).__init__(*args, **kwargs)
+        self.num_requested_pixels = 0
+        self.num_requested_slices = 0
+        self.fail_at = None
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        if self.fail_at is not None and roi.stop[0] > self.fail_at:
+            raise RuntimeError("Simulated failure")
+        self.num_requested_pixels += numpy.prod( roi.stop - roi.start )
+        self.num_requested_slices += roi.stop[0] - roi.start[0]
+        self.Input(roi.start, roi.stop).writeInto(result).wait()
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
@@ -108,6 +108,23 @@ class TestOpBlockwiseObjectClassification(object):
                 "Blockwise prediction operator did not produce the same prediction image" \
                 "as the non-blockwise prediction operator!"
  
+    def testRegionFeaturesAfterEviction(self):
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 35, 'y' : 35, 'z' : 30} )
+        self.op.PredictionImage[:].wait()
+        features = self.op.BlockwiseRegionFeatures[:].wait()
+
+        # Simulate memory pressure: the CacheRegistry evicts all block pipelines
+        for block_start in list(self.op._blockPipelines.keys()):
+            assert self.op._evictBlockPipeline( block_start )
+        assert not self.op._blockPipelines
+
+        # The pipelines are rebuilt on demand
+        features_after_eviction = self.op.BlockwiseRegionFeatures[:].wait()
+        assert features_after_eviction.shape == features.shape
+        assert all( block_features is not None for block_features in features_after_eviction.flat )
+        assert len(self.op._blockPipelines) == features.size
+
     def testZeroHalo(self):
         # If we shrink the halo down to zero, then we get different predictions...
         # This block shape/halo combination will slice through some of the big blocks, causing mis-classification.
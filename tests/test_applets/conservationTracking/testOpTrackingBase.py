@@ -0,0 +1,155 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
+from ilastik.applets.tracking.base.trackingUtilities import get_dict_value
+
+# Object ids present in each frame (some of them large and sparse)
+OBJECTS = [ [1, 2, 3, 4],
+            [1, 2, 4, 5, 6, 1000],
+            [1, 2, 3, 4, 7, 8],
+            [1, 2, 5] ]
+
+EVENTS = { '0' : { 'merger' : [[4, 2, 0.5]] },
+           '1' : { 'app' : [[5, 0.1]],
+                   'mov' : [[1, 1, 0.1], [2, 1000, 0.1], [4, 4, 0.1]],
+                   'div' : [[3, 2, 6, 0.1]] },
+           '2' : { 'app' : [[7, 0.1]],
+                   'mov' : [[1, 1, 0.1], [1000, 2, 0.1]],
+                   'div' : [[5, 3, 4, 0.1]] },
+           '3' : { 'mov' : [[2, 2, 0.1], [7, 1, 0.1]] } }
+
+# Object 5 in the last frame was filtered out, object 8 in frame 2 is a misdetection
+FILTERED_LABELS = { '3' : [5] }
+
+
+def referenceLabel2Color(events, time_range, filtered_labels, export_mode=False):
+    """
+    The per-event loop that OpTrackingBase._setLabel2Color() used before the dense color arrays
+    (with successive ids).
+    """
+    label2color = [{} for _ in range(time_range[0] + 1)]
+    divisions = []
+    maxId = 2
+    for i in time_range:
+        app = get_dict_value(events[str(i - time_range[0] + 1)], "app", [])
+        div = get_dict_value(events[str(i - time_range[0] + 1)], "div", [])
+        mov = get_dict_value(events[str(i - time_range[0] + 1)], "mov", [])
+
+        label2color.append({})
+        for e in app:
+            label2color[-1][int(e[0])] = maxId
+            maxId += 1
+
+        for e in mov:
+            if int(e[0]) not in label2color[-2]:
+                label2color[-2][int(e[0])] = maxId
+                maxId += 1
+            label2color[-1][int(e[1])] = label2color[-2][int(e[0])]
+
+        for e in div:
+            if int(e[0]) not in label2color[-2]:
+                label2color[-2][int(e[0])] = maxId
+                maxId += 1
+            ancestor_color = label2color[-2][int(e[0])]
+            if export_mode:
+                label2color[-1][int(e[1])] = maxId
+                label2color[-1][int(e[2])] = maxId + 1
+                divisions.append((i, int(e[0]), ancestor_color, int(e[1]), maxId, int(e[2]), maxId + 1))
+                maxId += 2
+            else:
+                label2color[-1][int(e[1])] = ancestor_color
+                label2color[-1][int(e[2])] = ancestor_color
+
+    for i in filtered_labels.keys():
+        if int(i) + time_range[0] >= len(label2color):
+            continue
+        for l in filtered_labels[i]:
+            label2color[int(i) + time_range[0]][l] = 0
+
+    return label2color, divisions
+
+
+class TestOpTrackingBase(object):
+    def setUp(self):
+        # one pixel per object, t,x,y,z,c
+        labels = np.zeros((len(OBJECTS), 10, 2, 1, 1), dtype=np.uint32)
+        for t, ids in enumerate(OBJECTS):
+            labels[t, :len(ids), 0, 0, 0] = ids
+        labels = vigra.taggedView(labels, 'txyzc')
+
+        self.labels = labels
+        self.time_range = [0, len(OBJECTS) - 1]
+
+        op = OpTrackingBase(graph=Graph())
+        op.LabelImage.setValue(labels)
+        op.RawImage.setValue(labels)
+        op.ObjectFeatures.setValue({})
+        op.ComputedFeatureNames.setValue({})
+        op.FilteredLabels.setValue(FILTERED_LABELS)
+        op.Parameters.setValue({'time_range' : self.time_range})
+        op.EventsVector.setValue(EVENTS)
+        self.op = op
+
+    def tearDown(self):
+        self.op.cleanUp()
+
+    def testColorsMatchEventLoop(self):
+        self.op._setLabel2Color()
+        expected, _ = referenceLabel2Color(EVENTS, range(*self.time_range), FILTERED_LABELS)
+        assert self.op.label2color == expected, "{} != {}".format(self.op.label2color, expected)
+
+    def testExportedTrackIdsMatchEventLoop(self):
+        label2color, _, divisions = self.op.export_track_ids()
+        expected, expected_divisions = referenceLabel2Color(EVENTS, range(*self.time_range), FILTERED_LABELS,
+                                                            export_mode=True)
+        assert label2color == expected, "{} != {}".format(label2color, expected)
+        assert divisions == expected_divisions, "{} != {}".format(divisions, expected_divisions)
+
+    def testOutputIsRelabeledWithTheColors(self):
+        self.op._setLabel2Color()
+        output = self.op.Output[:].wait()
+        assert output.shape == self.labels.shape
+
+        labels = self.labels.view(np.ndarray)
+        for t, ids in enumerate(OBJECTS):
+            assert (output[t][labels[t] == 0] == 0).all()
+            for label in ids:
+                # objects without a color are misdetections
+                expected = self.op.label2color[t].get(label, 1)
+                assert (output[t][labels[t] == label] == expected).all(), \
+                    "object {} at t={}: {}".format(label, t, output[t][labels[t] == label])
+
+        # e.g. object 2 keeps its color over the whole track (via object 1000),
+        # the filtered object is removed
+        assert output[3, 1, 0, 0, 0] == output[1, 5, 0, 0, 0] == output[0, 1, 0, 0, 0] > 1
+        assert output[3, 2, 0, 0, 0] == 0
+        assert output[2, 5, 0, 0, 0] == 1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,306 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import vigra
+import h5py
+import networkx as nx
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.rtype import List
+from lazyflow.stype import Opaque
+from lazyflow.operators.opArrayPiper import OpArrayPiper
+from hytra.core.jsongraph import getMappingsBetweenUUIDsAndTraxels
+
+from ilastik.plugins_default.tracking_h5_event_export import TrackingH5EventExportFormatPlugin
+from ilastik.plugins_default.tracking_mamut_export import TrackingMamutExportFormatPlugin, BigDataViewerExporter
+
+# A tiny tracking result: object ids per frame, active links ((t, label) -> (t+1, label)),
+# divisions (parent (t, label)) and mergers ((t, label): number of objects)
+OBJECTS = [ [1, 2], [1, 2, 3], [1, 2] ]
+LINKS = [ ((0, 1), (1, 1)), ((0, 2), (1, 2)), ((0, 2), (1, 3)), ((1, 1), (2, 1)), ((1, 3), (2, 2)) ]
+DIVISIONS = [ (0, 2) ]
+MERGERS = { (2, 1) : 2 }
+
+
+def createLabelImage():
+    """
+    One 2x2 square per object, t,x,y,z,c
+    """
+    labels = np.zeros((len(OBJECTS), 8, 6, 1, 1), dtype=np.uint32)
+    for t, ids in enumerate(OBJECTS):
+        for i, label in enumerate(ids):
+            labels[t, 2*i:2*i+2, label:label+2, 0, 0] = label
+    return vigra.taggedView(labels, 'txyzc')
+
+def createFeatures(labels):
+    """
+    The standard object features of each frame, with a row for the background
+    and one unused label at the end.
+    """
+    features = {}
+    for t in range(labels.shape[0]):
+        frame = labels[t, ..., 0].view(np.ndarray)
+        numRows = frame.max() + 2
+        counts = np.bincount(frame.reshape(-1), minlength=numRows)
+        centers = np.zeros((numRows, 3), dtype=np.float32)
+        coords = np.indices(frame.shape).reshape(3, -1)
+        for label in range(1, numRows):
+            if counts[label] > 0:
+                centers[label] = coords[:, frame.reshape(-1) == label].mean(axis=1)
+        features[t] = { 'Standard Object Features' : { 'Count' : counts.reshape(-1, 1).astype(np.float32),
+                                                       'RegionCenter' : centers,
+                                                       'RegionRadii' : np.ones((numRows, 3), dtype=np.float32) } }
+    return features
+
+
+class TinyHypothesesGraph(object):
+    """
+    Provides the tracking result above the way the export plugins access a solved
+    hytra.core.hypothesesgraph.HypothesesGraph.
+    """
+    def __init__(self):
+        self.uuids = {}
+        for t, ids in enumerate(OBJECTS):
+            for label in ids:
+                self.uuids[(t, label)] = len(self.uuids)
+
+        # the solved graph, with the lineage (and track) ids of the objects in the first frame
+        self._graph = nx.DiGraph()
+        for node, uuid in self.uuids.items():
+            self._graph.add_node(node, id=uuid, value=MERGERS.get(node, 1), trackId=node[1], lineageId=node[1])
+        for a, b in sorted(LINKS):
+            lineage = self._graph.node[a]['lineageId']
+            self._graph.node[b]['trackId'] = self._graph.node[b]['lineageId'] = lineage
+            self._graph.add_edge(a, b, value=1)
+
+    def getMappingsBetweenUUIDsAndTraxels(self):
+        model = { 'traxelToUniqueId' : {} }
+        for (t, label), uuid in self.uuids.items():
+            model['traxelToUniqueId'].setdefault(str(t), {})[str(label)] = uuid
+        return getMappingsBetweenUUIDsAndTraxels(model)
+
+    def getSolutionDictionary(self):
+        return { 'detectionResults' : [ { 'id' : uuid, 'value' : MERGERS.get(node, 1) } for node, uuid in self.uuids.items() ],
+                 'linkingResults' : [ { 'src' : self.uuids[a], 'dest' : self.uuids[b], 'value' : 1 } for a, b in LINKS ],
+                 'divisionResults' : [ { 'id' : self.uuids[node], 'value' : True } for node in DIVISIONS ] }
+
+
+class OpObjectFeatures(Operator):
+    """Provides the features of all frames as a List-rtype slot, like the RegionFeaturesAll output."""
+    Input = InputSlot(stype=Opaque, rtype=List)
+    Output = OutputSlot(stype=Opaque, rtype=List)
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        features = self.Input.value
+        timesteps = roi._l if len(roi._l) > 0 else features.keys()
+        return dict((t, features[t]) for t in timesteps)
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
+
+
+class TestTrackingExport(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        graph = Graph()
+
+        self.labels = createLabelImage()
+        self.opLabels = OpArrayPiper(graph=graph)
+        self.opLabels.Input.setValue(self.labels)
+
+        self.opFeatures = OpObjectFeatures(graph=graph)
+        self.opFeatures.Input.setValue(createFeatures(self.labels))
+
+        self.hypothesesGraph = TinyHypothesesGraph()
+
+    def tearDown(self):
+        self.opFeatures.cleanUp()
+        self.opLabels.cleanUp()
+        shutil.rmtree(self.tmpdir)
+
+
+class TestH5EventExport(TestTrackingExport):
+    def export(self, maxTimestepsInFlight):
+        plugin = TrackingH5EventExportFormatPlugin()
+        plugin.maxTimestepsInFlight = maxTimestepsInFlight
+        assert not plugin.checkFilesExist(self.tmpdir)
+        assert plugin.export(self.tmpdir, self.hypothesesGraph, self.opFeatures.Output, self.opLabels.Output, None)
+        assert plugin.checkFilesExist(self.tmpdir)
+
+    def readEvents(self, t):
+        events = {}
+        with h5py.File(os.path.join(self.tmpdir, 'H5-Event-Sequence', '{:05d}.h5'.format(t)), 'r') as f:
+            labels = f['segmentation/labels'][:]
+            ids = f['objects/meta/id'][:]
+            for name, dataset in f['tracking'].items():
+                events[name] = sorted(dataset[:].tolist())
+        return labels, ids, events
+
+    def checkExport(self):
+        expectedEvents = [ {},
+                           { 'Moves' : [[1, 1], [2, 2], [2, 3]], 'Splits' : [[2, 2, 3]] },
+                           { 'Moves' : [[1, 1], [3, 2]], 'Mergers' : [[1, 2]] } ]
+        for t, ids in enumerate(OBJECTS):
+            labels, exportedIds, events = self.readEvents(t)
+            assert (labels == self.labels[t:t+1].view(np.ndarray)).all()
+            # the ids are taken from the features, without the background and the unused label
+            assert exportedIds.tolist() == ids
+            assert events == expectedEvents[t], "t={}: {} != {}".format(t, events, expectedEvents[t])
+
+        assert sorted(os.listdir(os.path.join(self.tmpdir, 'H5-Event-Sequence'))) == \
+            ['{:05d}.h5'.format(t) for t in range(len(OBJECTS))]
+
+    def testExport(self):
+        self.export(4)
+        self.checkExport()
+
+    def testExportWithBoundedFramesInFlight(self):
+        # fewer frames in flight than frames
+        self.export(1)
+        self.checkExport()
+
+
+class SmallBlocksExporter(BigDataViewerExporter):
+    """Uses small chunks, blocks and levels, so that a small image needs several of each."""
+    chunkShape = (8, 8, 2)
+    blockShape = (16, 16, 4)
+    parallelBlocks = 2
+    minLevelSize = 16
+
+
+def downscale(level, factors):
+    """
+    Average zyx uint16 data over blocks of the given (x, y, z) factors.
+    """
+    shape = []
+    for size, f in zip(level.shape, factors[::-1]):
+        shape += [size // f, f]
+    return np.round(level.astype(np.float32).reshape(shape).mean(axis=(1, 3, 5))).astype(np.uint16)
+
+
+class TestBigDataViewerExport(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.opRaw = OpArrayPiper(graph=Graph())
+
+    def tearDown(self):
+        self.opRaw.cleanUp()
+        shutil.rmtree(self.tmpdir)
+
+    def export(self, data):
+        self.opRaw.Input.setValue(vigra.taggedView(data, 'txyzc'))
+        exporter = SmallBlocksExporter(self.opRaw.Output)
+        hdf5File = os.path.join(self.tmpdir, 'raw.h5')
+        xmlFile = os.path.join(self.tmpdir, 'bdv.xml')
+        exporter.writeHdf5(hdf5File)
+        exporter.writeXml(xmlFile, hdf5File)
+        return hdf5File, xmlFile
+
+    def testPyramid(self):
+        data = np.random.RandomState(0).randint(0, 2**16, size=(2, 40, 30, 6, 2)).astype(np.uint16)
+        hdf5File, xmlFile = self.export(data)
+
+        resolutions = [[1, 1, 1], [2, 2, 1], [4, 2, 1]]
+        with h5py.File(hdf5File, 'r') as f:
+            for c in range(2):
+                assert f['s{:02d}/resolutions'.format(c)][:].tolist() == resolutions
+                assert f['s{:02d}/subdivisions'.format(c)][:].tolist() == [[8, 8, 2], [8, 8, 2], [8, 8, 2]]
+                for t in range(2):
+                    # unsigned 16 bit data is stored as is, zyx
+                    level = f['t{:05d}/s{:02d}/0/cells'.format(t, c)][:].view(np.uint16)
+                    assert (level == data[t, ..., c].transpose()).all()
+
+                    # each level is the average of the previous one
+                    for i in range(1, len(resolutions)):
+                        factors = np.array(resolutions[i]) // np.array(resolutions[i - 1])
+                        expected = downscale(level, factors)
+                        level = f['t{:05d}/s{:02d}/{}/cells'.format(t, c, i)][:].view(np.uint16)
+                        assert level.shape == expected.shape
+                        assert (level == expected).all()
+                    assert level.shape == (6, 15, 10)
+
+        root = ET.parse(xmlFile).getroot()
+        assert root.find('SequenceDescription/ImageLoader/hdf5').text == 'raw.h5'
+        setups = root.findall('SequenceDescription/ViewSetups/ViewSetup')
+        assert [s.find('size').text for s in setups] == ['40 30 6', '40 30 6']
+        assert root.find('SequenceDescription/Timepoints/last').text == '1'
+        assert len(root.findall('ViewRegistrations/ViewRegistration')) == 4
+
+    def testFloatDataIsRescaled(self):
+        data = np.random.RandomState(0).rand(1, 20, 10, 3, 1).astype(np.float32) * 10 - 3
+        hdf5File, _ = self.export(data)
+
+        with h5py.File(hdf5File, 'r') as f:
+            level = f['t00000/s00/0/cells'][:].view(np.uint16).astype(np.float64)
+        expected = (data[0, ..., 0].transpose() - data.min()) * 65535. / (data.max() - data.min())
+        assert np.abs(level - expected).max() <= 1
+        assert level.min() == 0 and level.max() == 65535
+
+
+class TestMamutExport(TestTrackingExport):
+    def testExport(self):
+        raw = np.random.RandomState(0).randint(0, 256, size=self.labels.shape).astype(np.uint8)
+        opRaw = OpArrayPiper(graph=Graph())
+        opRaw.Input.setValue(vigra.taggedView(raw, 'txyzc'))
+
+        filename = os.path.join(self.tmpdir, 'tracking')
+        plugin = TrackingMamutExportFormatPlugin()
+        assert not plugin.checkFilesExist(filename)
+        assert plugin.export(filename, self.hypothesesGraph, self.opFeatures.Output, self.opLabels.Output, opRaw.Output)
+        assert plugin.checkFilesExist(filename)
+        opRaw.cleanUp()
+
+        with h5py.File(filename + '_raw.h5', 'r') as f:
+            for t in range(len(OBJECTS)):
+                assert (f['t{:05d}/s00/0/cells'.format(t)][:].view(np.uint16) == raw[t, ..., 0].transpose()).all()
+
+        # one spot per object, at the object's center
+        root = ET.parse(filename + '_mamut.xml').getroot()
+        features = self.opFeatures.Input.value
+        spots = {}
+        for spot in root.iter('Spot'):
+            spots[int(spot.get('ID'))] = spot
+        assert sorted(spots.keys()) == sorted(self.hypothesesGraph.uuids.values())
+        for (t, label), uuid in self.hypothesesGraph.uuids.items():
+            spot = spots[uuid]
+            center = features[t]['Standard Object Features']['RegionCenter'][label]
+            assert int(float(spot.get('FRAME'))) == t
+            assert np.allclose([float(spot.get('POSITION_' + axis)) for axis in 'XYZ'], center)
+
+        # one edge per link
+        uuids = self.hypothesesGraph.uuids
+        edges = set((int(edge.get('SPOT_SOURCE_ID')), int(edge.get('SPOT_TARGET_ID'))) for edge in root.iter('Edge'))
+        assert edges == set((uuids[a], uuids[b]) for a, b in LINKS)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,259 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+from ilastik.applets.tracking.base.trackingUtilities import dict_to_lut, relabel_with_lut, relabel, highlightMergers, \
+    traxel_arrays_at, clip_probabilities
+
+
+def referenceRelabel(volume, replace):
+    """
+    The per-label loop that relabel() used before the lookup tables.
+    """
+    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
+    mp[1:] = 1
+    for label in np.unique(volume):
+        if label > 0 and label in replace:
+            mp[label] = replace[label]
+    return mp[volume]
+
+def referenceHighlightMergers(volume, merger):
+    """
+    The per-label loop that highlightMergers() used before the lookup tables.
+    """
+    mp = np.zeros((np.amax(volume) + 1,), dtype=volume.dtype)
+    for label in np.unique(volume):
+        if label > 0 and label in merger:
+            mp[label] = merger[label]
+    return mp[volume]
+
+
+class TestDictToLut(object):
+    def testEmptyDict(self):
+        assert (dict_to_lut({}, 5, 1) == [0, 1, 1, 1, 1]).all()
+        assert (dict_to_lut({}, 5, 0) == 0).all()
+        assert len(dict_to_lut({}, 0, 1)) == 0
+
+    def testLabelZeroStaysBackground(self):
+        lut = dict_to_lut({0: 7, 1: 3}, 3, 1)
+        assert (lut == [0, 3, 1]).all()
+
+    def testMissingLabelsGetDefault(self):
+        lut = dict_to_lut({2: 5, 4: 0}, 6, 1)
+        assert (lut == [0, 1, 5, 1, 0, 1]).all()
+        lut = dict_to_lut({2: 5}, 4, 0)
+        assert (lut == [0, 0, 5, 0]).all()
+
+    def testLabelsOutsideOfTheTableAreIgnored(self):
+        lut = dict_to_lut({1: 2, 3: 4, 10**6: 9}, 4, 1)
+        assert (lut == [0, 2, 1, 4]).all()
+
+
+class TestRelabel(object):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.volume = rng.randint(0, 20, size=(10, 11, 3)).astype(np.uint32)
+        # Large, sparse ids
+        self.volume[0, 0, 0] = 10**6
+        self.volume[1, 0, 0] = 10**6 + 17
+        self.replace = {1: 4, 3: 0, 5: 12, 19: 19, 10**6: 3, 10**7: 8}
+
+    def testRelabelMatchesLoop(self):
+        expected = referenceRelabel(self.volume, self.replace)
+        result = relabel(self.volume, self.replace)
+        assert result.dtype == self.volume.dtype
+        assert (result == expected).all()
+        assert result[1, 0, 0] == 1
+        assert (result[self.volume == 0] == 0).all()
+
+    def testHighlightMergersMatchesLoop(self):
+        merger = {2: 2, 7: 3, 10**6 + 17: 4}
+        expected = referenceHighlightMergers(self.volume, merger)
+        result = highlightMergers(self.volume, merger)
+        assert (result == expected).all()
+        assert result[1, 0, 0] == 4
+        assert result[0, 0, 0] == 0
+
+    def testEmptyDict(self):
+        assert (relabel(self.volume, {}) == referenceRelabel(self.volume, {})).all()
+        assert (highlightMergers(self.volume, {}) == 0).all()
+
+    def testBackgroundOnly(self):
+        volume = np.zeros((4, 5), dtype=np.uint8)
+        assert (relabel(volume, {0: 3}) == 0).all()
+        assert (highlightMergers(volume, {}) == 0).all()
+
+    def testShortLutIsPadded(self):
+        # The table only covers labels 0..2, larger labels get the default
+        lut = dict_to_lut({1: 5, 2: 6}, 3, 1)
+        volume = np.array([[0, 1, 2], [3, 10**6, 2]], dtype=np.uint32)
+        assert (relabel_with_lut(volume, lut, 1) == [[0, 5, 6], [1, 1, 6]]).all()
+        assert (relabel_with_lut(volume, lut, 0) == [[0, 5, 6], [0, 0, 6]]).all()
+        assert (relabel_with_lut(volume, np.zeros((0,), dtype=np.int64), 1) == (volume > 0)).all()
+
+def referenceTraxelArrays(features_at, x_range, y_range, z_range, size_range):
+    """
+    The per-traxel loop that _generate_traxelstore() used before traxel_arrays_at().
+    """
+    rc = features_at['RegionCenter']
+    lower = features_at['Coord<Minimum>']
+    upper = features_at['Coord<Maximum>']
+    if rc.size:
+        rc = rc[1:, ...]
+        lower = lower[1:, ...]
+        upper = upper[1:, ...]
+    ct = features_at['Count']
+    if ct.size:
+        ct = ct[1:, ...]
+
+    com = []
+    inside = []
+    for idx in range(rc.shape[0]):
+        if len(rc[idx]) == 2:
+            x, y = rc[idx]
+            z = 0
+        elif len(rc[idx]) == 3:
+            x, y, z = rc[idx]
+        else:
+            raise ValueError("The RegionCenter feature must have dimensionality 2 or 3.")
+        size = ct[idx]
+        com.append([float(x), float(y), float(z)])
+        inside.append(not (x < x_range[0] or x >= x_range[1] or
+                           y < y_range[0] or y >= y_range[1] or
+                           z < z_range[0] or z >= z_range[1] or
+                           size < size_range[0] or size >= size_range[1]))
+    return com, lower.tolist(), upper.tolist(), [float(c) for c in np.ravel(ct)], inside
+
+def referenceClip(probs):
+    """
+    The per-value clipping that _generate_traxelstore() used before clip_probabilities().
+    """
+    clipped = []
+    for v in probs:
+        val = float(v)
+        if val < 0.0000001:
+            val = 0.0000001
+        if val > 0.99999999:
+            val = 0.99999999
+        clipped.append(val)
+    return clipped
+
+def createFeatures(num_objects, ndim, rng):
+    """
+    Region features of one frame, the first row is the background.
+    """
+    shape = np.array([20, 30, 10][:ndim])
+    lower = (rng.rand(num_objects + 1, ndim) * shape).astype(np.int32)
+    upper = lower + rng.randint(0, 5, size=(num_objects + 1, ndim)).astype(np.int32)
+    return { 'RegionCenter' : ((lower + upper) / 2.0).astype(np.float32),
+             'Coord<Minimum>' : lower,
+             'Coord<Maximum>' : upper,
+             'Count' : rng.randint(1, 100, size=(num_objects + 1, 1)).astype(np.uint32) }
+
+
+class TestTraxelArrays(object):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def checkFrame(self, features_at, ranges):
+        com, lower, upper, count, inside = traxel_arrays_at(features_at, *ranges)
+        expected = referenceTraxelArrays(features_at, *ranges)
+        assert com.shape == (len(count), 3)
+        assert com.tolist() == expected[0]
+        assert lower.tolist() == expected[1]
+        assert upper.tolist() == expected[2]
+        assert count.tolist() == expected[3]
+        assert inside.tolist() == expected[4]
+        return inside
+
+    def test3d(self):
+        features_at = createFeatures(50, 3, self.rng)
+        inside = self.checkFrame(features_at, ((0, 1000), (0, 1000), (0, 1000), (0, 100000)))
+        assert inside.all()
+        inside = self.checkFrame(features_at, ((2, 15), (5, 25), (0, 8), (10, 90)))
+        assert inside.any() and not inside.all()
+
+    def test2d(self):
+        features_at = createFeatures(50, 2, self.rng)
+        self.checkFrame(features_at, ((0, 1000), (0, 1000), (0, 1), (0, 100000)))
+        # z is always 0 for 2d data
+        inside = self.checkFrame(features_at, ((0, 1000), (0, 1000), (1, 2), (0, 100000)))
+        assert not inside.any()
+        inside = self.checkFrame(features_at, ((5, 12), (3, 20), (0, 1), (20, 60)))
+        assert inside.any() and not inside.all()
+
+    def testRangesAreHalfOpen(self):
+        features_at = { 'RegionCenter' : np.array([[0, 0], [5, 5], [10, 4], [4, 10], [9.5, 9.5]], dtype=np.float32),
+                        'Coord<Minimum>' : np.zeros((5, 2), dtype=np.int32),
+                        'Coord<Maximum>' : np.zeros((5, 2), dtype=np.int32),
+                        'Count' : np.array([[0], [10], [10], [10], [20]], dtype=np.uint32) }
+        inside = self.checkFrame(features_at, ((5, 10), (4, 10), (0, 1), (10, 20)))
+        assert inside.tolist() == [True, False, False, False]
+
+    def testEmptyFrame(self):
+        # only the background
+        features_at = createFeatures(0, 3, self.rng)
+        com, lower, upper, count, inside = traxel_arrays_at(features_at, (0, 10), (0, 10), (0, 10), (0, 10))
+        assert com.shape == (0, 3)
+        assert len(lower) == len(upper) == len(count) == len(inside) == 0
+
+        # no rows at all
+        features_at = { 'RegionCenter' : np.zeros((0, 3), dtype=np.float32),
+                        'Coord<Minimum>' : np.zeros((0, 3), dtype=np.int32),
+                        'Coord<Maximum>' : np.zeros((0, 3), dtype=np.int32),
+                        'Count' : np.zeros((0, 1), dtype=np.uint32) }
+        com, lower, upper, count, inside = traxel_arrays_at(features_at, (0, 10), (0, 10), (0, 10), (0, 10))
+        assert com.shape == (0, 3)
+        assert len(inside) == 0
+
+    def testWrongDimensionality(self):
+        features_at = createFeatures(3, 3, self.rng)
+        features_at['RegionCenter'] = np.zeros((4, 4), dtype=np.float32)
+        try:
+            traxel_arrays_at(features_at, (0, 10), (0, 10), (0, 10), (0, 10))
+        except ValueError:
+            pass
+        else:
+            assert False, "RegionCenter with 4 dimensions must be rejected"
+
+
+class TestClipProbabilities(object):
+    def testMatchesPerValueClipping(self):
+        probs = [0.0, 1e-9, 0.0000001, 0.3, 0.5, 0.99999999, 0.999999999, 1.0]
+        assert clip_probabilities(probs).tolist() == referenceClip(probs)
+
+    def testFrameOfProbabilities(self):
+        rng = np.random.RandomState(0)
+        # one row per object, like the detection probabilities of a frame
+        probs = rng.rand(20, 3).astype(np.float32)
+        probs[0] = [0.0, 1.0, 0.5]
+        probs[1] = [1e-12, 1.0 - 1e-12, 0.0]
+        clipped = clip_probabilities(probs)
+        assert clipped.dtype == np.float64
+        assert clipped.shape == probs.shape
+        assert clipped.tolist() == [referenceClip(row) for row in probs]
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,167 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+from ilastik.applets.tracking.conservation.windowedTracking import computeWindows, extractWindow, uuidTimesteps, trackWindowed, reconcileCut
+
+NUM_FRAMES = 50
+NUM_OBJECTS = 3
+
+def uuid(t, i):
+    return t * NUM_OBJECTS + i
+
+def createModel():
+    """
+    NUM_OBJECTS objects per frame, each linked to every object in the next frame.
+    """
+    model = { 'segmentationHypotheses' : [], 'linkingHypotheses' : [], 'traxelToUniqueId' : {}, 'settings' : {} }
+    for t in range(NUM_FRAMES):
+        model['traxelToUniqueId'][str(t)] = {}
+        for i in range(NUM_OBJECTS):
+            model['traxelToUniqueId'][str(t)][str(i + 1)] = uuid(t, i)
+            model['segmentationHypotheses'].append( { 'id' : uuid(t, i), 'features' : [[1.0], [0.0]],
+                                                      'appearanceFeatures' : [[0.0], [5.0]],
+                                                      'disappearanceFeatures' : [[0.0], [5.0]] } )
+            if t + 1 < NUM_FRAMES:
+                for j in range(NUM_OBJECTS):
+                    model['linkingHypotheses'].append( { 'src' : uuid(t, i), 'dest' : uuid(t + 1, j),
+                                                         'features' : [[0.0], [1.0]] } )
+    return model
+
+def straightSolver(model, weights):
+    """
+    Fake solver: every object is active and links to the object with the same index.
+    """
+    return { 'detectionResults' : [ { 'id' : s['id'], 'value' : 1 } for s in model['segmentationHypotheses'] ],
+             'linkingResults' : [ { 'src' : l['src'], 'dest' : l['dest'], 'value' : int(l['src'] % NUM_OBJECTS == l['dest'] % NUM_OBJECTS) }
+                                  for l in model['linkingHypotheses'] ] }
+
+def disagreeingSolver(model, weights):
+    """
+    Fake solver whose windows disagree: one object (depending on the window's first frame) is inactive
+    in the whole window, all other objects link to the object with the same index.
+    """
+    start = min( map( int, model['traxelToUniqueId'].keys() ) )
+    inactive = (start // 4) % NUM_OBJECTS
+    active = lambda uuid: uuid % NUM_OBJECTS != inactive
+    return { 'detectionResults' : [ { 'id' : s['id'], 'value' : int(active(s['id'])) } for s in model['segmentationHypotheses'] ],
+             'linkingResults' : [ { 'src' : l['src'], 'dest' : l['dest'],
+                                    'value' : int( active(l['src']) and l['src'] % NUM_OBJECTS == l['dest'] % NUM_OBJECTS ) }
+                                  for l in model['linkingHypotheses'] ] }
+
+def assertFlowConserved(result):
+    detections = dict( (e['id'], e['value']) for e in result['detectionResults'] )
+    divisions = dict( (e['id'], e['value']) for e in result.get('divisionResults', []) )
+    outgoing = {}
+    incoming = {}
+    for l in result['linkingResults']:
+        outgoing[l['src']] = outgoing.get(l['src'], 0) + l['value']
+        incoming[l['dest']] = incoming.get(l['dest'], 0) + l['value']
+    for uuid, value in detections.items():
+        assert incoming.get(uuid, 0) <= value
+        assert outgoing.get(uuid, 0) <= value + int(divisions.get(uuid, False))
+        if divisions.get(uuid, False):
+            assert outgoing.get(uuid, 0) == value + 1
+
+def canonical(result):
+    return dict( (key, sorted( sorted(e.items()) for e in entries )) for key, entries in result.items() )
+
+class TestWindowedTracking(object):
+    def testComputeWindows(self):
+        windows = computeWindows( 0, NUM_FRAMES, 20, 6 )
+        assert windows[0][0] == 0 and windows[-1][1] == NUM_FRAMES
+        for (start, stop, own_start, own_stop), next_window in zip(windows[:-1], windows[1:]):
+            assert stop - start <= 20
+            assert stop - next_window[0] == 6
+            # The owned frames are contiguous and lie away from the window borders
+            assert own_stop == next_window[2]
+            assert start <= own_start < own_stop <= stop
+            assert own_stop - next_window[0] >= 2 and stop - own_stop >= 2
+
+    def testExtractWindow(self):
+        model = createModel()
+        timesteps = uuidTimesteps( model )
+        window = extractWindow( model, timesteps, 10, 20, freeAppearance=True, freeDisappearance=False )
+        ids = set( s['id'] for s in window['segmentationHypotheses'] )
+        assert ids == set( uuid(t, i) for t in range(10, 20) for i in range(NUM_OBJECTS) )
+        assert all( l['src'] in ids and l['dest'] in ids for l in window['linkingHypotheses'] )
+        assert len(window['linkingHypotheses']) == 9 * NUM_OBJECTS**2
+        assert sorted( map( int, window['traxelToUniqueId'].keys() ) ) == range(10, 20)
+
+        for s in window['segmentationHypotheses']:
+            if timesteps[s['id']][0] == 10:
+                assert s['appearanceFeatures'] == [[0.0], [0.0]]
+            else:
+                assert s['appearanceFeatures'] == [[0.0], [5.0]]
+            assert s['disappearanceFeatures'] == [[0.0], [5.0]]
+
+        # The model itself must not be modified
+        assert all( s['appearanceFeatures'] == [[0.0], [5.0]] for s in model['segmentationHypotheses'] )
+
+    def testStitchedResultMatchesFullSolve(self):
+        model = createModel()
+        expected = canonical( straightSolver( model, {} ) )
+        result = canonical( trackWindowed( model, {}, straightSolver, 12, 4 ) )
+        assert result == expected
+
+    def testDisagreeingWindows(self):
+        model = createModel()
+        windows = computeWindows( 0, NUM_FRAMES, 12, 4 )
+        result = trackWindowed( model, {}, disagreeingSolver, 12, 4 )
+        assertFlowConserved( result )
+
+        # Every link of the stitched result is active in one of the windows that contain it,
+        # and links between active detections of the same object survive the cuts
+        detections = dict( (e['id'], e['value']) for e in result['detectionResults'] )
+        links = dict( ( (l['src'], l['dest']), l['value'] ) for l in result['linkingResults'] )
+        assert len(links) == len(model['linkingHypotheses'])
+        for (src, dest), value in links.items():
+            if value:
+                assert src % NUM_OBJECTS == dest % NUM_OBJECTS
+            elif src % NUM_OBJECTS == dest % NUM_OBJECTS:
+                assert not (detections[src] and detections[dest])
+
+        # The windows really disagree at the cuts
+        cut = windows[0][3]
+        inactive_before = [ i for i in range(NUM_OBJECTS) if not detections[uuid(cut - 1, i)] ]
+        inactive_after = [ i for i in range(NUM_OBJECTS) if not detections[uuid(cut, i)] ]
+        assert inactive_before != inactive_after
+
+    def testDivisionAtCut(self):
+        # Parent 0 in frame 0 divides into 1 and 2 in frame 1, but the window after the cut turned off 2
+        timesteps = { 0 : (0, 0), 1 : (1, 1), 2 : (1, 1) }
+        before = { 'linkingResults' : [ { 'src' : 0, 'dest' : 1, 'value' : 1 }, { 'src' : 0, 'dest' : 2, 'value' : 1 } ] }
+        after = { 'linkingResults' : [ { 'src' : 0, 'dest' : 1, 'value' : 1 }, { 'src' : 0, 'dest' : 2, 'value' : 0 } ] }
+        detections = { 0 : 1, 1 : 1, 2 : 0 }
+        divisions = { 0 : True }
+        links = reconcileCut( before, after, 1, timesteps, [], detections, divisions )
+        assert sorted( (l['src'], l['dest'], l['value']) for l in links ) == [ (0, 1, 1), (0, 2, 0) ]
+        assert divisions == { 0 : False }
+
+    def testSingleWindow(self):
+        model = createModel()
+        result = trackWindowed( model, {}, straightSolver, 2 * NUM_FRAMES, 10 )
+        assert canonical( result ) == canonical( straightSolver( model, {} ) )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
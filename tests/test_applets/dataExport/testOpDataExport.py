@@ -24,12 +24,17 @@ import shutil
 
 import numpy
 import vigra
+import h5py
 
 from lazyflow.graph import Graph
 from lazyflow.roi import roiToSlice
+from lazyflow.operators import OpArrayPiper
 from lazyflow.operators.ioOperators import OpInputDataReader
 
 from ilastik.applets.dataExport.opDataExport import OpDataExport
+from ilastik.applets.dataExport.roiExport import roisFromMask, writeRois
+
+from tests.helpers.opCountingPiper import OpCountingPiper
 
 class TestOpDataExport(object):
     
@@ -96,6 +101,145 @@ class TestOpDataExport(object):
         finally:
             opRead.cleanUp()
 
+    def _setupRoiExport(self, graph, data, nickname):
+        opPiper = OpCountingPiper(graph=graph)
+        opPiper.Input.setValue(data)
+
+        opExport = OpDataExport(graph=graph)
+        opExport.TransactionSlot.setValue(True)
+        opExport.WorkingDirectory.setValue( self._tmpdir )
+
+        class MockDatasetInfo(object): pass
+        rawInfo = MockDatasetInfo()
+        rawInfo.nickname = nickname
+        rawInfo.filePath = './somefile.h5'
+        opExport.RawDatasetInfo.setValue( rawInfo )
+        opExport.SelectionNames.setValue(['Mock Export Data'])
+        opExport.Inputs.resize(1)
+        opExport.Inputs[0].connect( opPiper.Output )
+
+        opExport.OutputFormat.setValue( 'hdf5' )
+        opExport.OutputFilenameFormat.setValue( '{dataset_dir}/{nickname}' )
+        opExport.OutputInternalPath.setValue('volume/data')
+        return opPiper, opExport
+
+    def testSparseRoiExport(self):
+        graph = Graph()
+        data = numpy.random.random( (1000,1000,1) ).astype( numpy.float32 )
+        data = vigra.taggedView( data, 'xyc' )
+        opPiper, opExport = self._setupRoiExport( graph, data, 'sparse_rois' )
+        try:
+            rois = [ ((10, 20, None), (30, 40, None)), ((250, 260, 0), (260, 300, 1)) ]
+            opExport.ExportRois.setValue( rois )
+            opExport.run_export()
+            external_path, internal_path = opExport.ExportPath.value.split('.h5/')
+        finally:
+            opExport.cleanUp()
+
+        # Only the blocks around the ROIs were computed
+        assert 0 < opPiper.num_requested_pixels < data.size / 2
+
+        with h5py.File( external_path + '.h5', 'r' ) as f:
+            exported = f[internal_path][:]
+        assert exported.shape == data.shape
+        for start, stop in [ ((10, 20, 0), (30, 40, 1)), ((250, 260, 0), (260, 300, 1)) ]:
+            assert (exported[roiToSlice(start, stop)] == data.view(numpy.ndarray)[roiToSlice(start, stop)]).all()
+        # Far from the ROIs, nothing was written
+        assert (exported[800:1000, 800:1000] == 0).all()
+
+    def testSeparateRoiExport(self):
+        graph = Graph()
+        data = numpy.random.random( (100,100,1) ).astype( numpy.float32 )
+        data = vigra.taggedView( data, 'xyc' )
+        opPiper, opExport = self._setupRoiExport( graph, data, 'separate_rois' )
+        try:
+            # The ROIs are given in input coordinates, so they are shifted by the subregion start.
+            opExport.RegionStart.setValue( (10, 10, 0) )
+            opExport.RegionStop.setValue( (90, 90, 1) )
+            opExport.ExportRois.setValue( [ ((0, 0, 0), (20, 30, 1)), ((50, 60, 0), (55, 70, 1)) ] )
+            opExport.RoiExportMode.setValue( 'separate' )
+            opExport.run_export()
+            external_path, internal_path = opExport.ExportPath.value.split('.h5/')
+        finally:
+            opExport.cleanUp()
+
+        with h5py.File( external_path + '.h5', 'r' ) as f:
+            group = f[internal_path]
+            assert sorted(group.keys()) == ['roi_0', 'roi_1']
+            assert (group['roi_0'][:] == data.view(numpy.ndarray)[10:20, 10:30]).all()
+            assert (group['roi_1'][:] == data.view(numpy.ndarray)[50:55, 60:70]).all()
+            assert tuple(group['roi_1'].attrs['start']) == (40, 50, 0)
+
+    def testMaskRoiExport(self):
+        graph = Graph()
+        data = numpy.random.random( (1000,1000,1) ).astype( numpy.float32 )
+        data = vigra.taggedView( data, 'xyc' )
+
+        # A few nonzero pixels, all in the first block of the mask
+        mask = numpy.zeros( (1000,1000,1), dtype=numpy.uint8 )
+        mask[100:110, 200:205] = 1
+        mask[300, 50] = 1
+        mask_path = os.path.join( self._tmpdir, 'roi_mask.h5' )
+        with h5py.File( mask_path, 'w' ) as f:
+            f.create_dataset( 'mask', data=mask )
+            f['mask'].attrs['axistags'] = vigra.defaultAxistags('xyc').toJSON()
+
+        opPiper, opExport = self._setupRoiExport( graph, data, 'mask_rois' )
+        try:
+            opExport.ExportRoiMask.setValue( mask_path + '/mask' )
+            opExport.run_export()
+            external_path, internal_path = opExport.ExportPath.value.split('.h5/')
+        finally:
+            opExport.cleanUp()
+
+        # Only the blocks around the mask block were computed
+        assert 0 < opPiper.num_requested_pixels < data.size / 2
+
+        with h5py.File( external_path + '.h5', 'r' ) as f:
+            exported = f[internal_path][:]
+        assert exported.shape == data.shape
+        assert (exported[100:110, 200:205] == data.view(numpy.ndarray)[100:110, 200:205]).all()
+        assert exported[300, 50] == data.view(numpy.ndarray)[300, 50]
+        # Far from the mask, nothing was written
+        assert (exported[800:1000, 800:1000] == 0).all()
+
+    def testManyRois(self):
+        data = numpy.random.random( (200,200,1) ).astype( numpy.float32 )
+        opPiper = OpArrayPiper( graph=Graph() )
+        opPiper.Input.setValue( vigra.taggedView( data, 'xyc' ) )
+        # Too many ROIs to store their table in an hdf5 attribute (max. 64 KB)
+        rois = [ ((x, y, 0), (x+1, y+1, 1)) for x in range(0, 200, 5) for y in range(0, 200, 6) ]
+        assert len(rois) > 1000
+        export_path = os.path.join( self._tmpdir, 'many_rois.h5' )
+        try:
+            writeRois( opPiper.Output, rois, export_path, 'volume/data' )
+        finally:
+            opPiper.cleanUp()
+
+        with h5py.File( export_path, 'r' ) as f:
+            exported = f['volume/data'][:]
+            stored_rois = f['volume/data_rois'][:]
+        assert stored_rois.shape == (len(rois), 2, 3)
+        assert (stored_rois == numpy.array(rois)).all()
+        for start, stop in rois:
+            assert exported[roiToSlice(start, stop)] == data[roiToSlice(start, stop)]
+
+    def testRoisFromMask(self):
+        mask = numpy.zeros( (40, 30), dtype=numpy.uint8 )
+        mask[15, 5] = 1
+        mask[35, 25] = 3
+        mask[36:40, 20:30] = 1
+        opMask = OpArrayPiper( graph=Graph() )
+        opMask.Input.setValue( vigra.taggedView( mask, 'yx' ) )
+        try:
+            # The boxes are given in the axis order of the image to export.
+            # Axes that the mask doesn't have, and channels, are None (the full range).
+            rois = roisFromMask( opMask.Output, ['x', 'y', 'z', 'c'], blockshape=(10, 10) )
+        finally:
+            opMask.cleanUp()
+        assert rois == [ ((0, 10, None, None), (10, 20, None, None)),
+                         ((20, 30, None, None), (30, 40, None, None)) ], rois
+
 if __name__ == "__main__":
     import sys
     import nose
@@ -23,9 +23,13 @@ import h5py
 import vigra
 import numpy
 import tempfile
+import collections
 from lazyflow.graph import Graph, OperatorWrapper
 from ilastik.applets.dataSelection.opDataSelection import OpMultiLaneDataSelectionGroup, DatasetInfo
 from ilastik.applets.dataSelection.dataSelectionSerializer import DataSelectionSerializer
+from ilastik.applets.dataSelection.projectDataStorage import chooseChunkShape, writeBlockShape, importStack, isImportComplete
+
+from tests.helpers.opCountingPiper import OpCountingPiper
 
 import logging
 logger = logging.getLogger(__name__)
@@ -134,7 +138,104 @@ class TestDataSelectionSerializer(object):
             assert operatorToLoad.Image[0].meta.axistags == operatorToSave.Image[0].meta.axistags
 
         os.remove(self.testProjectName)
-    
+
+    def testStorageLayout(self):
+        with h5py.File(self.testProjectName) as testProject:
+            testProject.create_dataset("ilastikVersion", data="1.0.0")
+
+            graph = Graph()
+            operatorToSave = OpMultiLaneDataSelectionGroup( graph=graph )
+            serializer = DataSelectionSerializer(operatorToSave, 'DataSelectionTest')
+            serializer.storageCompression = 'lzf'
+            serializer.chunkLayout = 'cubes'
+
+            operatorToSave.ProjectFile.setValue(testProject)
+            operatorToSave.WorkingDirectory.setValue( os.path.split(__file__)[0] )
+            operatorToSave.ProjectDataGroup.setValue( serializer.topGroupName + '/local_data' )
+
+            info = DatasetInfo()
+            info.filePath = self.tmpFilePath
+            info.location = DatasetInfo.Location.ProjectInternal
+            operatorToSave.DatasetRoles.setValue( ['Raw Data'] )
+            operatorToSave.DatasetGroup.resize(1)
+            operatorToSave.DatasetGroup[0][0].setValue(info)
+
+            progress = []
+            serializer.progressSignal.subscribe( progress.append )
+            serializer.serializeToHdf5(testProject, self.testProjectName)
+            assert progress[-1] == 100
+
+            dataset = testProject[serializer.topGroupName + '/local_data/' + info.datasetId]
+            assert dataset.compression == 'lzf'
+            assert dataset.attrs['chunk_layout'] == 'cubes'
+            assert dataset.chunks == dataset.shape # (The volume is smaller than one cube)
+            assert (dataset[...] == numpy.load(self.tmpFilePath)).all()
+
+            # The chunk shape is provided to readers
+            assert tuple(operatorToSave.Image[0].meta.ideal_blockshape) == dataset.chunks
+
+        os.remove(self.testProjectName)
+
+class TestProjectDataStorage(object):
+    def testChunkShapes(self):
+        image = collections.OrderedDict( [('t', 5), ('y', 1000), ('x', 600), ('c', 3)] )
+        assert chooseChunkShape( image ) == ( (1, 256, 256, 3), 'tiles' )
+
+        volume = collections.OrderedDict( [('z', 200), ('y', 1000), ('x', 30), ('c', 10)] )
+        assert chooseChunkShape( volume ) == ( (64, 64, 30, 1), 'cubes' )
+        assert chooseChunkShape( volume, 'tiles' ) == ( (1, 256, 30, 1), 'tiles' )
+
+    def testWriteBlocksAreChunkAligned(self):
+        shape = (200, 1000, 30, 10)
+        chunks = (64, 64, 30, 1)
+        blockshape = writeBlockShape( shape, chunks, 4 )
+        for block, chunk, size in zip(blockshape, chunks, shape):
+            assert block == size or block % chunk == 0
+        assert numpy.prod(blockshape) * 4 >= 16 * 2**20 or blockshape == shape
+
+    def testImportStackResume(self):
+        data = numpy.random.randint( 0, 255, (150, 70, 80, 1) ).astype(numpy.uint8)
+        data = vigra.taggedView( data, 'zyxc' )
+        opStack = OpCountingPiper( graph=Graph() )
+        opStack.Input.setValue( data )
+
+        # Batches of two slabs (64 slices each)
+        batch_bytes = 2 * 64 * 70 * 80
+        tmpFile = tempfile.NamedTemporaryFile(suffix='.h5', delete=False)
+        tmpFile.close()
+        try:
+            with h5py.File(tmpFile.name, 'w') as f:
+                # Interrupt the import in the second batch
+                opStack.fail_at = 140
+                try:
+                    importStack( opStack.Output, f, 'stack', 'z', source='stack/*.png', batch_bytes=batch_bytes )
+                except RuntimeError:
+                    pass
+                else:
+                    assert False, "Expected the import to fail"
+                assert not isImportComplete( f, 'stack' )
+                assert f['stack'].attrs['imported_slabs'] == 2
+
+            with h5py.File(tmpFile.name, 'a') as f:
+                # Resuming only reads the remaining slab
+                opStack.fail_at = None
+                opStack.num_requested_slices = 0
+                progress = []
+                importStack( opStack.Output, f, 'stack', 'z', source='stack/*.png',
+                             batch_bytes=batch_bytes, progress_callback=progress.append )
+                assert opStack.num_requested_slices == 150 - 128
+                assert progress == [100]
+                assert isImportComplete( f, 'stack' )
+                assert f['stack'].chunks == (64, 64, 64, 1)
+                assert (f['stack'][:] == data).all()
+
+                # A different stack replaces the old one
+                opStack.num_requested_slices = 0
+                importStack( opStack.Output, f, 'stack', 'z', source='other/*.png', batch_bytes=batch_bytes )
+                assert opStack.num_requested_slices == 150
+        finally:
+            os.remove(tmpFile.name)
+
 if __name__ == "__main__":
     import sys
     import nose
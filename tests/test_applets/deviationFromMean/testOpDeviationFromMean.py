@@ -0,0 +1,104 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.deviationFromMean.opDeviationFromMean import OpDeviationFromMean
+from ilastik.utility.cacheRegistry import CacheRegistry
+
+from tests.helpers.opCountingPiper import OpCountingPiper
+
+class TestOpDeviationFromMean(object):
+    def setUp(self):
+        graph = Graph()
+        self.images = [ vigra.taggedView( numpy.random.random( (100, 80) ).astype(numpy.float32), 'yx' )
+                        for _ in range(4) ]
+        self.pipers = []
+        self.op = OpDeviationFromMean( graph=graph )
+        self.op.BLOCK_VOLUME = 20*20
+        self.op.ScalingFactor.setValue( 2.0 )
+        self.op.Offset.setValue( 10.0 )
+        self.op.Input.resize( len(self.images) )
+        for i, image in enumerate(self.images):
+            piper = OpCountingPiper( graph=graph )
+            piper.Input.setValue( image )
+            self.op.Input[i].connect( piper.Output )
+            self.pipers.append( piper )
+
+    def _expected(self, index):
+        mean = numpy.sum( self.images, axis=0 ) / len(self.images)
+        return 10.0 + 2.0 * (self.images[index] - mean)
+
+    def testOutputs(self):
+        mean = numpy.sum( self.images, axis=0 ) / len(self.images)
+        assert numpy.allclose( self.op.Mean[:].wait(), mean )
+        for i in range(len(self.images)):
+            assert numpy.allclose( self.op.Output[i][:].wait(), self._expected(i) )
+        assert numpy.allclose( self.op.Output[2][10:35, 5:50].wait(), self._expected(2)[10:35, 5:50] )
+
+    def testSumIsShared(self):
+        self.op.Mean[:].wait()
+        for piper in self.pipers:
+            piper.num_requested_pixels = 0
+
+        # The mean is cached, so each output only reads its own input
+        for i in range(len(self.images)):
+            self.op.Output[i][:].wait()
+        for piper in self.pipers:
+            assert piper.num_requested_pixels == self.images[0].size
+
+    def testDirtyInput(self):
+        self.op.Output[0][:].wait()
+
+        dirty_regions = []
+        self.op.Output[3].notifyDirty( lambda slot, roi: dirty_regions.append( (tuple(roi.start), tuple(roi.stop)) ) )
+
+        self.images[1][0:10, 0:10] = 5.0
+        self.pipers[1].Input.setDirty( (0, 0), (10, 10) )
+        assert dirty_regions == [ ((0, 0), (10, 10)) ]
+
+        # Only the dirty block is recomputed from all inputs
+        for piper in self.pipers:
+            piper.num_requested_pixels = 0
+        assert numpy.allclose( self.op.Output[3][:].wait(), self._expected(3) )
+        assert 0 < self.pipers[0].num_requested_pixels < self.images[0].size // 4
+
+    def testEvictionWithinBudget(self):
+        # With a tiny budget, every new sum evicts the older ones right away
+        registry = CacheRegistry()
+        old_min_age = CacheRegistry.MINIMUM_BLOCK_AGE_SECONDS
+        CacheRegistry.MINIMUM_BLOCK_AGE_SECONDS = 0.0
+        registry.setBudget(1)
+        try:
+            mean = numpy.sum( self.images, axis=0 ) / len(self.images)
+            assert numpy.allclose( self.op.Mean[:].wait(), mean )
+            assert numpy.allclose( self.op.Output[1][:].wait(), self._expected(1) )
+        finally:
+            CacheRegistry.MINIMUM_BLOCK_AGE_SECONDS = old_min_age
+            registry.setBudget(0)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
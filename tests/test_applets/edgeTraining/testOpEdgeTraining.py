@@ -1,10 +1,14 @@
 import numpy as np
 import pandas as pd
+import vigra
+
+import ilastikrag
 
 from ilastikrag.util import generate_random_voronoi
 
 from lazyflow.graph import Graph
 from ilastik.applets.edgeTraining import OpEdgeTraining
+from ilastik.applets.edgeTraining.opEdgeTraining import OpComputeEdgeFeatures
 
 import logging
 logger = logging.getLogger("tests.test_applets.edgeTraining")
@@ -57,7 +61,40 @@ class TestOpEdgeTraining(object):
         # ON
         assert edge_prob_dict[edge_C] > 0.5, "Expected > 0.5, got {}".format(edge_prob_dict[edge_C])
         assert edge_prob_dict[edge_D] > 0.5, "Expected > 0.5, got {}".format(edge_prob_dict[edge_D])
-    
+
+    def testEdgeFeaturesMatchPerChannelComputation(self):
+        superpixels = generate_random_voronoi( (50,50,50), 30 )
+        rag = ilastikrag.Rag( superpixels )
+        superpixels = superpixels.insertChannelAxis()
+
+        # Three channels, the middle one without any selected features
+        voxel_data = np.random.random( superpixels.shape[:-1] + (3,) ).astype(np.float32)
+        voxel_data = vigra.taggedView( voxel_data, superpixels.axistags )
+        channel_names = ['A', 'B', 'C']
+        feature_names = { 'A' : ['standard_edge_mean', 'standard_edge_count'],
+                          'B' : [],
+                          'C' : ['standard_edge_maximum'] }
+
+        op = OpComputeEdgeFeatures( graph=Graph() )
+        op.VoxelData.setValue( voxel_data, extra_meta={'channel_names': channel_names} )
+        op.Rag.setValue( rag )
+        op.FeatureNames.setValue( feature_names )
+        edge_features_df = op.EdgeFeaturesDataFrame.value
+
+        # The previous implementation: one channel after another, merged with concat()
+        expected_dfs = []
+        for c, channel_name in enumerate(channel_names):
+            if not feature_names[channel_name]:
+                continue
+            channel_df = rag.compute_features( voxel_data[..., c], feature_names[channel_name] ).iloc[:, 2:]
+            channel_df.columns = [ channel_name + ' ' + name for name in channel_df.columns.values ]
+            expected_dfs.append( channel_df )
+        expected_df = pd.concat( [pd.DataFrame( rag.edge_ids, columns=['sp1', 'sp2'] )] + expected_dfs, axis=1 )
+
+        assert list(edge_features_df.columns) == list(expected_df.columns)
+        assert not any( name.startswith('B ') for name in edge_features_df.columns )
+        assert np.allclose( edge_features_df.values, expected_df.values )
+
 if __name__ == "__main__":
     import sys
     handler = logging.StreamHandler(sys.stdout)
@@ -0,0 +1,118 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import tempfile
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.featureSelection.opPersistentFeatureCache import OpPersistentFeatureCache, pruneFeatureCache
+
+from tests.helpers.opCountingPiper import OpCountingPiper
+
+class TestOpPersistentFeatureCache(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join( self.tmpdir, 'features.h5' )
+        data = numpy.random.random( (100,100,10,3) ).astype(numpy.float32)
+        self.data = vigra.taggedView( data, 'xyzc' )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _createPipeline(self):
+        graph = Graph()
+        opPiper = OpCountingPiper(graph=graph)
+        opPiper.Input.setValue( self.data )
+        opCache = OpPersistentFeatureCache(graph=graph)
+        opCache.Input.connect( opPiper.Output )
+        opCache.CacheFilePath.setValue( self.cache_path )
+        return opPiper, opCache
+
+    def testReuseAcrossSessions(self):
+        opPiper, opCache = self._createPipeline()
+        result = opCache.Output[10:20, :, 0:5, 1:2].wait()
+        assert (result == self.data[10:20, :, 0:5, 1:2]).all()
+        num_computed = opPiper.num_requested_pixels
+        assert num_computed > 0
+
+        # Same session: already-computed blocks come from the file
+        result = opCache.Output[10:20, :, 0:5, :].wait()
+        assert (result == self.data[10:20, :, 0:5, :]).all()
+        assert opPiper.num_requested_pixels == num_computed
+        opCache.cleanUp()
+
+        # New session: nothing is recomputed for the blocks we already have
+        opPiper, opCache = self._createPipeline()
+        result = opCache.Output[10:20, :, 0:5, :].wait()
+        assert (result == self.data[10:20, :, 0:5, :]).all()
+        assert opPiper.num_requested_pixels == 0
+
+        # ...but new blocks are computed
+        result = opCache.Output[:].wait()
+        assert (result == self.data).all()
+        assert opPiper.num_requested_pixels > 0
+        opCache.cleanUp()
+
+    def testDirtyBlocksAreRecomputed(self):
+        opPiper, opCache = self._createPipeline()
+        opCache.Output[:].wait()
+
+        self.data[0:10, 0:10, :, :] = 0
+        opPiper.Input.setDirty( (0,0,0,0), (10,10,10,3) )
+        opPiper.num_requested_pixels = 0
+
+        result = opCache.Output[:].wait()
+        assert (result == self.data).all()
+        assert 0 < opPiper.num_requested_pixels < self.data.size
+        opCache.cleanUp()
+
+    def testPruneStaleFiles(self):
+        opPiper, opCache = self._createPipeline()
+        opCache.Output[0:10, 0:10, :, :].wait()
+        opCache.cleanUp()
+        stale_path = os.path.join( self.tmpdir, 'stale.h5' )
+        open( stale_path, 'w' ).close()
+        ten_days_ago = time.time() - 10 * 24 * 60 * 60
+        os.utime( stale_path, (ten_days_ago, ten_days_ago) )
+        os.utime( self.cache_path, (ten_days_ago, ten_days_ago) )
+
+        # Re-opening the cache marks its file as recently used
+        opPiper, opCache = self._createPipeline()
+        opCache.cleanUp()
+        recent_path = os.path.join( self.tmpdir, 'recent.h5' )
+        open( recent_path, 'w' ).close()
+
+        removed = pruneFeatureCache( self.tmpdir, 5 )
+        assert removed == [stale_path]
+        assert os.path.exists( self.cache_path )
+        assert os.path.exists( recent_path )
+        assert not os.path.exists( stale_path )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,77 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+import nose
+
+from lazyflow.graph import Graph
+
+class TestOpIntegralImage(object):
+    def setUp(self):
+        # Skip if iiboost isn't installed.
+        try:
+            from ilastik.applets.iiboostFeatureSelection.opIIBoostFeatureSelection import OpIntegralImage
+        except ImportError:
+            raise nose.SkipTest
+
+        data = (numpy.random.random( (37, 29, 23, 3) ) * 100).astype(numpy.float32)
+        self.data = vigra.taggedView( data, 'xyzc' )
+        self.expected = data.copy()
+        for axis in range(3):
+            numpy.add.accumulate( self.expected, axis=axis, out=self.expected )
+
+        self.op = OpIntegralImage( graph=Graph() )
+        self.op.BLOCK_SHAPE = (10, 8, 7)
+        self.op.Input.setValue( self.data )
+
+    def testFullVolume(self):
+        result = self.op.Output[:].wait()
+        assert (result == self.expected).all()
+
+    def testSubregions(self):
+        # Any roi is a part of the full-volume integral image (bit-identical)
+        for _ in range(10):
+            start = [ numpy.random.randint(0, n) for n in self.data.shape[:-1] ]
+            stop = [ numpy.random.randint(a+1, n+1) for a, n in zip(start, self.data.shape[:-1]) ]
+            slicing = tuple( slice(a, b) for a, b in zip(start, stop) ) + (slice(1, 3),)
+            result = self.op.Output[slicing].wait()
+            assert (result == self.expected[slicing]).all()
+
+    def testDirty(self):
+        self.op.Output[:].wait()
+        dirty_regions = []
+        self.op.Output.notifyDirty( lambda slot, roi: dirty_regions.append( (tuple(roi.start), tuple(roi.stop)) ) )
+
+        self.data[20:25, 10:15, 5:10, :] += 1
+        self.op.Input.setDirty( (20, 10, 5, 0), (25, 15, 10, 3) )
+        assert dirty_regions == [ ((20, 10, 5, 0), (37, 29, 23, 3)) ]
+
+        expected = self.data.view(numpy.ndarray).copy()
+        for axis in range(3):
+            numpy.add.accumulate( expected, axis=axis, out=expected )
+        assert (self.op.Output[:].wait() == expected).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
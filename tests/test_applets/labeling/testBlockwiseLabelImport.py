@@ -0,0 +1,107 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import threading
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.operators import OpArrayPiper
+from ilastik.applets.labeling.blockwiseLabelImport import label_histogram, import_labels, LabelImportCancelled
+
+class OpLabelSink(Operator):
+    """
+    Records everything that is written into its Input via setInSlot().
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpLabelSink, self).__init__(*args, **kwargs)
+        self.data = None
+        self.num_writes = 0
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+        self.data = numpy.zeros( self.Input.meta.shape, dtype=self.Input.meta.dtype )
+
+    def execute(self, slot, subindex, roi, result):
+        result[:] = self.data[roi.toSlice()]
+
+    def setInSlot(self, slot, subindex, key, value):
+        self.data[key] = value
+        self.num_writes += 1
+
+    def propagateDirty(self, slot, subindex, roi):
+        pass
+
+class TestBlockwiseLabelImport(object):
+    def setUp(self):
+        self.graph = Graph()
+        data = numpy.zeros( (60, 50, 1), dtype=numpy.uint32 )
+        data[10:20, 10:20] = 7
+        data[30:40, 5:45] = 1000000000
+        data[45:50, 40:50] = 3
+        self.data = vigra.taggedView( data, 'xyc' )
+
+        self.opSource = OpArrayPiper( graph=self.graph )
+        self.opSource.Input.setValue( self.data )
+
+    def testHistogram(self):
+        progress = []
+        labels, counts = label_histogram( self.opSource.Output, blockshape=(16, 16, 1), progress_callback=progress.append )
+        assert list(labels) == [0, 3, 7, 1000000000]
+        assert list(counts) == [ (self.data == l).sum() for l in labels ]
+        assert progress[-1] == 100
+
+    def testImportWithMappingAndOffset(self):
+        labels, _ = label_histogram( self.opSource.Output )
+        new_labels = numpy.array( [0, 2, 1, 3] )
+
+        opSink = OpLabelSink( graph=self.graph )
+        opSink.Input.setValue( vigra.taggedView( numpy.zeros( (80, 60, 1), dtype=numpy.uint8 ), 'xyc' ) )
+
+        num_written = import_labels( self.opSource.Output, opSink.Input, (5, 3, 0), labels, new_labels, blockshape=(16, 16, 1) )
+        assert num_written == opSink.num_writes
+
+        expected = numpy.zeros( (80, 60, 1), dtype=numpy.uint8 )
+        expected[5:65, 3:53] = new_labels[ numpy.searchsorted(labels, self.data) ]
+        assert (opSink.data == expected).all()
+
+        # Blocks without labels were not written
+        assert num_written < 4 * 4
+
+    def testCancel(self):
+        cancel_event = threading.Event()
+        cancel_event.set()
+        try:
+            label_histogram( self.opSource.Output, blockshape=(16, 16, 1), cancel_event=cancel_event )
+        except LabelImportCancelled:
+            pass
+        else:
+            assert False, "Expected the histogram to be canceled."
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
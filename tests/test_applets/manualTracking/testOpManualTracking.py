@@ -0,0 +1,188 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import copy
+import numpy as np
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.tracking.manual.opManualTracking import OpManualTracking
+
+NUM_FRAMES = 3
+NUM_OBJECTS = 6
+
+
+def referenceLookup(labels, tid, t):
+    """
+    Find the objects of a track by scanning all annotations of a frame
+    (what lookup_oid_for_tid() did before the track index).
+    """
+    return set( oid for oid, tids in labels.get(t, {}).iteritems() if tid in tids )
+
+
+class TestOpManualTracking(object):
+    def setUp(self):
+        # one pixel per object, t,x,y,z,c
+        labels = np.zeros((NUM_FRAMES, NUM_OBJECTS + 2, 2, 1, 1), dtype=np.uint32)
+        labels[:, 1:NUM_OBJECTS + 1, 0, 0, 0] = np.arange(1, NUM_OBJECTS + 1)
+        labels = vigra.taggedView(labels, 'txyzc')
+        self.labelImage = labels
+
+        op = OpManualTracking(graph=Graph())
+        op.LabelImage.setValue(labels)
+        op.RawImage.setValue(labels)
+        op.BinaryImage.setValue(labels)
+        op.ObjectFeatures.setValue({})
+        op.ComputedFeatureNames.setValue({})
+        self.op = op
+
+        # track 1: object 1 in every frame, track 2: objects 2 and 3 (a merger) at t=0, then object 2,
+        # track 3 only exists in the last frame
+        for t in range(NUM_FRAMES):
+            op.addLabel(t, 1, 1)
+            op.addLabel(t, 2, 2)
+        op.addLabel(0, 3, 2)
+        op.addLabel(2, 4, 3)
+
+    def tearDown(self):
+        self.op.cleanUp()
+
+    def checkLookups(self):
+        op = self.op
+        for tid in range(1, 5):
+            for t in range(NUM_FRAMES):
+                expected = referenceLookup(op.labels, tid, t)
+                assert op.objectsOfTrack(tid, t) == expected, \
+                    "track {} at t={}: {} != {}".format(tid, t, op.objectsOfTrack(tid, t), expected)
+                if expected:
+                    assert op.lookup_oid_for_tid(tid, t) in expected
+                else:
+                    try:
+                        op.lookup_oid_for_tid(tid, t)
+                    except ValueError:
+                        pass
+                    else:
+                        assert False, "track {} should not be found at t={}".format(tid, t)
+            assert (tid in op.allTracks()) == any(referenceLookup(op.labels, tid, t) for t in range(NUM_FRAMES))
+
+    def checkImages(self):
+        op = self.op
+        trackImage = op.TrackImage[:].wait()
+        untrackedImage = op.UntrackedImage[:].wait()
+        labelImage = self.labelImage.view(np.ndarray)
+        for t in range(NUM_FRAMES):
+            for oid in range(NUM_OBJECTS + 1):
+                tids = op.tracksAt(t, oid)
+                pixels = labelImage[t] == oid
+                if oid == 0 or not tids:
+                    assert (trackImage[t][pixels] == 0).all()
+                    assert (untrackedImage[t][pixels] == int(oid != 0)).all()
+                else:
+                    assert set(trackImage[t][pixels].tolist()) <= tids
+                    assert (untrackedImage[t][pixels] == 0).all()
+
+    def testLookups(self):
+        self.checkLookups()
+        assert self.op.lookup_oid_for_tid(1, 1) == 1
+        assert self.op.lookup_oid_for_tid(3, 2) == 4
+        assert self.op.objectsOfTrack(2) == {0: set([2, 3]), 1: set([2]), 2: set([2])}
+        self.checkImages()
+
+    def testRemoveLabels(self):
+        op = self.op
+        # Fill the lookup table caches first, so that they must be dropped
+        self.checkImages()
+
+        op.removeLabel(0, 2, 2)
+        self.checkLookups()
+        assert op.lookup_oid_for_tid(2, 0) == 3
+
+        # removing the last object of a track at t removes the track at t
+        op.removeLabel(2, 4, 3)
+        self.checkLookups()
+        assert 3 not in op.allTracks()
+        assert op.objectsOfTrack(3) == {}
+        self.checkImages()
+
+    def testEditLabels(self):
+        op = self.op
+        self.checkImages()
+
+        # move track 1 to object 5 at t=1, and give object 6 a second track
+        op.removeLabel(1, 1, 1)
+        op.addLabel(1, 5, 1)
+        op.addLabel(1, 6, 2)
+        op.addLabel(1, 6, 4)
+        self.checkLookups()
+        assert op.lookup_oid_for_tid(1, 1) == 5
+        assert op.objectsOfTrack(2, 1) == set([2, 6])
+        assert op.lookup_oid_for_tid(4, 1) == 6
+        self.checkImages()
+
+    def testAssignLabels(self):
+        # e.g. when loading a project: the index is rebuilt from the new dict
+        op = self.op
+        self.checkImages()
+
+        labels = copy.deepcopy(op.labels)
+        labels[1] = {3: set([1]), 4: set([2, 4])}
+        op.labels = labels
+        self.checkLookups()
+        assert op.lookup_oid_for_tid(1, 1) == 3
+        assert op.lookup_oid_for_tid(4, 1) == 4
+        self.checkImages()
+
+        op.labels = {}
+        assert op.allTracks() == []
+        self.checkLookups()
+
+    def testLineageExport(self):
+        # what the TIFF export writes: each track labeled with the track it descends from
+        op = self.op
+        op.addLabel(1, 3, 5)
+        op.addLabel(1, 4, 6)
+        op.addLabel(2, 5, 7)
+        op.addLabel(2, 6, 8)
+        op.addLabel(2, 3, -1)
+        op.divisions = { 2 : ([5, 6], 0), 5 : ([7, 8], 1) }
+
+        lineages = op.lineageIds(set([1, 2, 3]))
+        assert lineages == {1: 1, 2: 2, 3: 3, 5: 2, 6: 2, 7: 2, 8: 2}, lineages
+
+        trackImage = op.TrackImage[2:3].wait()[0, ..., 0]
+        relabeled = op.relabelToLineages(trackImage, lineages)
+        labelImage = self.labelImage.view(np.ndarray)[2, ..., 0]
+        # object 3 is a misdetection, the background and unlabeled objects stay 0
+        expected = {0: 0, 1: 1, 2: 2, 3: 0, 4: 3, 5: 2, 6: 2}
+        for oid, lineage in expected.items():
+            assert (relabeled[labelImage == oid] == lineage).all(), \
+                "object {}: {}".format(oid, relabeled[labelImage == oid])
+
+        # tracks that are not exported become background
+        relabeled = op.relabelToLineages(trackImage, {1: 1})
+        assert (relabeled[labelImage == 1] == 1).all()
+        assert (relabeled[labelImage != 1] == 0).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -24,7 +24,9 @@ ilastik.ilastik_logging.default_config.init()
 import unittest
 import numpy as np
 import vigra
-from lazyflow.graph import Graph
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.rtype import List
+from lazyflow.stype import Opaque
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
@@ -85,6 +87,25 @@ class TestOpRelabelSegmentation(object):
         assert (np.all(img[1, 10:20, 10:20, 10:20, 0] == 60))
         assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 70))
 
+class OpCountingFeatures(Operator):
+    """Passes the features through and records which time slices were requested."""
+    Input = InputSlot(stype=Opaque, rtype=List)
+    Output = OutputSlot(stype=Opaque, rtype=List)
+
+    def __init__(self, *args, **kwargs):
+        super(OpCountingFeatures, self).__init__(*args, **kwargs)
+        self.requested_times = []
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        self.requested_times.extend(roi._l)
+        return self.Input(roi._l).wait()
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
+
 class TestOpObjectTrain(unittest.TestCase):
     
     nRandomForests = 1
@@ -132,7 +153,39 @@ class TestOpObjectTrain(unittest.TestCase):
         
         classifier = self.op.Classifier.value        
         self.assertIsInstance(classifier, ParallelVigraRfLazyflowClassifier)
-            
+
+    def test_cached_features(self):
+        opCounting = OpCountingFeatures(graph=self.op.graph)
+        opCounting.Input.connect(self._opRegFeatsAdaptOutput.Output)
+        self.op.Features[0].connect(opCounting.Output)
+
+        labels = {0 : np.array([0, 1, 2]),
+                  1 : np.array([0, 0, 0, 0])}
+        self.op.LabelsCount.setValue(2)
+        self.op.Labels.resize(1)
+        self.op.Labels.setValue(labels)
+        self.op.Classifier.value
+        self.assertEqual(opCounting.requested_times, [0])
+
+        # Changing the label of an object whose features are known doesn't request features
+        labels = {0 : np.array([0, 2, 1]),
+                  1 : np.array([0, 0, 0, 0])}
+        self.op.Labels[0].setValue(labels)
+        self.op.Classifier.value
+        self.assertEqual(opCounting.requested_times, [0])
+
+        # Labeling objects in another time slice requests only that time slice
+        labels = {0 : np.array([0, 2, 1]),
+                  1 : np.array([0, 1, 2, 0])}
+        self.op.Labels[0].setValue(labels)
+        classifier = self.op.Classifier.value
+        self.assertEqual(opCounting.requested_times, [0, 1])
+        self.assertIsInstance(classifier, ParallelVigraRfLazyflowClassifier)
+
+        # Dirty features are requested again
+        self._opRegFeatsAdaptOutput.Output.setDirty([])
+        self.op.Classifier.value
+        self.assertEqual(sorted(opCounting.requested_times[2:]), [0, 1])
             
     def test_train_fail(self):
         segimg = segImage()
@@ -237,6 +290,28 @@ class TestOpObjectPredict(unittest.TestCase):
         
         self.assertTrue( np.all(probChannel0Time01[0]==probs[0][:, 0]) )
         self.assertTrue( np.all(probChannel0Time01[1]==probs[1][:, 0]) )
+
+    def test_invalidate_timestep(self):
+        ###
+        # dirty features only invalidate the affected time steps
+        ###
+        probs = self.op.Probabilities([0, 1]).wait()
+        self.assertEqual(sorted(self.op.CachedProbabilities([]).wait().keys()), [0, 1])
+
+        self.op.Features.setDirty(List(self.op.Features, [1]))
+        cached = self.op.CachedProbabilities([]).wait()
+        self.assertEqual(cached.keys(), [0])
+        self.assertTrue( cached[0] is probs[0] )
+
+        probs2 = self.op.Probabilities([0, 1]).wait()
+        self.assertTrue( probs2[0] is probs[0] )
+        self.assertTrue( np.all(probs2[1] == probs[1]) )
+
+        # a new classifier invalidates everything
+        self.trainop.ForestCount.setValue(2)
+        self.assertEqual(self.op.CachedProbabilities([]).wait(), {})
+        preds = self.op.Predictions([0, 1]).wait()
+        self.assertTrue(np.all(preds[0] == np.array([0, 1, 2])))
         
 
  
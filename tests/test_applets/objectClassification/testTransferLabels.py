@@ -53,6 +53,30 @@ class TestTransferLabelsFunction(object):
         newmin4 =  coords_new["Coord<Minimum>"][4]
         newmax4 = coords_new["Coord<Maximum>"][4]
         assert numpy.all(newlost["conflict"]==(newmin4+(newmax4-newmin4)/2.))
+
+    def testGrid2D(self):
+        # Objects on a grid, shifted by one pixel in the new segmentation,
+        # plus a new background object that covers everything
+        mins = numpy.array([[x, y] for x in range(0, 1000, 10) for y in range(0, 1000, 10)])
+        maxs = mins + 5
+        coords_old = {"Coord<Minimum>" : mins, "Coord<Maximum>" : maxs}
+        coords_new = {"Coord<Minimum>" : numpy.vstack(([[0, 0]], mins+1)),
+                      "Coord<Maximum>" : numpy.vstack(([[1000, 1000]], maxs+1))}
+
+        labels = numpy.arange(len(mins)) % 3 + 1
+        newlabels, oldlost, newlost = OpObjectClassification.transferLabels(labels, coords_old, coords_new, "xy")
+        assert numpy.all(newlabels[1:] == labels)
+        assert newlabels[0] == 0
+        assert len(oldlost["full"]) == 0
+        assert len(oldlost["partial"]) == 0
+        assert len(newlost["conflict"]) == 0
+
+        # A new object that swallows two labeled ones is a conflict
+        coords_new["Coord<Maximum>"][1] = coords_new["Coord<Minimum>"][1] + [5, 15]
+        newlabels, oldlost, newlost = OpObjectClassification.transferLabels(labels, coords_old, coords_new, "xy")
+        assert newlabels[1] == 0
+        assert len(newlost["conflict"]) == 1
+        assert len(oldlost["partial"]) == 1
     
     
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+import threading
+
+import numpy
+
+from ilastik.applets.pixelClassification.featureSetEvaluation import FeatureSetEvaluator, stratifiedSubsample, \
+                                                                     sequentialForwardSelection
+
+class CountingEvaluation(object):
+    """
+    Deterministic stand-in for a classifier-based evaluation:
+    features 2 and 5 are informative, every feature costs a little.
+    """
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, data, labels, test_data, feature_set):
+        with self._lock:
+            self.calls.append( tuple(feature_set) )
+        return 0.5*(2 in feature_set) + 0.4*(5 in feature_set) - 0.01*len(feature_set)
+
+class TestFeatureSetEvaluation(object):
+    def testStratifiedSubsample(self):
+        labels = numpy.array( [1]*900 + [2]*90 + [3]*10 )
+        numpy.random.shuffle( labels )
+        samples = stratifiedSubsample( labels, 100, seed=0 )
+        assert (numpy.diff(samples) > 0).all()
+        counts = numpy.bincount( labels[samples] )
+        assert list(counts[1:]) == [90, 9, 1]
+
+        # Deterministic
+        assert (samples == stratifiedSubsample( labels, 100, seed=0 )).all()
+
+        # Small label sets are used as they are
+        assert (stratifiedSubsample( labels, 1000 ) == numpy.arange(1000)).all()
+
+    def testMemoization(self):
+        evaluation = CountingEvaluation()
+        evaluator = FeatureSetEvaluator( None, None, evaluation )
+        scores = evaluator.scoreAll( [[2, 5], [5, 2], [1], [2, 5]] )
+        assert scores[0] == scores[1] == scores[3]
+        assert sorted(evaluation.calls) == [(1,), (2, 5)]
+        assert evaluator.num_evaluations == 2
+
+    def testConcurrentScoresOfTheSameSet(self):
+        evaluation = CountingEvaluation()
+        def slow_evaluation(*args):
+            time.sleep(0.1)
+            return evaluation(*args)
+        evaluator = FeatureSetEvaluator( None, None, slow_evaluation )
+
+        scores = []
+        threads = [ threading.Thread( target=lambda s=s: scores.append( evaluator.score(s) ) ) for s in ([3, 4], [4, 3], [3, 4]) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(scores) == 3 and len(set(scores)) == 1
+        assert evaluation.calls == [(3, 4)]
+        assert evaluator.num_evaluations == 1
+
+    def testSequentialForwardSelection(self):
+        for parallel in (True, False):
+            evaluation = CountingEvaluation()
+            evaluator = FeatureSetEvaluator( None, None, evaluation, parallel=parallel )
+            selected, score = sequentialForwardSelection( evaluator, 10, overshoot=3 )
+            assert selected == [2, 5]
+            assert abs(score - 0.88) < 1e-9
+
+            # Stopped after three steps without improvement (instead of trying all 10 features)
+            assert max( len(s) for s in evaluation.calls ) == 5
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,66 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.pixelClassification.opPixelClassification import OpFusedPredictionOutputs, OpArgmaxChannel, OpEnsembleMargin
+
+class TestOpFusedPredictionOutputs(object):
+    def setUp(self):
+        pmaps = numpy.random.random( (20, 30, 4) ).astype(numpy.float32)
+        pmaps /= pmaps.sum(axis=-1)[..., None]
+        self.pmaps = vigra.taggedView( pmaps, 'yxc' )
+
+        graph = Graph()
+        self.opFused = OpFusedPredictionOutputs( graph=graph )
+        self.opFused.Input.setValue( self.pmaps )
+        self.opArgmax = OpArgmaxChannel( graph=graph )
+        self.opArgmax.Input.setValue( self.pmaps )
+        self.opMargin = OpEnsembleMargin( graph=graph )
+        self.opMargin.Input.setValue( self.pmaps )
+
+    def testMatchesSeparateOutputs(self):
+        assert self.opFused.Output.meta.shape == (20, 30, 6)
+        fused = self.opFused.Output[:].wait()
+        assert (fused[..., :4] == self.pmaps).all()
+        assert (fused[..., 4:5] == self.opArgmax.Output[:].wait()).all()
+        assert numpy.allclose( fused[..., 5:6], self.opMargin.Output[:].wait() )
+
+    def testSubregion(self):
+        fused = self.opFused.Output[:].wait()
+        part = self.opFused.Output[5:10, 3:17, 2:5].wait()
+        assert (part == fused[5:10, 3:17, 2:5]).all()
+
+    def testSingleOutputs(self):
+        fused = self.opFused.Output[:].wait()
+        assert fused.dtype == numpy.float32
+        assert (self.opFused.Output[..., 1:3].wait() == self.pmaps[..., 1:3]).all()
+        assert (self.opFused.Output[..., 4:5].wait() == self.opArgmax.Output[:].wait()).all()
+        assert numpy.allclose( self.opFused.Output[..., 5:6].wait(), self.opMargin.Output[:].wait() )
+        assert (self.opFused.Output[2:7, :, 3:6].wait() == fused[2:7, :, 3:6]).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
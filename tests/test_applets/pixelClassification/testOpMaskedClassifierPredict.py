@@ -0,0 +1,84 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpClassifierPredict
+from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
+from ilastik.applets.pixelClassification.opPixelClassification import OpMaskedClassifierPredict
+
+from tests.helpers.opCountingPiper import OpCountingPiper
+
+class TestOpMaskedClassifierPredict(object):
+    def setUp(self):
+        features = numpy.random.random( (200, 200, 3) ).astype(numpy.float32)
+        self.features = vigra.taggedView( features, 'yxc' )
+        labels = (features[..., 0] > 0.5).astype(numpy.uint32) + 1
+        self.classifier = ParallelVigraRfLazyflowClassifierFactory(10).create_and_train( features.reshape(-1, 3)[::10],
+                                                                                           labels.reshape(-1)[::10] )
+
+        # Background everywhere except a region in the top-left corner
+        mask = numpy.zeros( (200, 200, 1), dtype=numpy.uint8 )
+        mask[10:70, 20:90] = 1
+        self.mask = vigra.taggedView( mask, 'yxc' )
+
+        graph = Graph()
+        self.opFeatures = OpCountingPiper( graph=graph )
+        self.opFeatures.Input.setValue( self.features )
+
+        self.opMaskedPredict = OpMaskedClassifierPredict( graph=graph )
+        self.opMaskedPredict.MASK_BLOCK_VOLUME = 50*50
+        self.opMaskedPredict.Image.connect( self.opFeatures.Output )
+        self.opMaskedPredict.LabelsCount.setValue( 2 )
+        self.opMaskedPredict.Classifier.setValue( self.classifier )
+        self.opMaskedPredict.PredictionMask.setValue( self.mask )
+
+        self.opPredict = OpClassifierPredict( graph=graph )
+        self.opPredict.Image.setValue( self.features )
+        self.opPredict.LabelsCount.setValue( 2 )
+        self.opPredict.Classifier.setValue( self.classifier )
+
+    def testMaskedPredictions(self):
+        expected = self.opPredict.PMaps[:].wait() * (self.mask != 0)
+        predictions = self.opMaskedPredict.PMaps[:].wait()
+        assert predictions.shape == expected.shape
+        assert numpy.allclose( predictions, expected )
+
+        # Features (all channels) were only computed for the blocks that intersect the mask
+        assert 0 < self.opFeatures.num_requested_pixels <= 100*100 * self.features.shape[-1]
+
+    def testSubregion(self):
+        expected = self.opPredict.PMaps[:].wait() * (self.mask != 0)
+        predictions = self.opMaskedPredict.PMaps[5:60, 50:150, 1:2].wait()
+        assert numpy.allclose( predictions, expected[5:60, 50:150, 1:2] )
+
+    def testFullyMasked(self):
+        predictions = self.opMaskedPredict.PMaps[100:200, 100:200, :].wait()
+        assert (predictions == 0).all()
+        assert self.opFeatures.num_requested_pixels == 0
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
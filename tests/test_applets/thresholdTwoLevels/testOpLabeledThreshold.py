@@ -38,6 +38,23 @@ class TestOpLabeledThreshold(object):
         assert result.max() == 3
         assert (result.astype(bool) == data.astype(bool)).all()
 
+    def test_simple_blockwise(self):
+        # Labeling with small blocks must produce exactly the same labels as whole-volume labeling.
+        data = self.data
+        core_labels = np.zeros_like(data)
+        expected = vigra.analysis.labelMultiArrayWithBackground((data[0,...,0] >= 0.5).view(np.uint8))
+
+        for block_shape in [(1,3,4), (1,2,2), (1,13,1), (1,1,10)]:
+            op = OpLabeledThreshold(graph=Graph())
+            op.Method.setValue(ThresholdMethod.SIMPLE)
+            op.FinalThreshold.setValue(0.5)
+            op.BlockShape.setValue(block_shape)
+            op.Input.setValue(data.copy())
+            op.CoreLabels.setValue(core_labels)
+
+            result = op.Output[:].wait()
+            assert (result[0,...,0] == expected).all(), "Wrong labels for block shape {}".format(block_shape)
+
     def test_hysteresis(self):
         data = self.data
         core_binary = (data == 5)
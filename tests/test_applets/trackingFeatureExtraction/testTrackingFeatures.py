@@ -0,0 +1,71 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2016, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#                  http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+from ilastik.applets.trackingFeatureExtraction import trackingFeatures
+from ilastik.applets.trackingFeatureExtraction.trackingFeatures import FeatureManager
+
+class TestFeatureManager(object):
+    feat_names = ['ParentChildrenRatio_Count', 'ChildrenRatio_Count', 'ParentChildrenAngle_RegionCenter',
+                  'SquaredDistances_0', 'SquaredDistances_1', 'SquaredDistances_2']
+
+    def setUp(self):
+        # label 0 is the background
+        # object 1 divides into objects 1 and 2, object 2 has no successor nearby
+        self.feats_cur = { 'RegionCenter' : np.array([[0, 0], [20, 20], [80, 80]], dtype=np.float32),
+                           'Count' : np.array([[0], [30], [10]], dtype=np.float32) }
+        # object 3 is too small, object 4 is too far away
+        self.feats_next = { 'RegionCenter' : np.array([[0, 0], [20, 17], [20, 24], [21, 20], [20, 60]], dtype=np.float32),
+                            'Count' : np.array([[0], [10], [20], [2], [30]], dtype=np.float32) }
+
+    def _check(self, result):
+        assert np.allclose(result['SquaredDistances_0'][:,0], [9999, 3, 9999])
+        assert np.allclose(result['SquaredDistances_1'][:,0], [9999, 4, 9999])
+        assert np.allclose(result['SquaredDistances_2'][:,0], [9999, 9999, 9999])
+        assert np.allclose(result['ParentChildrenRatio_Count'][:,0], [0, 1, 0])
+        assert np.allclose(result['ChildrenRatio_Count'][:,0], [0, 0.5, 0])
+        assert np.allclose(result['ParentChildrenAngle_RegionCenter'][:,0], [0, 180, 0])
+
+    def testDivision(self):
+        fm = FeatureManager(ndim=2, template_size=50, size_filter=4)
+        self._check( fm.computeFeatures_at(self.feats_cur, self.feats_next, None, self.feat_names) )
+
+    def testWithoutKDTree(self):
+        cKDTree = trackingFeatures.cKDTree
+        trackingFeatures.cKDTree = None
+        try:
+            self.testDivision()
+        finally:
+            trackingFeatures.cKDTree = cKDTree
+
+    def testLastFrame(self):
+        fm = FeatureManager(ndim=2)
+        result = fm.computeFeatures_at(self.feats_cur, None, None, self.feat_names)
+        for name in self.feat_names:
+            default = 9999 if name.startswith('SquaredDistances') else 0
+            assert (result[name] == default).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
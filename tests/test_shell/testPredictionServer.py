@@ -0,0 +1,124 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import threading
+
+from ilastik.shell.headless.predictionServer import PredictionServer, PredictionClient, JobStatus, parse_address
+
+class BlockingRunner(object):
+    """
+    A stand-in for the batch export: records its jobs and blocks each one until it is released.
+    """
+    def __init__(self):
+        self.jobs = []
+        self.release = threading.Semaphore(0)
+
+    def __call__(self, inputs, export_args):
+        self.release.acquire()
+        if 'fail' in export_args:
+            raise RuntimeError("failed on purpose")
+        self.jobs.append( (inputs, export_args) )
+        return [ path + '.h5' for path in inputs ]
+
+class TestPredictionServer(object):
+    def setUp(self):
+        self.runner = BlockingRunner()
+        self.tmpdir = None
+
+    def _start(self, address=('localhost', 0), max_queued_jobs=2):
+        self.server = PredictionServer( self.runner, address, max_queued_jobs )
+        self.thread = threading.Thread( target=self.server.serve_forever )
+        self.thread.start()
+        return PredictionClient( self.server.address, timeout=10.0 )
+
+    def tearDown(self):
+        for _ in range(10):
+            self.runner.release.release()
+        self.server.shutdown()
+        self.thread.join(10.0)
+        assert not self.thread.is_alive()
+        if self.tmpdir is not None:
+            shutil.rmtree( self.tmpdir )
+
+    def testJobs(self):
+        client = self._start()
+        job = client.submit( '/tmp/a.png', ['--output_format=png'] )
+        assert job['status'] in (JobStatus.QUEUED, JobStatus.RUNNING)
+
+        self.runner.release.release()
+        job = client.wait( job['id'], 10.0 )
+        assert job['status'] == JobStatus.FINISHED
+        assert job['outputs'] == ['/tmp/a.png.h5']
+        assert self.runner.jobs == [ (['/tmp/a.png'], ['--output_format=png']) ]
+
+        job = client.submit( ['/tmp/b.png'], ['fail'] )
+        self.runner.release.release()
+        job = client.wait( job['id'], 10.0 )
+        assert job['status'] == JobStatus.FAILED
+        assert 'failed on purpose' in job['error']
+
+        try:
+            client.status( 1000 )
+        except RuntimeError:
+            pass
+        else:
+            assert False, "Expected an error for an unknown job."
+
+    def testBoundedQueue(self):
+        client = self._start( max_queued_jobs=2 )
+        first = client.submit( '/tmp/0.png' )
+        # Wait until the worker has taken the first job, so the queue is empty.
+        while client.status( first['id'] )['status'] != JobStatus.RUNNING:
+            pass
+
+        client.submit( '/tmp/1.png' )
+        client.submit( '/tmp/2.png' )
+        try:
+            client.submit( '/tmp/3.png' )
+        except RuntimeError:
+            pass
+        else:
+            assert False, "Expected the submission to be rejected."
+
+        for _ in range(3):
+            self.runner.release.release()
+        assert client.wait( first['id'] + 2, 10.0 )['status'] == JobStatus.FINISHED
+        assert [ inputs for inputs, _ in self.runner.jobs ] == [ ['/tmp/0.png'], ['/tmp/1.png'], ['/tmp/2.png'] ]
+
+    def testUnixSocket(self):
+        self.tmpdir = tempfile.mkdtemp()
+        socket_path = os.path.join( self.tmpdir, 'server.sock' )
+        assert parse_address( socket_path ) == socket_path
+        assert parse_address( 'localhost:1234' ) == ('localhost', 1234)
+
+        client = self._start( socket_path )
+        job = client.submit( '/tmp/a.png' )
+        self.runner.release.release()
+        assert client.wait( job['id'], 10.0 )['status'] == JobStatus.FINISHED
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,216 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import json
+import time
+import socket
+import threading
+
+from ilastik.shell.gui.ipcManager import TCPClient, Handler, ThreadingTCPServer, CoalescingQueue, PeerConnection
+
+class DummyWidget(object):
+    def update_connections(self, connections):
+        pass
+
+    def add_sent_command(self, cmd, count):
+        pass
+
+class RecordingSignal(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = []
+
+    def emit(self, name, command):
+        with self.lock:
+            self.received.append( (name, command) )
+
+class CountingHandler(Handler):
+    def handle(self):
+        with self.server.lock:
+            self.server.num_connections += 1
+        Handler.handle(self)
+
+class OneShotHandler(Handler):
+    """
+    Behaves like a peer that reads a single message per connection.
+    """
+    def handle(self):
+        with self.server.lock:
+            self.server.num_connections += 1
+        data = self.request.makefile("rb").readline()
+        self._emit(json.loads(data), "localhost")
+        self.request.shutdown(socket.SHUT_RDWR)
+
+class LoopbackPeer(object):
+    """
+    A peer listening on the loopback interface that records all received commands.
+    """
+    def __init__(self, handler):
+        self.server = ThreadingTCPServer(("localhost", 0), handler)
+        self.server.signal = RecordingSignal()
+        self.server.lock = threading.Lock()
+        self.server.num_connections = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    @property
+    def received(self):
+        with self.server.signal.lock:
+            return list(self.server.signal.received)
+
+    def wait_for(self, num_messages, timeout=5.0):
+        deadline = time.time() + timeout
+        while len(self.received) < num_messages and time.time() < deadline:
+            time.sleep(0.01)
+        return self.received
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def hilite(object_id):
+    return json.dumps({"command": "hilite", "mode": "hilite", "where": {"row": "ilastik_id", "value": object_id}})
+
+def position(x):
+    return json.dumps({"command": "setviewerposition", "t": 0, "x": x, "y": 0, "z": 0})
+
+class TestTCPClient(object):
+    def setUp(self):
+        self.client = TCPClient()
+        self.client.info = DummyWidget()
+        self.peer = None
+
+    def tearDown(self):
+        self.client.stop()
+        if self.peer is not None:
+            self.peer.close()
+
+    def testPersistentConnection(self):
+        self.client.persistent = True
+        self.peer = LoopbackPeer(CountingHandler)
+        self.client.add_peer("test", self.peer.address)
+
+        for i in range(50):
+            self.client.broadcast(hilite(i), "", "hilite")
+        assert self.client.flush(5.0)
+
+        received = self.peer.wait_for(50)
+        assert [command["where"]["value"] for _, command in received] == range(50)
+        assert self.peer.server.num_connections == 1
+
+    def testOneConnectionPerMessage(self):
+        # The default: like before, peers get one message per connection, without a newline
+        assert not self.client.persistent
+        self.peer = LoopbackPeer(CountingHandler)
+        self.client.add_peer("test", self.peer.address)
+
+        for i in range(5):
+            self.client.broadcast(hilite(i), "", "hilite")
+        assert self.client.flush(5.0)
+
+        received = self.peer.wait_for(5)
+        assert [command["where"]["value"] for _, command in received] == range(5)
+        assert self.peer.server.num_connections == 5
+
+    def testReconnect(self):
+        self.client.persistent = True
+        self.peer = LoopbackPeer(OneShotHandler)
+        self.client.add_peer("test", self.peer.address)
+
+        for i in range(5):
+            self.client.broadcast(hilite(i), "", "hilite")
+            assert self.client.flush(5.0)
+            assert len(self.peer.wait_for(i+1)) == i+1
+            # Wait until the peer has dropped the connection
+            time.sleep(0.05)
+
+        assert [command["where"]["value"] for _, command in self.peer.received] == range(5)
+        assert self.peer.server.num_connections == 5
+
+    def testUnreachablePeer(self):
+        # Find a port nobody listens on
+        s = socket.socket()
+        s.bind(("localhost", 0))
+        address = s.getsockname()
+        s.close()
+
+        connection = PeerConnection(address)
+        assert not connection.send("test\n")
+        assert connection.backoff == PeerConnection.INITIAL_BACKOFF
+        assert connection.retry_time > time.time()
+
+        # Don't retry before the backoff expired
+        retry_time = connection.retry_time
+        assert not connection.send("test\n")
+        assert connection.retry_time == retry_time
+
+class TestCoalescingQueue(object):
+    def testLatestWins(self):
+        queue = CoalescingQueue()
+        queue.put("hilite 1")
+        queue.put(position(1), "setviewerposition")
+        queue.put("hilite 2")
+        queue.put(position(2), "setviewerposition")
+        queue.put(position(3), "setviewerposition")
+        queue.put("hilite 3")
+        assert len(queue) == 4
+
+        messages = [queue.get() for _ in range(4)]
+        assert messages == ["hilite 1", position(3), "hilite 2", "hilite 3"]
+
+        # After the position was sent, a new one is queued again
+        queue.put(position(4), "setviewerposition")
+        assert queue.get() == position(4)
+
+    def testJoin(self):
+        queue = CoalescingQueue()
+        queue.put("a")
+        queue.put("b", "key")
+        queue.put("c", "key")
+        assert not queue.join(0.01)
+
+        def consume():
+            for _ in range(2):
+                queue.get()
+                queue.task_done()
+        t = threading.Thread(target=consume)
+        t.start()
+        assert queue.join(5.0)
+        t.join()
+
+    def testClose(self):
+        queue = CoalescingQueue()
+        queue.put("a")
+        queue.close()
+        assert queue.get() is None
+        # Discarded messages don't keep join() waiting
+        assert queue.join(5.0)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,92 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+from ilastik.utility.cacheRegistry import CacheRegistry
+
+class DummyCache(object):
+    def __init__(self, registry, name):
+        self.blocks = {}
+        self.entry = registry.registerDictCache( name, self.evict )
+
+    def add(self, key, nbytes, seconds):
+        self.blocks[key] = nbytes
+        self.entry.insert( key, nbytes, seconds )
+
+    def evict(self, key):
+        del self.blocks[key]
+
+class TestCacheRegistry(object):
+    def setUp(self):
+        self.registry = CacheRegistry()
+        self.registry.setBudget(0)
+        self.old_min_age = CacheRegistry.MINIMUM_BLOCK_AGE_SECONDS
+        CacheRegistry.MINIMUM_BLOCK_AGE_SECONDS = 0.0
+
+    def tearDown(self):
+        CacheRegistry.MINIMUM_BLOCK_AGE_SECONDS = self.old_min_age
+        self.registry.setBudget(0)
+
+    def testReport(self):
+        cache = DummyCache( self.registry, "testReport" )
+        cache.add( 'a', 100, 1.0 )
+        cache.add( 'b', 200, 1.0 )
+
+        reports = filter( lambda r: r.name == "testReport", self.registry.report() )
+        assert len(reports) == 1
+        assert reports[0].usedMemory == 300
+        assert reports[0].numBlocks == 2
+        assert reports[0].lastAccessTime <= time.time()
+
+    def testEvictsCheapBlocksFirst(self):
+        cache = DummyCache( self.registry, "testEvictsCheapBlocksFirst" )
+        cache.add( 'expensive', 1000, 10.0 )
+        cache.add( 'cheap', 1000, 0.1 )
+        cache.add( 'medium', 1000, 1.0 )
+
+        other_usage = self.registry.totalUsedMemory() - 3000
+        self.registry.setBudget( other_usage + 2500 )
+        assert set(cache.blocks.keys()) == set(['expensive', 'medium'])
+
+        self.registry.setBudget( other_usage + 1500 )
+        assert cache.blocks.keys() == ['expensive']
+
+    def testRefusedEviction(self):
+        class PinnedCache(DummyCache):
+            def evict(self, key):
+                if key == 'pinned':
+                    return False
+                del self.blocks[key]
+
+        cache = PinnedCache( self.registry, "testRefusedEviction" )
+        cache.add( 'pinned', 1000, 0.1 )
+        cache.add( 'other', 1000, 10.0 )
+
+        other_usage = self.registry.totalUsedMemory() - 2000
+        self.registry.setBudget( other_usage + 1500 )
+        assert cache.blocks.keys() == ['pinned']
+        assert cache.entry.usedMemory() == 1000
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)